@@ -0,0 +1,255 @@
+"""
+Benchmarks the download paths against local stand-in servers.
+
+Every scenario starts the servers it needs (see mock_servers), then runs the
+unchanged scraper code against them in a fresh child process and working
+directory:
+
+- geofabrik:         geofabrik_china_downloader.scrape_and_download
+- github_yearly:     data_scraper_region.fetch_yearly_data
+- github_directory:  download_github_files.download_directory
+- open_buildings:    the google_colab_data url pipeline
+                     (open_buildings.stream_geotiff_urls_to_file)
+- hf_mirror:         hf_mirror.mirror_repos
+
+It reports wall time, files/s, MB/s (bytes served), request counts and the
+peak RSS of the child. With --warm every scenario runs a second time in the
+same directory, measuring the incremental path. Results can be saved with
+--output and compared with an earlier run with --baseline:
+
+    python benchmarks/bench_downloads.py --latency 50 --bandwidth 20 --output base.json
+    # ... change something ...
+    python benchmarks/bench_downloads.py --latency 50 --bandwidth 20 --baseline base.json
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import queue
+import resource
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from mock_servers import Faults, GCSServer, GeofabrikServer, GitHubServer, HubServer, RequestLog  # noqa: E402
+
+SCENARIOS = ["geofabrik", "github_yearly", "github_directory", "open_buildings", "hf_mirror"]
+
+# 合成 GitHub 仓库中的年份目录
+_GITHUB_YEARS = range(2013, 2024)
+# Open Buildings 场景的区域（新加坡附近，EPSG:4326）
+_OPEN_BUILDINGS_REGION = (103.6, 1.2, 104.05, 1.47)
+_MB = 1024 * 1024
+
+
+def start_servers(name, args, faults, log):
+    """
+    Starts the servers of scenario `name`.
+
+    Returns:
+    A (servers, env, params) tuple: the started servers, the environment
+    variables pointing the scrapers at them and the scenario's parameters.
+    """
+    if name == "geofabrik":
+        server = GeofabrikServer("geofabrik", faults, log, args.geofabrik_files, int(args.geofabrik_mb * _MB),
+                                 args.geofabrik_parts, args.geofabrik_json).start()
+        return [server], {}, {"index_url": server.index_url, "regions": args.geofabrik_regions}
+    if name in ("github_yearly", "github_directory"):
+        years = list(_GITHUB_YEARS)[:args.years]
+        api = GitHubServer("github-api", faults, log, years, args.files_per_year, int(args.file_kb * 1024),
+                           args.truncate_above).start()
+        raw = GitHubServer("github-raw", faults, log, years, args.files_per_year, int(args.file_kb * 1024)).start()
+        api.raw_url = raw.url
+        env = {"GITHUB_API_URL": api.url, "GITHUB_RAW_URL": raw.url}
+        params = {"owner": api.owner, "repo": api.repo, "base_path": api.base_path,
+                  "start_year": years[0], "end_year": years[-1]}
+        return [api, raw], env, params
+    if name == "open_buildings":
+        years = list(range(2016, 2016 + args.years))[:8]
+        server = GCSServer("gcs", faults, log, years, args.tiles_per_manifest).start()
+        return [server], {"STORAGE_EMULATOR_HOST": server.url}, {"years": years, "executor": args.executor}
+    if name == "hf_mirror":
+        server = HubServer("hub", faults, log, args.files_per_repo, int(args.file_kb * 1024),
+                           int(args.lfs_mb * _MB)).start()
+        return [server], {"HF_ENDPOINT": server.url}, {"repos": args.repos, "endpoint": server.url}
+    raise ValueError(f"unknown scenario: {name}")
+
+
+def _count_files(directory):
+    """
+    Returns the number of downloaded files below `directory`, ignoring the
+    object store, sync state and partial files.
+    """
+    count = 0
+    for root, dirs, names in os.walk(directory):
+        dirs[:] = [d for d in dirs if not d.startswith(".")]
+        count += sum(not name.startswith(".") and not name.endswith((".part", ".part.json")) for name in names)
+    return count
+
+
+def run_scenario(name, params):
+    """
+    Runs scenario `name` in the current directory. Returns the number of
+    files in its output (for open_buildings, of manifest cache lookups).
+    """
+    if name == "geofabrik":
+        import geofabrik_china_downloader
+        geofabrik_china_downloader.scrape_and_download(
+            params["index_url"], "out", [".osm.pbf"], segments=params["segments"],
+            min_segment_size=params["min_segment_size"], regions=params["regions"])
+        return _count_files("out")
+    if name == "github_yearly":
+        import data_scraper_region
+        data_scraper_region.fetch_yearly_data(
+            params["owner"], params["repo"], params["start_year"], params["end_year"], params["base_path"])
+        return _count_files("data")
+    if name == "github_directory":
+        import download_github_files
+        download_github_files.download_directory(params["owner"], params["repo"], params["base_path"], "out")
+        return _count_files("out")
+    if name == "open_buildings":
+        import shapely
+        import open_buildings
+        open_buildings.manifest_cache = open_buildings.ManifestCache(os.path.abspath("manifest_cache"))
+        region = shapely.box(*_OPEN_BUILDINGS_REGION)
+        open_buildings.stream_geotiff_urls_to_file(
+            "urls.txt", open_buildings.get_region_s2_covering_tokens(region), region, params["years"],
+            params["executor"])
+        return open_buildings.manifest_cache.hits + open_buildings.manifest_cache.misses
+    if name == "hf_mirror":
+        import hf_mirror
+        repos = [(f"bench/repo{index:03d}", "model") for index in range(params["repos"])]
+        hf_mirror.mirror_repos(repos, root="mirror", endpoint=params["endpoint"])
+        return _count_files("mirror")
+    raise ValueError(f"unknown scenario: {name}")
+
+
+def _child(name, params, env, workdir, verbose, results):
+    os.environ.update(env)
+    sys.path.insert(0, REPO_ROOT)
+    os.chdir(workdir)
+    if not verbose:
+        # 爬虫逐文件打印进度，基准测试时写入日志文件
+        log_fd = os.open(os.path.join(workdir, "run.log"), os.O_WRONLY | os.O_CREAT | os.O_APPEND)
+        os.dup2(log_fd, 1)
+        os.dup2(log_fd, 2)
+    start = time.perf_counter()
+    try:
+        files = run_scenario(name, params)
+        error = None
+    except Exception as e:
+        files = 0
+        error = f"{type(e).__name__}: {e}"
+    seconds = time.perf_counter() - start
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    results.put({"seconds": seconds, "files": files, "peak_rss": peak_rss, "error": error})
+
+
+def measure(name, params, env, workdir, verbose, log):
+    """
+    Runs one scenario in a child process and returns its metrics.
+    """
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    before = log.snapshot()
+    process = context.Process(target=_child, args=(name, params, env, workdir, verbose, results))
+    process.start()
+    process.join()
+    after = log.snapshot()
+    try:
+        result = results.get(timeout=5)
+    except queue.Empty:
+        result = {"seconds": 0.0, "files": 0, "peak_rss": 0, "error": f"child exited with {process.exitcode}"}
+    requests = {key: n - before["requests"].get(key, 0) for key, n in after["requests"].items()
+                if n - before["requests"].get(key, 0)}
+    statuses = {key: n - before["statuses"].get(key, 0) for key, n in after["statuses"].items()
+                if n - before["statuses"].get(key, 0)}
+    result.update({
+        "bytes": after["bytes_sent"] - before["bytes_sent"],
+        "requests": requests,
+        "statuses": statuses,
+    })
+    seconds = max(result["seconds"], 1e-9)
+    result["files_per_second"] = result["files"] / seconds
+    result["mb_per_second"] = result["bytes"] / _MB / seconds
+    return result
+
+
+def print_result(label, result, baseline=None):
+    total_requests = sum(result["requests"].values())
+    line = (f"{label:26s} {result['seconds']:8.2f} s {result['files']:7d} files {result['files_per_second']:9.1f}"
+            f" files/s {result['mb_per_second']:8.1f} MB/s {total_requests:7d} req"
+            f" {result['peak_rss'] / _MB:7.0f} MB RSS")
+    if baseline is not None:
+        def ratio(key):
+            return result[key] / baseline[key] if baseline.get(key) else float("nan")
+        base_requests = sum(baseline["requests"].values())
+        line += (f"  vs baseline: x{ratio('files_per_second'):.2f} files/s, x{ratio('mb_per_second'):.2f} MB/s,"
+                 f" {total_requests - base_requests:+d} req, x{ratio('peak_rss'):.2f} RSS")
+    print(line)
+    if result["error"]:
+        print(f"{'':26s} error: {result['error']}")
+    print(f"{'':26s} " + ", ".join(f"{key}: {n}" for key, n in sorted(result["requests"].items())))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--latency", type=float, default=20, help="Milliseconds added to every response.")
+    parser.add_argument("--bandwidth", type=float, default=0, help="MB/s per connection; 0 for unlimited.")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with 503.")
+    parser.add_argument("--drop-rate", type=float, default=0.0, help="Fraction of bodies cut off halfway.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--warm", action="store_true", help="Run every scenario a second time, incrementally.")
+    parser.add_argument("--geofabrik-files", type=int, default=4)
+    parser.add_argument("--geofabrik-mb", type=float, default=64)
+    parser.add_argument("--geofabrik-parts", type=int, default=0, help="Sub-regions of every Geofabrik region.")
+    parser.add_argument("--geofabrik-json", action="store_true", help="Serve index-v1-nogeom.json.")
+    parser.add_argument("--geofabrik-regions", nargs="+", help="Region globs to download (default: children).")
+    parser.add_argument("--segments", type=int, default=4)
+    parser.add_argument("--segment-min-mb", type=float, default=8)
+    parser.add_argument("--years", type=int, default=8, help="Year folders (GitHub) or years (Open Buildings).")
+    parser.add_argument("--files-per-year", type=int, default=50)
+    parser.add_argument("--file-kb", type=float, default=256)
+    parser.add_argument("--truncate-above", type=int, default=None,
+                        help="Truncate recursive tree responses with more entries than this.")
+    parser.add_argument("--tiles-per-manifest", type=int, default=20000)
+    parser.add_argument("--executor", choices=["thread", "process", "hybrid"], default="hybrid")
+    parser.add_argument("--repos", type=int, default=10)
+    parser.add_argument("--files-per-repo", type=int, default=10)
+    parser.add_argument("--lfs-mb", type=float, default=16)
+    parser.add_argument("--output", help="Write the results to this JSON file.")
+    parser.add_argument("--baseline", help="Compare with the results in this JSON file.")
+    parser.add_argument("--verbose", action="store_true", help="Show the scrapers' output.")
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)["results"]
+    faults = Faults(args.latency / 1000, args.bandwidth * _MB, args.error_rate, args.drop_rate, args.seed)
+    results = {}
+    for name in args.scenarios:
+        log = RequestLog()
+        servers, env, params = start_servers(name, args, faults, log)
+        params.update({"segments": args.segments, "min_segment_size": int(args.segment_min_mb * _MB)})
+        try:
+            with tempfile.TemporaryDirectory(prefix=f"bench_{name}_") as workdir:
+                runs = [name, f"{name} (warm)"] if args.warm else [name]
+                for label in runs:
+                    results[label] = measure(name, params, env, workdir, args.verbose, log)
+                    print_result(label, results[label], baseline.get(label))
+        finally:
+            for server in servers:
+                server.stop()
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"config": vars(args), "results": results}, f, indent=1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""Benchmarks manifest parsing on synthetic manifests.
+
+Compares the previous implementation (json.loads and a walk collecting one
+tuple per source) with `open_buildings.extract_tile_bounds` in its full
+parse (orjson when installed, else json) and streaming modes. Reports the
+best wall time and the peak Python heap allocation (tracemalloc) of each.
+
+  python benchmarks/bench_manifest_parsing.py --sources 200000
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import open_buildings  # pylint: disable=g-import-not-at-top
+
+
+def make_manifest(num_sources: int, num_tilesets: int = 1) -> bytes:
+  """Returns a manifest of `num_sources` 4096x4096 tiles in a UTM grid."""
+  per_tileset = -(-num_sources // num_tilesets)
+  tilesets = []
+  for t in range(num_tilesets):
+    sources = []
+    for i in range(t * per_tileset, min(num_sources, (t + 1) * per_tileset)):
+      row, col = divmod(i, 1000)
+      sources.append({
+          "uris": [f"geotiffs/2020/{row:04d}/{col:04d}.tif"],
+          "affineTransform": {
+              "translateX": 300000.0 + 2048.0 * col,
+              "translateY": 1500000.0 - 2048.0 * row,
+              "scaleX": 0.5,
+              "scaleY": -0.5,
+          },
+          "dimensions": {"width": 4096, "height": 4096},
+      })
+    tilesets.append({"id": f"t{t}", "crs": "EPSG:32648", "sources": sources})
+  return json.dumps({
+      "name": "projects/open-buildings/assets/synthetic",
+      "uriPrefix": "gs://open-buildings-temporal-data/v1/",
+      "tilesets": tilesets,
+  }).encode("utf-8")
+
+
+def reference_extract_tile_bounds(manifest_bytes: bytes):
+  """The previous implementation, kept as the baseline."""
+  manifest = json.loads(manifest_bytes)
+  crs = None
+  urls = []
+  params = []
+  for tileset in manifest["tilesets"]:
+    if crs is None:
+      crs = tileset["crs"]
+    for source in tileset["sources"]:
+      affine_transform = source["affineTransform"]
+      dimensions = source["dimensions"]
+      params.append((
+          affine_transform["translateX"],
+          affine_transform["translateY"],
+          affine_transform["scaleX"],
+          affine_transform["scaleY"],
+          dimensions["width"],
+          dimensions["height"],
+      ))
+      urls.append(manifest["uriPrefix"] + source["uris"][0])
+  params = np.asarray(params, dtype=np.float64).reshape(-1, 6)
+  translate_x, translate_y, scale_x, scale_y, width, height = params.T
+  far_x = translate_x + scale_x * width
+  far_y = translate_y + scale_y * height
+  bounds = np.column_stack((
+      np.minimum(translate_x, far_x),
+      np.minimum(translate_y, far_y),
+      np.maximum(translate_x, far_x),
+      np.maximum(translate_y, far_y),
+  ))
+  return np.asarray(urls, dtype=object), bounds, crs
+
+
+def measure(fn, manifest_bytes: bytes, repeat: int):
+  """Returns (best seconds, peak traced bytes, result) of fn(manifest)."""
+  best = float("inf")
+  for _ in range(repeat):
+    start = time.perf_counter()
+    result = fn(manifest_bytes)
+    best = min(best, time.perf_counter() - start)
+  tracemalloc.start()
+  fn(manifest_bytes)
+  peak = tracemalloc.get_traced_memory()[1]
+  tracemalloc.stop()
+  return best, peak, result
+
+
+def main() -> None:
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument("--sources", type=int, default=200000)
+  parser.add_argument("--tilesets", type=int, default=1)
+  parser.add_argument("--repeat", type=int, default=3)
+  args = parser.parse_args()
+
+  manifest_bytes = make_manifest(args.sources, args.tilesets)
+  print(
+      f"{args.sources} sources, {len(manifest_bytes) / 2**20:.1f} MiB manifest"
+  )
+  full_parser = "orjson" if open_buildings.orjson else "json"
+  candidates = [
+      ("reference (json + tuples)", reference_extract_tile_bounds),
+      (
+          f"extract_tile_bounds ({full_parser})",
+          lambda b: open_buildings.extract_tile_bounds(b, streaming=False),
+      ),
+      (
+          "extract_tile_bounds (streaming)",
+          lambda b: open_buildings.extract_tile_bounds(b, streaming=True),
+      ),
+  ]
+  reference = None
+  for name, fn in candidates:
+    seconds, peak, (urls, bounds, crs) = measure(fn, manifest_bytes, args.repeat)
+    if reference is None:
+      reference = (urls, bounds, crs)
+    same = (
+        crs == reference[2]
+        and np.array_equal(bounds, reference[1])
+        and list(urls) == list(reference[0])
+    )
+    print(
+        f"{name:36s} {seconds:7.3f} s  {args.sources / seconds:12,.0f}"
+        f" sources/s  peak {peak / 2**20:7.1f} MiB"
+        + ("" if same else "  RESULT MISMATCH")
+    )
+
+
+if __name__ == "__main__":
+  main()
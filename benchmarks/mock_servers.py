@@ -0,0 +1,600 @@
+"""
+Local stand-in servers for the download benchmarks.
+
+Each server imitates just enough of one upstream for the scrapers to run
+unchanged against it:
+
+- GitHubServer: the REST API (repos, branches, Git Trees, Contents) and
+  raw.githubusercontent.com over a synthetic tree of year folders.
+- GeofabrikServer: a tree of region pages (`td.subregion` rows), an
+  optional index-v1-nogeom.json and large files served with Range,
+  If-Range and conditional request support.
+- GCSServer: the Cloud Storage JSON API (object listing and media
+  download) of a bucket of synthetic Open Buildings manifests.
+- HubServer: the Hugging Face revision API and resolve endpoint.
+
+All servers share a Faults configuration (latency, bandwidth, errors,
+dropped connections) and count requests and bytes per route in a
+RequestLog.
+"""
+
+import collections
+import email.utils
+import hashlib
+import html
+import json
+import math
+import random
+import re
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 合成文件内容的随机块，按偏移量取值，大文件无需放在内存中
+_PATTERN = random.Random(0).randbytes(1024 * 1024)
+# 每次写入套接字的块大小；限速时按块休眠
+_SEND_CHUNK = 64 * 1024
+_LAST_MODIFIED = email.utils.formatdate(1700000000, usegmt=True)
+
+
+class Faults:
+    """
+    Fault injection shared by the servers.
+
+    Parameters:
+    - latency: Seconds added before every response.
+    - bandwidth: Bytes per second per connection for bodies; 0 for unlimited.
+    - error_rate: Fraction of requests answered with 503.
+    - drop_rate: Fraction of bodies cut off halfway by closing the connection.
+    - seed: Seed of the fault random generator, for repeatable runs.
+    """
+
+    def __init__(self, latency=0.0, bandwidth=0, error_rate=0.0, drop_rate=0.0, seed=0):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.drop_rate = drop_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def roll(self, rate):
+        if not rate:
+            return False
+        with self._lock:
+            return self._random.random() < rate
+
+
+class RequestLog:
+    """
+    Thread-safe request and byte counters, by "<server> <route>".
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = collections.Counter()
+        self.statuses = collections.Counter()
+        self.bytes_sent = 0
+
+    def count(self, key, status, sent):
+        with self._lock:
+            self.requests[key] += 1
+            self.statuses[status] += 1
+            self.bytes_sent += sent
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "requests": dict(self.requests),
+                "statuses": {str(status): n for status, n in self.statuses.items()},
+                "bytes_sent": self.bytes_sent,
+            }
+
+
+class SyntheticFile:
+    """
+    A deterministic file of `size` bytes whose content is derived from `seed`.
+    """
+
+    def __init__(self, size, seed):
+        self.size = size
+        self.seed = seed
+        self._offset = (seed * 7919) % len(_PATTERN)
+        self.etag = f'"{seed:x}-{size:x}"'
+        self._git_sha = None
+
+    def read(self, start, length):
+        out = bytearray()
+        position = (self._offset + start) % len(_PATTERN)
+        while length > 0:
+            chunk = _PATTERN[position:position + length]
+            out += chunk
+            length -= len(chunk)
+            position = 0
+        return bytes(out)
+
+    def git_sha(self):
+        if self._git_sha is None:
+            digest = hashlib.sha1(b"blob %d\0" % self.size)
+            for start in range(0, self.size, len(_PATTERN)):
+                digest.update(self.read(start, min(len(_PATTERN), self.size - start)))
+            self._git_sha = digest.hexdigest()
+        return self._git_sha
+
+    def sha256(self):
+        digest = hashlib.sha256()
+        for start in range(0, self.size, len(_PATTERN)):
+            digest.update(self.read(start, min(len(_PATTERN), self.size - start)))
+        return digest.hexdigest()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self._handle(head=False)
+
+    def do_HEAD(self):
+        self._handle(head=True)
+
+    def _handle(self, head):
+        server = self.server
+        parts = urllib.parse.urlsplit(self.path)
+        path = urllib.parse.unquote(parts.path)
+        query = dict(urllib.parse.parse_qsl(parts.query))
+        if server.faults.latency:
+            time.sleep(server.faults.latency)
+        if server.faults.roll(server.faults.error_rate):
+            self._send(f"{server.name} error", 503, b"injected error", {"Retry-After": "1"}, head)
+            return
+        route, status, body, headers = server.route(path, query, self.headers)
+        if isinstance(body, SyntheticFile):
+            self._send_file(f"{server.name} {route}", body, headers, head)
+        else:
+            self._send(f"{server.name} {route}", status, body, headers, head)
+
+    def _send(self, key, status, body, headers, head):
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        sent = 0 if head else self._write(lambda start, length: body[start:start + length], len(body))
+        self.server.log.count(key, status, sent)
+
+    def _send_file(self, key, file, headers, head):
+        request = self.headers
+        if request.get("If-None-Match") == file.etag or request.get("If-Modified-Since") == _LAST_MODIFIED:
+            self._send(key, 304, b"", {"ETag": file.etag}, head)
+            return
+        start, end = 0, file.size - 1
+        status = 200
+        match = re.fullmatch(r"bytes=(\d+)-(\d*)", request.get("Range", ""))
+        if_range = request.get("If-Range")
+        if match and (if_range is None or if_range in (file.etag, _LAST_MODIFIED)):
+            start = int(match.group(1))
+            if match.group(2):
+                end = min(int(match.group(2)), file.size - 1)
+            if start >= file.size:
+                self._send(key, 416, b"", {"Content-Range": f"bytes */{file.size}"}, head)
+                return
+            status = 206
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", file.etag)
+        self.send_header("Last-Modified", _LAST_MODIFIED)
+        self.send_header("Content-Length", str(end - start + 1))
+        if status == 206:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{file.size}")
+        self.end_headers()
+        sent = 0 if head else self._write(lambda offset, length: file.read(start + offset, length), end - start + 1)
+        self.server.log.count(key, status, sent)
+
+    def _write(self, read, length):
+        """
+        Writes `length` bytes obtained from read(offset, length), throttled,
+        and possibly cut off halfway. Returns the number of bytes written.
+        """
+        faults = self.server.faults
+        cutoff = length // 2 if length > 1 and faults.roll(faults.drop_rate) else length
+        sent = 0
+        try:
+            while sent < cutoff:
+                chunk = read(sent, min(_SEND_CHUNK, cutoff - sent))
+                self.wfile.write(chunk)
+                sent += len(chunk)
+                if faults.bandwidth:
+                    time.sleep(len(chunk) / faults.bandwidth)
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+            return sent
+        if cutoff < length:
+            self.wfile.flush()
+            self.close_connection = True
+        return sent
+
+
+class MockServer(ThreadingHTTPServer):
+    """
+    A threaded HTTP server on 127.0.0.1 (random port) running in the
+    background. Subclasses implement route().
+
+    Parameters:
+    - name: Label of the server in the request counts.
+    - faults: Faults to inject.
+    - log: RequestLog to count requests in.
+    """
+
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, name, faults, log):
+        super().__init__(("127.0.0.1", 0), _Handler)
+        self.name = name
+        self.faults = faults
+        self.log = log
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def route(self, path, query, headers):
+        """
+        Returns (route label, status, body, headers) for a request; `body` is
+        bytes or a SyntheticFile (served with range support).
+        """
+        raise NotImplementedError
+
+
+def _json(route, payload, status=200, headers=None):
+    return route, status, json.dumps(payload).encode("utf-8"), {"Content-Type": "application/json", **(headers or {})}
+
+
+def _not_found(route="not found"):
+    return route, 404, b'{"message": "Not Found"}', {"Content-Type": "application/json"}
+
+
+class GitHubServer(MockServer):
+    """
+    GitHub API and raw file host over a synthetic repository.
+
+    The repository contains `base_path`/<year>年/<index>.shp files for every
+    year, plus one LICENSE.txt shared by all years (same content, so it
+    exercises blob deduplication). Start it twice to get separate API and
+    raw hosts, as on github.com.
+
+    Parameters:
+    - years: Years with a folder.
+    - files_per_year: Files in each year folder.
+    - file_size: Size of each file in bytes.
+    - truncate_above: Answer recursive tree requests with more entries than
+      this with `truncated: true` (None to never truncate).
+    """
+
+    owner = "bench"
+    repo = "shengshixian.com"
+    base_path = "CTAmap(2013年-2023年)行政区划矢量"
+    branch = "master"
+
+    def __init__(self, name, faults, log, years, files_per_year, file_size, truncate_above=None):
+        super().__init__(name, faults, log)
+        self.truncate_above = truncate_above
+        self.raw_url = None
+        self.files = {}
+        for year in years:
+            for index in range(files_per_year):
+                self.files[f"{self.base_path}/{year}年/{index:04d}.shp"] = SyntheticFile(file_size, year * 100000 + index)
+            self.files[f"{self.base_path}/{year}年/LICENSE.txt"] = SyntheticFile(4096, 1)
+        self.shas = {path: file.git_sha() for path, file in self.files.items()}
+        self.trees = self._build_trees()
+        self._remaining = 5000
+        self._remaining_lock = threading.Lock()
+
+    def _build_trees(self):
+        """
+        Returns tree sha -> (directory path, direct children) where children
+        are (name, "blob" or "tree", sha) tuples; "" is the root.
+        """
+        children = collections.defaultdict(dict)
+        for path in self.files:
+            parts = path.split("/")
+            for depth in range(1, len(parts)):
+                children["/".join(parts[:depth - 1])][parts[depth - 1]] = "tree"
+            children["/".join(parts[:-1])][parts[-1]] = "blob"
+        trees = {}
+        self.dir_shas = {}
+        for directory in children:
+            self.dir_shas[directory] = hashlib.sha1(f"tree {directory}".encode("utf-8")).hexdigest()
+        for directory, entries in children.items():
+            items = []
+            for child, kind in sorted(entries.items()):
+                child_path = f"{directory}/{child}" if directory else child
+                sha = self.shas[child_path] if kind == "blob" else self.dir_shas[child_path]
+                items.append((child, kind, sha))
+            trees[self.dir_shas[directory]] = (directory, items)
+        return trees
+
+    def _rate_headers(self):
+        with self._remaining_lock:
+            self._remaining = max(self._remaining - 1, 1)
+            remaining = self._remaining
+        return {
+            "X-RateLimit-Limit": "5000",
+            "X-RateLimit-Remaining": str(remaining),
+            "X-RateLimit-Reset": str(int(time.time()) + 3600),
+        }
+
+    def _tree_items(self, sha, recursive, prefix=""):
+        directory, entries = self.trees[sha]
+        items = []
+        for name, kind, child_sha in entries:
+            item = {"path": prefix + name, "mode": "100644" if kind == "blob" else "040000", "type": kind,
+                    "sha": child_sha}
+            if kind == "blob":
+                item["size"] = self.files[f"{directory}/{name}" if directory else name].size
+            items.append(item)
+            if recursive and kind == "tree":
+                items.extend(self._tree_items(child_sha, True, prefix + name + "/"))
+        return items
+
+    def route(self, path, query, headers):
+        api = f"/repos/{self.owner}/{self.repo}"
+        raw = f"/{self.owner}/{self.repo}/"
+        if path == api:
+            return _json("repo", {"default_branch": self.branch}, headers=self._rate_headers())
+        if path.startswith(api + "/branches/"):
+            root = self.dir_shas[""]
+            return _json("branch", {"name": self.branch, "commit": {"sha": root, "commit": {"tree": {"sha": root}}}},
+                         headers=self._rate_headers())
+        if path.startswith(api + "/git/trees/"):
+            sha = path[len(api + "/git/trees/"):]
+            if sha in (self.branch, "HEAD"):
+                sha = self.dir_shas[""]
+            if sha not in self.trees:
+                return _not_found("trees")
+            recursive = bool(query.get("recursive"))
+            items = self._tree_items(sha, recursive)
+            truncated = recursive and self.truncate_above is not None and len(items) > self.truncate_above
+            if truncated:
+                items = items[:self.truncate_above]
+            return _json("trees", {"sha": sha, "tree": items, "truncated": truncated}, headers=self._rate_headers())
+        if path.startswith(api + "/contents"):
+            directory = path[len(api + "/contents"):].strip("/")
+            if directory not in self.dir_shas:
+                return _not_found("contents")
+            entries = []
+            for name, kind, sha in self.trees[self.dir_shas[directory]][1]:
+                child = f"{directory}/{name}" if directory else name
+                entries.append({
+                    "type": "file" if kind == "blob" else "dir", "name": name, "path": child, "sha": sha,
+                    "size": self.files[child].size if kind == "blob" else 0,
+                    "download_url": (f"{self.raw_url}/{self.owner}/{self.repo}/{self.branch}/"
+                                     f"{urllib.parse.quote(child)}" if kind == "blob" else None),
+                })
+            return _json("contents", entries, headers=self._rate_headers())
+        if path.startswith(raw):
+            _, _, file_path = path[len(raw):].partition("/")
+            file = self.files.get(file_path)
+            if file is None:
+                return _not_found("raw")
+            return "raw", 200, file, {}
+        return _not_found()
+
+
+class GeofabrikServer(MockServer):
+    """
+    Geofabrik-style download site: a region page at /asia/china.html whose
+    `td.subregion` rows link to `num_files` sub-region pages and their
+    large files. Every sub-region page lists its own file and, with
+    `parts` > 0, that many smaller sub-regions of its own (files only).
+    With `json_index` the site also serves /index-v1-nogeom.json.
+
+    Parameters:
+    - num_files: Sub-regions of China, each with one file.
+    - file_size: Size of each sub-region's file in bytes.
+    - parts: Sub-regions of each sub-region.
+    - json_index: Serve the machine-readable index.
+    """
+
+    index_path = "/asia/china.html"
+
+    def __init__(self, name, faults, log, num_files, file_size, parts=0, json_index=False):
+        super().__init__(name, faults, log)
+        self.json_index = json_index
+        # 区域路径 -> 文件
+        self.regions = {}
+        for index in range(num_files):
+            region = f"asia/china/region{index:02d}"
+            self.regions[region] = SyntheticFile(file_size, 1000 + index)
+            for part in range(parts):
+                self.regions[f"{region}/part{part:02d}"] = SyntheticFile(
+                    max(file_size // 16, 1), 100000 + index * 100 + part)
+        self.files = {f"/{region}-latest.osm.pbf": file for region, file in self.regions.items()}
+
+    @property
+    def index_url(self):
+        return self.url + self.index_path
+
+    def _children(self, parent):
+        return [region for region in self.regions if region.rsplit("/", 1)[0] == parent]
+
+    def _page(self, region):
+        name = region.rsplit("/", 1)[1]
+        rows = "".join(
+            f'<tr onMouseOver="this.className=\'highlight\'"><td class="subregion">'
+            f'<a href="{name}/{html.escape(child.rsplit("/", 1)[1])}.html">{html.escape(child.rsplit("/", 1)[1])}</a>'
+            f'</td><td style="border-right: 0"><a href="{name}/{html.escape(child.rsplit("/", 1)[1])}-latest.osm.pbf">'
+            f'[.osm.pbf]</a></td><td>({self.regions[child].size / 1e6:.0f} MB)</td></tr>'
+            for child in self._children(region)
+        )
+        own = (f'<li><a href="{name}-latest.osm.pbf">{name}-latest.osm.pbf</a></li>'
+               if region in self.regions else "")
+        page = (f'<html><body><p><a href="../index.html">Geofabrik</a> <a href="../{name}.html">up</a></p>'
+                f'<ul>{own}</ul><table id="subregions"><tr><th>Sub Region</th></tr>{rows}</table></body></html>')
+        return page.encode("utf-8")
+
+    def _index(self):
+        features = [{"type": "Feature", "properties": {
+            "id": "china", "parent": "asia", "name": "China", "urls": {}}}]
+        for region in self.regions:
+            parent = region.rsplit("/", 1)[0]
+            features.append({"type": "Feature", "properties": {
+                "id": region.rsplit("/", 1)[1] if parent == "asia/china" else region,
+                "parent": "china" if parent == "asia/china" else parent.rsplit("/", 1)[1],
+                "name": region.rsplit("/", 1)[1],
+                "urls": {"pbf": f"{self.url}/{region}-latest.osm.pbf", "updates": f"{self.url}/{region}-updates"},
+            }})
+        return {"type": "FeatureCollection", "features": features}
+
+    def route(self, path, query, headers):
+        if path == self.index_path:
+            return "index", 200, self._page("asia/china"), {"Content-Type": "text/html; charset=utf-8"}
+        if path == "/index-v1-nogeom.json":
+            return _json("json index", self._index()) if self.json_index else _not_found("json index")
+        if path.endswith(".html") and path[1:-len(".html")] in self.regions:
+            return "page", 200, self._page(path[1:-len(".html")]), {"Content-Type": "text/html; charset=utf-8"}
+        file = self.files.get(path)
+        if file is None:
+            return _not_found()
+        return "file", 200, file, {"Content-Type": "application/octet-stream"}
+
+
+class GCSServer(MockServer):
+    """
+    Cloud Storage JSON API over a bucket of synthetic Open Buildings
+    manifests; point the client at it with STORAGE_EMULATOR_HOST.
+
+    Any S2 cell listed gets one manifest per year, holding a square grid of
+    `tiles_per_manifest` 1 km tiles in EPSG:32648 centered on `center`.
+
+    Parameters:
+    - years: Years with a manifest for every cell.
+    - tiles_per_manifest: Sources in each manifest.
+    - center: (x, y) of the tile grid in EPSG:32648 (default: Singapore).
+    """
+
+    bucket = "open-buildings-temporal-data"
+
+    def __init__(self, name, faults, log, years, tiles_per_manifest, center=(366000.0, 149000.0)):
+        super().__init__(name, faults, log)
+        self.years = list(years)
+        self.tiles_per_manifest = tiles_per_manifest
+        self.center = center
+        self._manifests = {}
+        self._lock = threading.Lock()
+
+    def _manifest(self, name):
+        with self._lock:
+            body = self._manifests.get(name)
+        if body is not None:
+            return body
+        side = math.ceil(math.sqrt(self.tiles_per_manifest))
+        origin_x = self.center[0] - side * 500.0
+        origin_y = self.center[1] + side * 500.0
+        stem = name.rsplit("/", 1)[-1][:-len(".json")]
+        sources = []
+        for index in range(self.tiles_per_manifest):
+            row, col = divmod(index, side)
+            sources.append({
+                "uris": [f"geotiffs/{stem}/{row:04d}_{col:04d}.tif"],
+                "affineTransform": {"translateX": origin_x + 1000.0 * col, "translateY": origin_y - 1000.0 * row,
+                                    "scaleX": 0.5, "scaleY": -0.5},
+                "dimensions": {"width": 2000, "height": 2000},
+            })
+        body = json.dumps({
+            "name": f"projects/open-buildings/assets/{stem}",
+            "uriPrefix": f"gs://{self.bucket}/v1/",
+            "tilesets": [{"id": "0", "crs": "EPSG:32648", "sources": sources}],
+        }).encode("utf-8")
+        with self._lock:
+            self._manifests[name] = body
+        return body
+
+    def _object(self, name):
+        body = self._manifest(name)
+        return {
+            "kind": "storage#object", "bucket": self.bucket, "name": name, "generation": "1",
+            "md5Hash": "", "size": str(len(body)),
+        }
+
+    def route(self, path, query, headers):
+        objects = f"/storage/v1/b/{self.bucket}/o"
+        media = f"/download/storage/v1/b/{self.bucket}/o/"
+        if path == f"/storage/v1/b/{self.bucket}":
+            return _json("bucket", {"kind": "storage#bucket", "name": self.bucket})
+        if path == objects:
+            prefix = query.get("prefix", "")
+            match = re.search(r"([0-9a-f]+)_$", prefix)
+            if not match:
+                return _json("list", {"kind": "storage#objects"})
+            names = [f"{prefix}{year}_manifest.json" for year in self.years]
+            return _json("list", {"kind": "storage#objects", "items": [self._object(name) for name in names]})
+        if path.startswith(objects + "/"):
+            return _json("metadata", self._object(path[len(objects) + 1:]))
+        if path.startswith(media):
+            body = self._manifest(path[len(media):])
+            return "media", 200, body, {"Content-Type": "application/json"}
+        return _not_found()
+
+
+class HubServer(MockServer):
+    """
+    Hugging Face Hub revision API and resolve endpoint for synthetic
+    repositories. Every repository holds `files_per_repo` regular files of
+    `file_size` bytes, unique per repository, and one LFS file of
+    `lfs_size` bytes shared by all repositories.
+    """
+
+    commit = hashlib.sha1(b"bench commit").hexdigest()
+
+    def __init__(self, name, faults, log, files_per_repo, file_size, lfs_size):
+        super().__init__(name, faults, log)
+        self.files_per_repo = files_per_repo
+        self.file_size = file_size
+        self.lfs_file = SyntheticFile(lfs_size, 7)
+        self._lfs_sha256 = self.lfs_file.sha256()
+        self._repos = {}
+        self._lock = threading.Lock()
+
+    def _repo_files(self, repo_id):
+        with self._lock:
+            files = self._repos.get(repo_id)
+            if files is None:
+                seed = int(hashlib.sha1(repo_id.encode("utf-8")).hexdigest()[:8], 16)
+                files = {f"shard-{index:03d}.bin": SyntheticFile(self.file_size, seed + index)
+                         for index in range(self.files_per_repo)}
+                files["model.safetensors"] = self.lfs_file
+                self._repos[repo_id] = files
+            return files
+
+    def route(self, path, query, headers):
+        match = re.fullmatch(r"/api/(models|datasets)/([^/]+/[^/]+)/revision/[^/]+", path)
+        if match:
+            siblings = []
+            for name, file in self._repo_files(match.group(2)).items():
+                sibling = {"rfilename": name, "size": file.size, "blobId": file.git_sha()}
+                if file is self.lfs_file:
+                    sibling["lfs"] = {"sha256": self._lfs_sha256, "size": file.size, "pointerSize": 134}
+                siblings.append(sibling)
+            return _json("revision", {"id": match.group(2), "sha": self.commit, "siblings": siblings})
+        match = re.fullmatch(r"/(?:datasets/)?([^/]+/[^/]+)/resolve/[^/]+/(.+)", path)
+        if match:
+            file = self._repo_files(match.group(1)).get(match.group(2))
+            if file is None:
+                return _not_found("resolve")
+            return "resolve", 200, file, {"X-Repo-Commit": self.commit}
+        return _not_found()
@@ -0,0 +1,167 @@
+import errno
+import hashlib
+import os
+import shutil
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    # Windows 没有 fcntl，无法 reflink，直接退回到复制
+    fcntl = None
+
+from download_engine import get_engine
+from sync_state import file_sha256
+
+# 对象库目录名，放在下载根目录下，保证与镜像文件在同一文件系统上可以硬链接
+OBJECTS_DIR = ".objects"
+# Linux FICLONE ioctl，用于 btrfs / xfs 上的 reflink
+_FICLONE = 0x40049409
+
+
+def git_blob_sha(path, chunk_size=1024 * 1024):
+    """
+    Returns the git blob SHA-1 of the file at `path` (the `sha` GitHub's
+    Contents and Trees APIs report for a file).
+    """
+    digest = hashlib.sha1(b"blob %d\0" % os.path.getsize(path))
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def content_digest(path, sha):
+    """
+    Returns the digest of the file at `path` of the same kind as `sha`: the
+    SHA-256 of its content for 64 hex digit keys (Hugging Face LFS files),
+    else its git blob SHA-1.
+    """
+    if len(sha) == 64:
+        return file_sha256(path)
+    return git_blob_sha(path)
+
+
+def _reflink(src, dest):
+    if fcntl is None:
+        raise OSError(errno.ENOTSUP, "reflink is not supported on this platform")
+    with open(src, "rb") as s, open(dest, "wb") as d:
+        fcntl.ioctl(d.fileno(), _FICLONE, s.fileno())
+
+
+class BlobStore:
+    """
+    Content-addressed object store keyed by git blob SHA (or by content
+    SHA-256 for files whose host reports that instead, see content_digest).
+
+    Every distinct file is stored once under `root/ab/cdef...`; mirror paths
+    are materialized as hardlinks (or reflinks / copies when hardlinking is
+    not possible). Hardlinked mirror files share their bytes with the
+    object, so they must be treated as read-only.
+
+    Parameters:
+    - root: Directory holding the objects.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self._lock = threading.Lock()
+        self._sha_locks = {}
+
+    def path_for(self, sha):
+        return os.path.join(self.root, sha[:2], sha[2:])
+
+    def has(self, sha):
+        return os.path.exists(self.path_for(sha))
+
+    def lock_for(self, sha):
+        """
+        Returns the lock serializing fetches of one SHA, so identical files
+        requested concurrently are transferred only once.
+        """
+        with self._lock:
+            return self._sha_locks.setdefault(sha, threading.Lock())
+
+    def ingest(self, src, sha):
+        """
+        Moves the file `src` into the store as object `sha`.
+
+        Raises ValueError if the content does not hash to `sha`.
+        """
+        actual = content_digest(src, sha)
+        if actual != sha:
+            os.remove(src)
+            raise ValueError(f"blob sha mismatch: expected {sha}, got {actual}")
+        object_path = self.path_for(sha)
+        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+        os.replace(src, object_path)
+
+    def materialize(self, sha, dest):
+        """
+        Makes `dest` a hardlink (else reflink, else copy) of object `sha`.
+        """
+        object_path = self.path_for(sha)
+        directory = os.path.dirname(dest)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = dest + ".link"
+        if os.path.lexists(tmp_path):
+            os.remove(tmp_path)
+        try:
+            os.link(object_path, tmp_path)
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+                raise
+            try:
+                _reflink(object_path, tmp_path)
+            except OSError:
+                shutil.copyfile(object_path, tmp_path)
+        os.replace(tmp_path, dest)
+
+    def is_materialized(self, sha, dest):
+        """
+        Returns True if `dest` already is a hardlink of object `sha`.
+        """
+        try:
+            return os.path.samefile(self.path_for(sha), dest)
+        except OSError:
+            return False
+
+
+def fetch_blob(store, url, local_path, sha, headers=None, state=None):
+    """
+    Materializes the git blob `sha` at `local_path`, downloading it from
+    `url` only if the store does not have it yet.
+
+    Parameters:
+    - store: The BlobStore to use.
+    - url: Where to download the blob from (raw file URL).
+    - local_path: Mirror path to materialize.
+    - sha: The git blob SHA reported by the listing (or content SHA-256).
+    - headers: Extra request headers (optional).
+    - state: SyncState to record the mirror file in (optional).
+
+    Returns:
+    True when bytes were transferred, False when the file was already up to
+    date or was reused from the store.
+    """
+    engine = get_engine()
+    record = state.get(url) if state is not None else None
+    if store.is_materialized(sha, local_path) or (
+            record and record.get("git_sha") == sha and os.path.exists(local_path)
+            and os.path.getsize(local_path) == record.get("size")):
+        engine.count(skipped=1)
+        return False
+    with store.lock_for(sha):
+        transferred = False
+        if not store.has(sha):
+            incoming = os.path.join(store.root, "incoming", sha)
+            engine.download(url, incoming, headers=headers)
+            store.ingest(incoming, sha)
+            transferred = True
+        else:
+            engine.count(deduplicated=1)
+        store.materialize(sha, local_path)
+    if state is not None:
+        state.record(url, local_path, git_sha=sha)
+    return transferred
@@ -1,11 +1,11 @@
 import os
-import time
 from selenium import webdriver
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.chrome.options import Options
-import requests
+
+from download_engine import get_engine, wait_all
 
 def fetch_all_data(url, save_path):
     chrome_options = Options()
@@ -20,7 +20,9 @@ def fetch_all_data(url, save_path):
     # 定位到特定目录
     driver.find_element(By.XPATH, '//a[@href="/ruiduobao/shengshixian.com/tree/master/CTAmap%282013%E5%B9%B4-2023%E5%B9%B4%29%E8%A1%8C%E6%94%BF%E5%8C%BA%E5%88%92%E7%9F%A2%E9%87%8F"]').click()
 
-    # 获取所有子目录和文件
+    # 获取所有子目录和文件，文件提交给共享下载引擎并发下载
+    engine = get_engine()
+    futures = {}
     elements = driver.find_elements(By.CSS_SELECTOR, "div.js-navigation-container")
     for element in elements:
         items = element.find_elements(By.CSS_SELECTOR, "a.js-navigation-open")
@@ -32,12 +34,13 @@ def fetch_all_data(url, save_path):
                 continue
 
             download_url = f"{file_url}?raw=true"
-            response = requests.get(download_url)
             print(download_url)
-            with open(os.path.join(save_path, file_name), "wb") as f:
-                f.write(response.content)
+            futures[engine.submit_download(download_url, os.path.join(save_path, file_name))] = download_url
 
     driver.quit()
+    _, errors = wait_all(futures)
+    for download_url, e in errors:
+        print(f"下载失败 {download_url}: {e}")
 
 if __name__ == "__main__":
     url = "https://github.com/ruiduobao/shengshixian.com/tree/master/CTAmap%282013%E5%B9%B4-2023%E5%B9%B4%29%E8%A1%8C%E6%94%BF%E5%8C%BA%E5%88%92%E7%9F%A2%E9%87%8F"
@@ -1,42 +1,85 @@
-from multiprocessing import Pool
+from concurrent.futures import FIRST_COMPLETED, wait
 import requests
-import base64
 import os
+import time
+import urllib.parse
 
-# Create a session object to reuse TCP connections
-session = requests.Session()
+from blob_store import OBJECTS_DIR, BlobStore, fetch_blob
+from download_engine import get_engine
+from github_api import GITHUB_RAW_URL, list_tree, scheduler
+from metrics import get_metrics
+from sync_state import SYNC_STATE_FILE, SyncState
 
-def fetch_file_content(repo_owner, repo_name, file_path, local_file_path,  access_token=None):
+def fetch_file_content(repo_owner, repo_name, file_path, local_file_path,  access_token=None, size=None, state=None,
+                       sha=None, store=None, download_url=None):
     """
     Fetches the content of a file from a GitHub repository.
 
+    The raw file is streamed straight to disk in large chunks (see
+    download_engine), so memory use does not depend on the file size and
+    files larger than the Contents API's 1 MB limit download correctly.
+
     Parameters:
     - repo_owner: The owner of the repository.
     - repo_name: The name of the repository.
     - file_path: The path to the file in the repository.
     - access_token: Personal access token for GitHub API (optional).
+    - size: Size of the file from the directory listing (optional).
+    - state: SyncState for incremental sync (optional); the file is skipped
+      when its local size matches `size` or the server answers 304.
+    - sha: Git blob SHA of the file from the directory listing (optional).
+    - store: BlobStore (optional); together with `sha`, a file whose SHA is
+      already stored locally is hardlinked into place instead of downloaded.
+    - download_url: Raw URL of the file from the directory listing
+      (optional); defaults to the file on the repository's HEAD.
 
     Returns:
-    The decoded content of the file.
+    True if the local file is up to date, False if it could not be fetched.
     """
-    url = f"https://api.github.com/repos/{repo_owner}/{repo_name}/contents/{file_path}"
+    url = download_url or f"{GITHUB_RAW_URL}/{repo_owner}/{repo_name}/HEAD/{urllib.parse.quote(file_path)}"
     headers = {}
 
     if access_token:
         headers['Authorization'] = f'token {access_token}'
 
-    response = requests.get(url, headers=headers)
-
-    if response.status_code == 200:
-        with open(local_file_path, 'wb') as file:
-            file.write(response.content)
-        print(f"File {file_path} downloaded successfully.")
-    else:
-        print(f"Failed to download file {file_path}. Status code: {response.status_code}")
+    engine = get_engine()
+    while True:
+        try:
+            if store is not None and sha is not None:
+                if not fetch_blob(store, url, local_file_path, sha, headers, state):
+                    print(f"File {file_path} is unchanged or already stored, skipped.")
+                    return True
+            elif state is not None:
+                if not engine.sync(url, local_file_path, state, headers=headers, expected_size=size):
+                    print(f"File {file_path} is unchanged, skipped.")
+                    return True
+            else:
+                engine.download(url, local_file_path, headers=headers)
+        except requests.HTTPError as e:
+            # 被限流时等到配额重置再重试，而不是丢掉这个文件
+            wait = scheduler.update(e.response)
+            if wait is not None:
+                print(f"Rate limited while fetching {file_path}, retrying in {wait:.0f}s.")
+                get_metrics().retry(url)
+                get_metrics().count("github_rate_limit_wait_seconds", wait)
+                time.sleep(wait)
+                continue
+            print(f"Failed to download file {file_path}. Status code: {e.response.status_code}")
+            return False
+        break
+    print(f"File {file_path} downloaded successfully.")
+    return True
 def get_github_directory_contents(repo_owner, repo_name, directory_path, year,access_token=None):
     """
     Fetches the contents of a directory from a GitHub repository.
 
+    The whole directory is listed with one Git Trees API call (see
+    github_api.list_tree) and its files are fetched in parallel by the
+    crawler in `crawl_directories`. Sync state is kept in
+    ./data/.sync_state.json and file contents in the ./data/.objects store
+    keyed by git blob SHA, so files identical to one already downloaded
+    (e.g. in another year) are hardlinked instead of transferred again.
+
     Parameters:
     - repo_owner: The owner of the repository.
     - repo_name: The name of the repository.
@@ -44,68 +87,123 @@ def get_github_directory_contents(repo_owner, repo_name, directory_path, year,ac
     - access_token: Personal access token for GitHub API (optional).
 
     Returns:
-    A list of files and directories in the specified directory.
+    The completion status of the directory, see `crawl_directories`.
     """
-    url = f"https://api.github.com/repos/{repo_owner}/{repo_name}/contents/{directory_path}"
-    headers = {}
-
-    if access_token:
-        headers['Authorization'] = f'token {access_token}'
-
-    response = session.get(url, headers=headers)
-
-    if response.status_code == 200:
-        contents = response.json()
-        local_dir = os.path.join("./data", directory_path)
-        if not os.path.exists(local_dir):
-            os.makedirs(local_dir)
-        if isinstance(contents, list):
-            for item in contents:
-                item_path = item['path']
-                item_type = item['type']
-                item_name = item['name']
-                if item_type == "file":
-                    fetch_file_content(
-                        repo_owner, repo_name, item_path, os.path.join(local_dir, item_name), access_token
-                    )
-                    # if file_content is not None:
-                    #     local_file_path = f"./data/{year}/{item['name']}"
-                    #     # save_file_content(local_file_path, file_content)
-                    #     print(f"Saved {item['name']} to {local_file_path}")
-                if item_type == "dir":
-                    get_github_directory_contents(
-                        repo_owner, repo_name, os.path.join(directory_path, item_name), year, access_token
-                    )
-
-        else:
-            print(f"Error fetching directory contents: {contents}")
-    else:
-        print(f"无法访问 {url}, 状态码: {response.status_code}")
+    return crawl_directories(repo_owner, repo_name, {year: directory_path}, access_token)[year]
 
-def save_file_content(local_path, content):
+def crawl_directories(repo_owner, repo_name, directories, access_token=None):
     """
-    Saves content to a file in the specified local path.
+    Mirrors several repository directories with one bounded work queue.
+
+    Every directory listing is a task on the shared download engine; as soon
+    as a listing completes, its files are queued as download tasks on the
+    same pool, so listings and downloads of all directories overlap and the
+    run takes about as long as the slowest directory. Listings and file
+    fetches are timed as the "listing" and "download" stages of the
+    process-wide metrics, which are reported at the end (see metrics).
 
     Parameters:
-    - local_path: The local file path where the content will be saved.
-    - content: The content to save.
+    - repo_owner: The owner of the repository.
+    - repo_name: The name of the repository.
+    - directories: Mapping of key (e.g. year) -> directory path.
+    - access_token: Personal access token for GitHub API (optional).
+
+    Returns:
+    A dict ordered by key, mapping each key to its status:
+    {"directory", "status" ("complete", "incomplete", "empty" or
+    "listing failed"),
+    "files", "fetched", "failed" (sorted list of paths)}.
     """
-    os.makedirs(os.path.dirname(local_path), exist_ok=True)
-    with open(local_path, 'w', encoding='utf-8') as file:
-        file.write(content)
+    engine = get_engine()
+    metrics = get_metrics()
+    state = SyncState(os.path.join("./data", SYNC_STATE_FILE))
+    store = BlobStore(os.path.join("./data", OBJECTS_DIR))
+    results = {
+        key: {"directory": path, "status": None, "files": 0, "fetched": 0, "failed": []}
+        for key, path in sorted(directories.items())
+    }
+    outstanding = {}
+    tasks = {}
+    for key, path in directories.items():
+        tasks[engine.submit(metrics.timed, "listing", list_tree, repo_owner, repo_name, path,
+                            token=access_token)] = ("list", key, path)
+
+    def finish(key):
+        result = results[key]
+        result["failed"].sort()
+        if not result["files"]:
+            result["status"] = "empty"
+        else:
+            result["status"] = "complete" if not result["failed"] else "incomplete"
+        print(f"{key}: {result['directory']} 完成 {result['fetched']}/{result['files']} 个文件")
+
+    try:
+        while tasks:
+            done, _ = wait(tasks, return_when=FIRST_COMPLETED)
+            for future in done:
+                kind, key, path = tasks.pop(future)
+                if kind == "list":
+                    try:
+                        files = future.result()
+                    except requests.RequestException as e:
+                        # 连接中断等错误没有 response，只让这一年失败，其余年份继续
+                        if e.response is not None:
+                            print(f"无法访问 {e.response.url}, 状态码: {e.response.status_code}")
+                        else:
+                            print(f"无法列出目录 {path}: {e}")
+                        results[key]["status"] = "listing failed"
+                        continue
+                    results[key]["files"] = len(files)
+                    outstanding[key] = len(files)
+                    for item in files:
+                        local_file_path = os.path.join("./data", *item['path'].split('/'))
+                        fetch = engine.submit(
+                            metrics.timed, "download", fetch_file_content,
+                            repo_owner, repo_name, item['path'], local_file_path, access_token,
+                            item['size'], state, item['sha'], store, item['download_url']
+                        )
+                        tasks[fetch] = ("fetch", key, item['path'])
+                    if not files:
+                        finish(key)
+                    continue
+                try:
+                    ok = future.result()
+                except Exception as e:
+                    print(f"Failed to download file {path}: {e}")
+                    ok = False
+                if ok:
+                    results[key]["fetched"] += 1
+                else:
+                    results[key]["failed"].append(path)
+                outstanding[key] -= 1
+                if outstanding[key] == 0:
+                    finish(key)
+    finally:
+        # 异常退出时取消尚未开始的任务，并保存已完成文件的同步状态
+        for future in tasks:
+            future.cancel()
+        state.save()
+        print(engine.summary())
+        metrics.report()
+    return results
 
 def fetch_yearly_data(repo_owner, repo_name, start_year, end_year, base_directory_path, access_token=None):
     """
     Fetches and saves files from yearly directories within a specified range.
+
+    All years are crawled concurrently (see `crawl_directories`).
+
+    Returns:
+    A dict year -> completion status, in year order.
     """
-    # years = range(start_year, end_year + 1)
-    # directory_path = f"{base_directory_path}/{year}年"
-    # with Pool(processes=len(years)) as pool:
-    #     pool.map(lambda year: get_github_directory_contents(repo_owner, repo_name, f"{base_directory_path}/{year}年", year, access_token), years)
-    for year in range(start_year, end_year + 1):
-        directory_path = f"{base_directory_path}/{year}年"
-        get_github_directory_contents(repo_owner, repo_name, directory_path, year, access_token)
-        print(f"get contents of year {year} of {directory_path}")
+    directories = {
+        year: f"{base_directory_path}/{year}年" for year in range(start_year, end_year + 1)
+    }
+    results = crawl_directories(repo_owner, repo_name, directories, access_token)
+    for year, result in results.items():
+        print(f"get contents of year {year} of {result['directory']}: {result['status']}, "
+              f"{result['fetched']}/{result['files']} files")
+    return results
 
 
 # Example usage
@@ -1,25 +1,145 @@
-# from datasets import load_dataset
-from huggingface_hub import snapshot_download
+import asyncio
 import json
-def get_model(target_repo_id):
-    print(f'-----------------------begin get_model :{target_repo_id} --------------------')
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from datasets import load_dataset
+from huggingface_hub import snapshot_download
+
+# 同时下载的仓库数
+MAX_CONCURRENT_REPOS = 4
+# 每个仓库内同时下载的文件数（snapshot_download 的 max_workers）
+MAX_CONCURRENT_FILES = 8
+# Hub 地址，可用 HF_ENDPOINT 指向镜像站或本地测试服务；None 表示官方地址。
+# load_dataset 直接读取同一个环境变量
+HF_ENDPOINT = os.environ.get("HF_ENDPOINT")
+
+
+def model_dir(target_repo_id):
     m_name = target_repo_id.split("/")
-    snapshot_download(repo_id=target_repo_id, local_dir=f'./models/{m_name[0]}/{m_name[1]}')
+    return f'./models/{m_name[0]}/{m_name[1]}'
+
+
+def dataset_dir(target_dataset):
+    d_name = target_dataset.replace("/", "-")
+    return f'./cache_datasets/{d_name}'
+
+
+def get_model(target_repo_id, endpoint=HF_ENDPOINT, max_workers=MAX_CONCURRENT_FILES):
+    print(f'-----------------------begin get_model :{target_repo_id} --------------------')
+    return snapshot_download(repo_id=target_repo_id, local_dir=model_dir(target_repo_id),
+                             endpoint=endpoint, max_workers=max_workers)
+
+
 def get_dataset(t_dataset=""):
-    target_dataset = t_dataset
-   
-    #data_files = {"train": "train.csv", "test": "test.csv", "validation": "validation.csv"}
-    d_name = target_dataset.replace("/", "-") 
- 
+    print(f'-----------------------begin get_dataset: {t_dataset} --------------------')
+    return load_dataset(t_dataset, cache_dir=dataset_dir(t_dataset))
+
+
+def _dir_stats(path):
+    """
+    Returns the (file count, total bytes) of the files below `path`.
+    Symlinks (the snapshot entries of a Hub cache) are not counted, so each
+    blob is counted once.
+    """
+    files = 0
+    size = 0
+    for root, _, names in os.walk(path):
+        for name in names:
+            file_path = os.path.join(root, name)
+            if os.path.islink(file_path):
+                continue
+            try:
+                size += os.path.getsize(file_path)
+            except OSError:
+                continue
+            files += 1
+    return files, size
+
+
+def _describe(error):
+    lines = str(error).strip().splitlines()
+    return f"{type(error).__name__}: {lines[0] if lines else ''}"
+
+
+def fetch_repo(repo_id, fetch_fn, target_dir):
+    """
+    Runs one blocking fetch, e.g. on an executor thread. Failures are
+    recorded in the result instead of raised, so one bad repo does not stop
+    the others.
+
+    Parameters:
+    - repo_id: The repository.
+    - fetch_fn: fetch_fn(repo_id) downloads the repository into target_dir.
+    - target_dir: Directory the repository is downloaded into.
+
+    Returns:
+    A dict with repo_id, seconds, files (now in target_dir), disk_bytes (how
+    much target_dir grew during the fetch; files that were already cached
+    add nothing, so this is not the number of bytes transferred) and error
+    (None on success).
+    """
+    _, size_before = _dir_stats(target_dir)
+    start = time.monotonic()
+    error = None
     try:
-      print(f'-----------------------begin get_dataset: {target_dataset} --------------------')
-      dataset = load_dataset(target_dataset,cache_dir=f'./cache_datasets/{d_name}')
-    except ZeroDivisionError as e:
-      print(e)
-      
-    finally:  
-      print('The try except is finished')   
-       
+        fetch_fn(repo_id)
+    except Exception as e:
+        error = e
+        print(f"下载失败 {repo_id}: {_describe(e)}")
+    files, size = _dir_stats(target_dir)
+    result = {
+        "repo_id": repo_id,
+        "seconds": time.monotonic() - start,
+        "files": files,
+        "disk_bytes": max(size - size_before, 0),
+        "error": error,
+    }
+    if error is None:
+        print(f"已下载 {repo_id}: 磁盘新增 {result['disk_bytes'] / 1e6:.1f} MB, {result['seconds']:.1f} 秒")
+    return result
+
+
+async def _fetch_repos(jobs, max_repos):
+    loop = asyncio.get_running_loop()
+    with ThreadPoolExecutor(max_workers=max_repos) as executor:
+        return await asyncio.gather(*(loop.run_in_executor(executor, fetch_repo, *job) for job in jobs))
+
+
+def fetch_repos(jobs, max_repos=MAX_CONCURRENT_REPOS):
+    """
+    Fetches Hugging Face repositories concurrently.
+
+    The blocking downloads run on a thread pool of `max_repos` workers, so
+    at most `max_repos` repositories are in flight; get_model fetches up to
+    MAX_CONCURRENT_FILES files of each at the same time.
+
+    Parameters:
+    - jobs: (repo_id, fetch_fn, target_dir) tuples, see `fetch_repo`.
+    - max_repos: Repositories downloaded at the same time.
+
+    Returns:
+    One `fetch_repo` result per job, in order.
+    """
+    return asyncio.run(_fetch_repos(jobs, max_repos))
+
+
+def print_summary(results, seconds):
+    """
+    Prints the number of repositories fetched and failed and how fast the
+    target directories grew during a run that took `seconds`.
+    """
+    failed = [result for result in results if result["error"] is not None]
+    disk_bytes = sum(result["disk_bytes"] for result in results)
+    total_files = sum(result["files"] for result in results)
+    print(f"完成 {len(results) - len(failed)}/{len(results)} 个仓库，"
+          f"共 {total_files} 个文件，磁盘新增 {disk_bytes / 1e6:.1f} MB，"
+          f"耗时 {seconds:.1f} 秒，平均 {disk_bytes / 1e6 / max(seconds, 1e-9):.1f} MB/s（按磁盘增长计）")
+    for result in failed:
+        print(f"  失败: {result['repo_id']}: {_describe(result['error'])}")
+
+
 if __name__ == "__main__":
     datasets = []
     models = []
@@ -28,18 +148,16 @@ if __name__ == "__main__":
     with open('./dataset.json', 'r') as f:
         datasets = json.load(f)
         print(datasets)
-        f.close()
-    
-        
+
     with open('./models.json', 'r') as f:
         models = json.load(f)
         print(models)
-        f.close()
-    if is_model is True: 
-        for ml in models:
-          print(ml['model_name'])
-          get_model(ml['model_name'])
+
+    jobs = []
+    if is_model is True:
+        jobs += [(ml['model_name'], get_model, model_dir(ml['model_name'])) for ml in models]
     if is_ds is True:
-        for ml in datasets:
-            print(ml['ds_name'])
-            get_dataset(ml['ds_name']) 
+        jobs += [(ml['ds_name'], get_dataset, dataset_dir(ml['ds_name'])) for ml in datasets]
+    start = time.monotonic()
+    results = fetch_repos(jobs)
+    print_summary(results, time.monotonic() - start)
@@ -2,42 +2,59 @@ from datasets import load_dataset
 from huggingface_hub import snapshot_download
 import json
 import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from get_hugface_model_dataset import MAX_CONCURRENT_FILES, MAX_CONCURRENT_REPOS, fetch_repo, print_summary
+
+# get_ds/get_models 的阻塞下载在此线程池上运行，同时最多下载 MAX_CONCURRENT_REPOS 个仓库
+executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REPOS)
+
+
 def get_model(target_repo_id):
     print(f'-----------------------begin get_model :{target_repo_id} --------------------')
     m_name = target_repo_id.replace("/", "-")
     snapshot_download(repo_id=target_repo_id, local_dir=f'./GPT/models/{m_name}')
+
+
 def get_dataset(t_dataset=""):
-    target_dataset = t_dataset
-   
-    #data_files = {"train": "train.csv", "test": "test.csv", "validation": "validation.csv"}
-    d_name = target_dataset.replace("/", "-") 
- 
-    try:
-      print(f'-----------------------begin get_dataset: {target_dataset} --------------------')
-      dataset = load_dataset(target_dataset,cache_dir=f'./datasets/{d_name}')
-    except ZeroDivisionError as e:
-      print(e)
-      
-    finally:  
-      print('The try except is finished')   
+    print(f'-----------------------begin get_dataset: {t_dataset} --------------------')
+    d_name = t_dataset.replace("/", "-")
+    return load_dataset(t_dataset, cache_dir=f'./datasets/{d_name}')
+
+
+def ds_dir(repo_path):
+    return f'./cache_datasets/{repo_path.replace("/", "-")}'
+
+
+def models_dir(repo_path):
+    return f'./models/{repo_path.replace("/", "-")}'
+
+
+def load_ds(repo_path):
+    return load_dataset(repo_path, cache_dir=ds_dir(repo_path))
+
+
+def load_models(repo_path):
+    return snapshot_download(repo_path, cache_dir=models_dir(repo_path), max_workers=MAX_CONCURRENT_FILES)
+
+
 async def get_ds(repo_path):
-    repo_name = repo_path.replace("/", "-")
-    try:
-      print(f'-----------------------begin get_dataset: {repo_path} --------------------')
-      dataset = load_dataset(repo_path,cache_dir=f'./cache_datasets/{repo_name}')
-    except ZeroDivisionError as e:
-      print(e)
-    finally:  
-      print(f'download {repo_path}The try except is finished')   
+    print(f'-----------------------begin get_dataset: {repo_path} --------------------')
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, fetch_repo, repo_path, load_ds, ds_dir(repo_path))
+
+
 async def get_models(repo_path):
-    repo_name = repo_path.replace("/", "-")
-    try:
-      print(f'-----------------------begin download model: {repo_path} --------------------')
-      snapshot_download(repo_path,cache_dir=f'./models/{repo_name}')
-    except ZeroDivisionError as e:
-      print(e)
-    finally:  
-      print(f'download {repo_path}The try except is finished')         
+    print(f'-----------------------begin download model: {repo_path} --------------------')
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, fetch_repo, repo_path, load_models, models_dir(repo_path))
+
+
+async def gather_all(tasks):
+    return await asyncio.gather(*tasks)
+
+
 if __name__ == "__main__":
     datasets = []
     models = []
@@ -45,24 +62,19 @@ if __name__ == "__main__":
     is_ds = False
     ds_path = "./hf_ds.json"
     ms_path = "./hf_model.json"
-    loop = asyncio.get_event_loop()
-    get_ds_task = None
-    get_model_task = None
     with open(ds_path, 'r') as f:
         datasets = json.load(f)
         print(datasets)
-        f.close()
-    
-        
+
     with open(ms_path, 'r') as f:
         models = json.load(f)
         print(models)
-        f.close()
 
+    tasks = []
     if is_ds is True:
-      get_ds_task = [get_ds(repo["ds_name"]) for repo in datasets]
-      loop.run_until_complete(asyncio.gather(*get_ds_task))
-
+        tasks += [get_ds(repo["ds_name"]) for repo in datasets]
     if is_model is True:
-      get_model_task = [get_models(repo["model_name"]) for repo in models]
-      loop.run_until_complete(asyncio.gather(*get_model_task))
+        tasks += [get_models(repo["model_name"]) for repo in models]
+    start = time.monotonic()
+    results = asyncio.run(gather_all(tasks))
+    print_summary(results, time.monotonic() - start)
@@ -0,0 +1,594 @@
+import json
+import os
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from metrics import get_metrics
+
+# 全局并发上限（同时进行的下载任务数）
+MAX_WORKERS = 16
+# 单个主机的并发连接上限
+MAX_PER_HOST = 8
+# 流式写盘的块大小
+CHUNK_SIZE = 1024 * 1024
+# (连接超时, 读取超时)，单位秒
+TIMEOUT = (10, 300)
+# 连接中断后的自动重试次数（每次从 .part 文件的末尾续传）
+RETRIES = 5
+# 服务器暂时不可用时，连接池按 1, 2, 4, ... 秒（或 Retry-After）退避重试的状态码
+RETRY_STATUSES = (502, 503, 504)
+# 分段下载时每段的最小字节数，小于 2 段的文件直接单流下载
+SEGMENT_MIN_SIZE = 64 * 1024 * 1024
+# 分段下载时每传输这么多字节或经过这么多秒，就把数据与各段进度落盘一次
+CHECKPOINT_BYTES = 16 * 1024 * 1024
+CHECKPOINT_SECONDS = 5
+
+# 传输中断时会触发续传重试的异常
+_RETRYABLE = (
+    requests.ConnectionError,
+    requests.Timeout,
+    requests.exceptions.ChunkedEncodingError,
+)
+
+
+class _StatusRetry(Retry):
+    """
+    Status-based retry policy of the engine's connection pools that records
+    every retry against `host` in the process-wide metrics.
+    """
+
+    host = None
+
+    def new(self, **kw):
+        retry = super().new(**kw)
+        retry.host = self.host
+        return retry
+
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        if response is not None and self.host is not None:
+            get_metrics().retry(self.host)
+        return super().increment(method, url, response, error, _pool, _stacktrace)
+
+
+def _status_retry(host):
+    # 只按状态码重试；连接与读取错误照常抛出，由调用方（如 download 的续传）处理
+    retry = _StatusRetry(total=None, connect=0, read=False, other=0, status=RETRIES,
+                         status_forcelist=RETRY_STATUSES, allowed_methods=frozenset({"GET", "HEAD"}),
+                         backoff_factor=1, raise_on_status=False)
+    retry.host = host
+    return retry
+
+
+class IncompleteDownload(requests.ConnectionError):
+    """The server closed the stream before sending the advertised length."""
+
+
+class RangeNotHonored(Exception):
+    """The server answered a segment request with something other than 206."""
+
+
+def _host(url):
+    parts = urllib.parse.urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}"
+
+
+def _load_part_meta(meta_path, url):
+    """
+    Returns the validator record of a .part file, or None if it is missing,
+    unreadable or belongs to another URL.
+    """
+    try:
+        with open(meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return meta if meta.get("url") == url else None
+
+
+def _save_part_meta(meta_path, meta):
+    tmp_path = meta_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, meta_path)
+
+
+def _if_range_validator(meta):
+    """
+    Returns the value for If-Range: a strong ETag, else Last-Modified.
+    Weak ETags are not allowed in If-Range.
+    """
+    etag = meta.get("etag")
+    if etag and not etag.startswith("W/"):
+        return etag
+    return meta.get("last_modified")
+
+
+class DownloadEngine:
+    """
+    Shared download engine used by all scrapers.
+
+    Keeps one keep-alive connection pool per host and runs download jobs on a
+    bounded thread pool. Concurrency is limited globally (max_workers) and per
+    host (max_per_host); a host slot is only held while bytes are in flight.
+    Every request made through the pools (`get`, `download`, ...) that is
+    answered with one of RETRY_STATUSES is retried up to RETRIES times with
+    exponential backoff, honouring Retry-After.
+    Every request's latency, status, bytes and retries are recorded in the
+    process-wide metrics (see metrics.get_metrics).
+
+    Parameters:
+    - max_workers: Maximum number of jobs running at the same time.
+    - max_per_host: Maximum number of concurrent transfers to one host.
+    """
+
+    def __init__(self, max_workers=MAX_WORKERS, max_per_host=MAX_PER_HOST):
+        self.max_workers = max_workers
+        self.max_per_host = max_per_host
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="download")
+        self._lock = threading.Lock()
+        self._sessions = {}
+        self._host_slots = {}
+        self.stats = {"downloaded": 0, "skipped": 0, "deduplicated": 0, "bytes": 0}
+
+    def session(self, url):
+        """
+        Returns the pooled requests.Session for the host of `url`.
+        """
+        host = _host(url)
+        with self._lock:
+            session = self._sessions.get(host)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_per_host, pool_block=True,
+                                      max_retries=_status_retry(host))
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self._sessions[host] = session
+        return session
+
+    @contextmanager
+    def host_slot(self, url):
+        """
+        Holds one of the per-host concurrency slots of `url`'s host.
+        """
+        host = _host(url)
+        with self._lock:
+            slot = self._host_slots.get(host)
+            if slot is None:
+                slot = threading.BoundedSemaphore(self.max_per_host)
+                self._host_slots[host] = slot
+        start = time.perf_counter()
+        with slot:
+            # 等待槽位的时间：持续偏高说明 max_per_host 是瓶颈
+            get_metrics().count("host_slot_wait_seconds", time.perf_counter() - start)
+            yield
+
+    def count(self, **deltas):
+        """
+        Adds `deltas` to the engine's counters (see `stats`).
+        """
+        with self._lock:
+            for key, value in deltas.items():
+                self.stats[key] += value
+
+    def summary(self):
+        """
+        Returns a one-line human summary of the engine's counters.
+        """
+        with self._lock:
+            stats = dict(self.stats)
+        summary = f"下载 {stats['downloaded']} 个文件，跳过 {stats['skipped']} 个未变化文件，"
+        if stats["deduplicated"]:
+            summary += f"从本地对象库复用 {stats['deduplicated']} 个文件，"
+        return summary + f"传输 {stats['bytes'] / 1024 / 1024:.1f} MB"
+
+    def get(self, url, **kwargs):
+        """
+        Issues a non-streaming GET through the host's pooled session.
+        """
+        kwargs.setdefault("timeout", TIMEOUT)
+        with self.host_slot(url), get_metrics().request(url) as record:
+            response = self.session(url).get(url, **kwargs)
+            record["status"] = response.status_code
+            record["bytes"] = len(response.content)
+            return response
+
+    def download(self, url, local_path, headers=None, on_chunk=None):
+        """
+        Streams `url` to `local_path` in CHUNK_SIZE blocks, resumably.
+
+        Bytes go to `local_path + ".part"`; the response's ETag/Last-Modified
+        are recorded next to it in `.part.json`. After a crash or a dropped
+        connection the transfer continues with a `Range:` request guarded by
+        `If-Range`, so a changed file on the server restarts from zero instead
+        of being spliced. `local_path` only appears, through an atomic rename,
+        once the download is complete.
+
+        Parameters:
+        - url: The URL to download.
+        - local_path: Destination file path; parent directories are created.
+        - headers: Extra request headers (optional).
+        - on_chunk: Callback `on_chunk(downloaded, total)` called after every
+          written block; `total` is None when the server sends no length.
+
+        Returns:
+        A dict with the number of `bytes` transferred by this call and the
+        response's `etag` / `last_modified`, or None when a conditional
+        request in `headers` was answered with 304 Not Modified. Raises
+        requests.HTTPError on a non-2xx response.
+        """
+        directory = os.path.dirname(local_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        part_path = local_path + ".part"
+        meta_path = part_path + ".json"
+        counter = {"bytes": 0, "etag": None, "last_modified": None}
+        for attempt in range(RETRIES + 1):
+            try:
+                if self._transfer(url, part_path, meta_path, headers, on_chunk, counter) is False:
+                    return None
+                break
+            except _RETRYABLE as e:
+                if attempt == RETRIES:
+                    self.count(bytes=counter["bytes"])
+                    raise
+                get_metrics().retry(url)
+                print(f"下载中断 {url}: {e}，{2 ** attempt} 秒后续传")
+                time.sleep(2 ** attempt)
+        os.replace(part_path, local_path)
+        if os.path.exists(meta_path):
+            os.remove(meta_path)
+        self.count(downloaded=1, bytes=counter["bytes"])
+        return counter
+
+    def _transfer(self, url, part_path, meta_path, headers, on_chunk, counter):
+        """
+        Performs one (possibly ranged) GET appending to `part_path`; bytes
+        received are added to `counter["bytes"]` and the response validators
+        stored in `counter`. Returns False on 304 Not Modified.
+        """
+        meta = _load_part_meta(meta_path, url)
+        offset = 0
+        validator = None
+        if meta is not None and os.path.exists(part_path):
+            offset = os.path.getsize(part_path)
+            validator = _if_range_validator(meta)
+        if offset and not validator:
+            # 没有校验值就无法确认服务器文件未变，只能从头下载
+            offset = 0
+
+        request_headers = dict(headers or {})
+        # 按原始字节传输，保证 Content-Length / Range 与写入的字节一致
+        request_headers.setdefault("Accept-Encoding", "identity")
+        if offset:
+            request_headers["Range"] = f"bytes={offset}-"
+            request_headers["If-Range"] = validator
+
+        with self.host_slot(url), get_metrics().request(url) as record:
+            with self.session(url).get(url, headers=request_headers, stream=True, timeout=TIMEOUT) as r:
+                record["status"] = r.status_code
+                if r.status_code == 304:
+                    return False
+                if r.status_code == 416 and offset and offset == meta.get("total"):
+                    # .part 已经完整，只差重命名
+                    return
+                r.raise_for_status()
+                if r.status_code == 206 and offset:
+                    print(f"断点续传 {os.path.basename(part_path)}，已有 {offset} 字节")
+                    mode = "ab"
+                else:
+                    offset = 0
+                    mode = "wb"
+                length = r.headers.get("content-length")
+                total = offset + int(length) if length is not None else None
+                counter["etag"] = r.headers.get("etag")
+                counter["last_modified"] = r.headers.get("last-modified")
+                _save_part_meta(meta_path, {
+                    "url": url,
+                    "etag": counter["etag"],
+                    "last_modified": counter["last_modified"],
+                    "total": total,
+                })
+                downloaded = offset
+                with open(part_path, mode) as f:
+                    for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                        if chunk:
+                            f.write(chunk)
+                            downloaded += len(chunk)
+                            counter["bytes"] += len(chunk)
+                            record["bytes"] += len(chunk)
+                            if on_chunk is not None:
+                                on_chunk(downloaded, total)
+                    f.flush()
+                    os.fsync(f.fileno())
+        if total is not None and downloaded != total:
+            raise IncompleteDownload(f"expected {total} bytes, got {downloaded}")
+
+    def download_segmented(self, url, local_path, segments=4, min_segment_size=SEGMENT_MIN_SIZE,
+                           headers=None, on_chunk=None):
+        """
+        Downloads `url` as up to `segments` byte ranges fetched concurrently.
+
+        The .part file is preallocated to the full size and every range is
+        written at its own offset with os.pwrite, so nothing is reassembled
+        afterwards. Per-segment progress is kept in `.part.json`, and an
+        interrupted run resumes each segment where it stopped. Falls back to
+        the single-stream `download` when the server does not advertise
+        `Accept-Ranges: bytes`, the file is smaller than two segments or the
+        platform has no os.pwrite (Windows). When one segment fails (e.g. a
+        range request answered with 200), the other segments stop at their
+        next block instead of running to completion.
+        Progress is checkpointed every CHECKPOINT_BYTES / CHECKPOINT_SECONDS,
+        after an fsync of the data, so a killed process loses at most that
+        much of each segment.
+
+        Parameters:
+        - url: The URL to download.
+        - local_path: Destination file path; parent directories are created.
+        - segments: Maximum number of concurrent ranges.
+        - min_segment_size: Minimum size of one range in bytes.
+        - headers: Extra request headers (optional).
+        - on_chunk: Callback `on_chunk(downloaded, total)`, see `download`.
+
+        Returns:
+        The same result dict as `download`.
+        """
+        if not hasattr(os, "pwrite"):
+            return self.download(url, local_path, headers, on_chunk)
+        part_path = local_path + ".part"
+        meta_path = part_path + ".json"
+        meta = _load_part_meta(meta_path, url)
+        if meta is not None and "segments" not in meta and os.path.exists(part_path):
+            # 之前的单流下载留下的 .part，继续单流续传
+            return self.download(url, local_path, headers, on_chunk)
+
+        request_headers = dict(headers or {})
+        request_headers.setdefault("Accept-Encoding", "identity")
+        with self.host_slot(url), get_metrics().request(url) as record:
+            head = self.session(url).head(url, headers=request_headers, allow_redirects=True, timeout=TIMEOUT)
+            record["status"] = head.status_code
+        length = head.headers.get("content-length")
+        accepts_ranges = "bytes" in head.headers.get("accept-ranges", "").lower()
+        if head.status_code != 200 or length is None or not accepts_ranges:
+            return self.download(url, local_path, headers, on_chunk)
+        total = int(length)
+        count = min(segments, total // max(min_segment_size, 1))
+        if count < 2:
+            return self.download(url, local_path, headers, on_chunk)
+
+        etag = head.headers.get("etag")
+        last_modified = head.headers.get("last-modified")
+        if (meta is None or not os.path.exists(part_path) or meta.get("total") != total
+                or meta.get("etag") != etag or meta.get("last_modified") != last_modified):
+            # 新下载（或服务器文件已变化）：重新切分并预分配文件
+            bounds = [total * i // count for i in range(count + 1)]
+            meta = {
+                "url": url,
+                "etag": etag,
+                "last_modified": last_modified,
+                "total": total,
+                "segments": [[bounds[i], bounds[i + 1], 0] for i in range(count)],
+            }
+            directory = os.path.dirname(local_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(part_path, "wb") as f:
+                if hasattr(os, "posix_fallocate"):
+                    os.posix_fallocate(f.fileno(), 0, total)
+                else:
+                    f.truncate(total)
+            _save_part_meta(meta_path, meta)
+        else:
+            done = sum(segment[2] for segment in meta["segments"])
+            print(f"断点续传 {os.path.basename(part_path)}，已有 {done} 字节")
+
+        validator = _if_range_validator(meta)
+        if validator:
+            request_headers["If-Range"] = validator
+        lock = threading.Lock()
+        # 任一分段失败后置位，其余分段在下一个数据块处停止
+        stop = threading.Event()
+        progress = {
+            "downloaded": sum(segment[2] for segment in meta["segments"]),
+            "bytes": 0,
+        }
+
+        def checkpoint(fd):
+            # 先 fsync 数据再写进度：崩溃后 .part.json 记录的字节一定已经在磁盘上
+            with lock:
+                os.fsync(fd)
+                _save_part_meta(meta_path, meta)
+
+        def fetch_segment(segment, fd):
+            start, end, done = segment
+            saved = done
+            saved_at = time.monotonic()
+            while start + done < end and not stop.is_set():
+                range_headers = dict(request_headers)
+                range_headers["Range"] = f"bytes={start + done}-{end - 1}"
+                with self.host_slot(url), get_metrics().request(url) as record:
+                    with self.session(url).get(url, headers=range_headers, stream=True, timeout=TIMEOUT) as r:
+                        record["status"] = r.status_code
+                        r.raise_for_status()
+                        if r.status_code != 206:
+                            raise RangeNotHonored(f"{url} 分段请求返回状态码 {r.status_code}")
+                        for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                            if not chunk:
+                                continue
+                            chunk = chunk[:end - start - done]
+                            os.pwrite(fd, chunk, start + done)
+                            done += len(chunk)
+                            record["bytes"] += len(chunk)
+                            with lock:
+                                segment[2] = done
+                                progress["downloaded"] += len(chunk)
+                                progress["bytes"] += len(chunk)
+                                if on_chunk is not None:
+                                    on_chunk(progress["downloaded"], total)
+                            if done - saved >= CHECKPOINT_BYTES or time.monotonic() - saved_at >= CHECKPOINT_SECONDS:
+                                checkpoint(fd)
+                                saved = done
+                                saved_at = time.monotonic()
+                            if start + done >= end or stop.is_set():
+                                break
+                if start + done < end and not stop.is_set():
+                    raise IncompleteDownload(f"segment {start}-{end - 1} stopped at {start + done}")
+
+        def run_segment(segment, fd):
+            for attempt in range(RETRIES + 1):
+                try:
+                    return fetch_segment(segment, fd)
+                except _RETRYABLE as e:
+                    if attempt == RETRIES:
+                        stop.set()
+                        raise
+                    get_metrics().retry(url)
+                    print(f"分段下载中断 {url}: {e}，{2 ** attempt} 秒后续传")
+                    if stop.wait(2 ** attempt):
+                        return
+                except BaseException:
+                    stop.set()
+                    raise
+                finally:
+                    checkpoint(fd)
+
+        fd = os.open(part_path, os.O_WRONLY)
+        try:
+            pending = [segment for segment in meta["segments"] if segment[0] + segment[2] < segment[1]]
+            # 分段运行在独立线程上，只在传输时占用主机并发槽位，不会与引擎线程池互相等待
+            with ThreadPoolExecutor(max_workers=len(meta["segments"]), thread_name_prefix="segment") as pool:
+                for future in [pool.submit(run_segment, segment, fd) for segment in pending]:
+                    future.result()
+            os.fsync(fd)
+        except RangeNotHonored:
+            os.close(fd)
+            fd = None
+            for path in (part_path, meta_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            self.count(bytes=progress["bytes"])
+            return self.download(url, local_path, headers, on_chunk)
+        finally:
+            if fd is not None:
+                os.close(fd)
+        os.replace(part_path, local_path)
+        os.remove(meta_path)
+        self.count(downloaded=1, bytes=progress["bytes"])
+        return {"bytes": progress["bytes"], "etag": etag, "last_modified": last_modified}
+
+    def sync(self, url, local_path, state, headers=None, on_chunk=None, expected_size=None,
+             segments=1, min_segment_size=SEGMENT_MIN_SIZE):
+        """
+        Downloads `url` to `local_path` only if the local copy is out of date.
+
+        A file is skipped without any request when `expected_size` (e.g. the
+        size from a directory listing) matches the local file. Otherwise, if
+        `state` has a record for `url` matching the local file, the request
+        carries If-None-Match / If-Modified-Since and a 304 skips it. New
+        downloads are recorded in `state`.
+
+        Parameters:
+        - url: The URL to download.
+        - local_path: Destination file path.
+        - state: A sync_state.SyncState.
+        - headers: Extra request headers (optional).
+        - on_chunk: Progress callback, see `download`.
+        - expected_size: Size the file is known to have (optional).
+        - segments, min_segment_size: Use `download_segmented` when
+          segments > 1.
+
+        Returns:
+        True when the file was transferred, False when it was skipped.
+        """
+        local_size = os.path.getsize(local_path) if os.path.exists(local_path) else None
+        if local_size is not None and local_size == expected_size:
+            if state.get(url) is None:
+                state.record(url, local_path)
+            self.count(skipped=1)
+            return False
+
+        record = state.get(url)
+        conditional = {}
+        if record and local_size == record.get("size") and not os.path.exists(local_path + ".part"):
+            if record.get("etag"):
+                conditional["If-None-Match"] = record["etag"]
+            if record.get("last_modified"):
+                conditional["If-Modified-Since"] = record["last_modified"]
+
+        if segments > 1:
+            if conditional:
+                with self.host_slot(url), get_metrics().request(url) as request:
+                    head = self.session(url).head(url, headers={**(headers or {}), **conditional},
+                                                  allow_redirects=True, timeout=TIMEOUT)
+                    request["status"] = head.status_code
+                if head.status_code == 304:
+                    self.count(skipped=1)
+                    return False
+            result = self.download_segmented(url, local_path, segments, min_segment_size, headers, on_chunk)
+        else:
+            result = self.download(url, local_path, {**(headers or {}), **conditional}, on_chunk)
+        if result is None:
+            self.count(skipped=1)
+            return False
+        state.record(url, local_path, result["etag"], result["last_modified"])
+        return True
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Submits an arbitrary job to the engine's pool and returns its Future.
+
+        Jobs must not block waiting on other jobs of the same engine.
+        """
+        return self._executor.submit(fn, *args, **kwargs)
+
+    def submit_download(self, url, local_path, headers=None):
+        """
+        Submits `download(url, local_path, headers)` and returns its Future.
+        """
+        return self.submit(self.download, url, local_path, headers)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+
+
+def wait_all(futures):
+    """
+    Waits for every future and returns (results, errors).
+
+    `futures` maps each Future to a label (e.g. its URL); `errors` is a list
+    of (label, exception) for the jobs that raised.
+    """
+    results = []
+    errors = []
+    for future in as_completed(futures):
+        try:
+            results.append(future.result())
+        except Exception as e:
+            errors.append((futures[future], e))
+    return results, errors
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_engine():
+    """
+    Returns the process-wide shared DownloadEngine, creating it on first use.
+    """
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = DownloadEngine()
+        return _engine
@@ -1,49 +1,77 @@
 import requests
 import os
-import urllib.parse
-import base64
+import posixpath
+
+from blob_store import OBJECTS_DIR, BlobStore, fetch_blob
+from download_engine import get_engine, wait_all
+from github_api import list_tree
+from metrics import get_metrics
+from sync_state import SYNC_STATE_FILE, SyncState
+
 token = os.environ.get('GITHUB_TOKEN')
 def download_directory(owner, repo, path, local_dir, token=None):
     """
     递归下载GitHub仓库中的目录
+
+    用 Git Trees API 一次请求列出整棵目录树，文件下载提交给共享下载引擎并发执行。
+    同步状态保存在 local_dir/.sync_state.json；文件内容按 git blob SHA 存入
+    local_dir/.objects，内容相同的文件只下载一次，其余位置用硬链接生成
+    列目录与下载分别计入运行指标的 listing / download 阶段，结束时输出（见 metrics）
     """
-    # 构造API请求URL
-    url = f"https://api.github.com/repos/{owner}/{repo}/contents/{urllib.parse.quote(path)}"
-    headers = {}
-    if token:
-        headers['Authorization'] = f'token {token}'
-    response = requests.get(url, headers=headers)
-    if response.status_code == 200:
-        contents = response.json()
-        if not os.path.exists(local_dir):
-            os.makedirs(local_dir)
-        for item in contents:
-            item_path = item['path']
-            item_type = item['type']
-            item_name = item['name']
-            if item_type == 'dir':
-                # 递归下载子目录
-                download_directory(owner, repo, item_path, os.path.join(local_dir, item_name), token)
-            elif item_type == 'file':
-                # 下载文件
-                download_file(item['download_url'], os.path.join(local_dir, item_name), token)
-    else:
-        print(f"无法访问 {url}, 状态码: {response.status_code}")
+    engine = get_engine()
+    metrics = get_metrics()
+    try:
+        with metrics.stage("listing"):
+            files = list_tree(owner, repo, path, token=token)
+    except requests.RequestException as e:
+        if e.response is not None:
+            print(f"无法访问 {e.response.url}, 状态码: {e.response.status_code}")
+        else:
+            print(f"无法列出目录 {path}: {e}")
+        return
+    state = SyncState(os.path.join(local_dir, SYNC_STATE_FILE))
+    store = BlobStore(os.path.join(local_dir, OBJECTS_DIR))
+    futures = {}
+    for item in files:
+        relative_path = posixpath.relpath(item['path'], path) if path else item['path']
+        future = engine.submit(
+            metrics.timed, "download", download_file, item['download_url'],
+            os.path.join(local_dir, *relative_path.split('/')), token, item['size'], state, item['sha'], store
+        )
+        futures[future] = item['download_url']
+    _, errors = wait_all(futures)
+    for url, e in errors:
+        print(f"无法下载文件 {url}: {e}")
+    state.save()
+    print(engine.summary())
+    metrics.report()
 
-def download_file(url, local_path, token=None):
+def download_file(url, local_path, token=None, size=None, state=None, sha=None, store=None):
     """
     下载单个文件
+
+    传入 state（SyncState）时做增量同步：本地大小与 size 一致或服务器返回 304 则跳过；
+    同时传入 sha 与 store（BlobStore）时，对象库中已有该 SHA 则直接硬链接，不再下载
     """
     headers = {}
     if token:
         headers['Authorization'] = f'token {token}'
-    response = requests.get(url, headers=headers)
-    if response.status_code == 200:
-        with open(local_path, 'wb') as f:
-            f.write(response.content)
-        print(f"已下载文件: {local_path}")
-    else:
-        print(f"无法下载文件 {url}, 状态码: {response.status_code}")
+    engine = get_engine()
+    try:
+        if store is not None and sha is not None:
+            if not fetch_blob(store, url, local_path, sha, headers, state):
+                print(f"文件未变化或已在对象库中，跳过: {local_path}")
+                return
+        elif state is not None:
+            if not engine.sync(url, local_path, state, headers=headers, expected_size=size):
+                print(f"文件未变化，跳过: {local_path}")
+                return
+        else:
+            engine.download(url, local_path, headers=headers)
+    except requests.HTTPError as e:
+        print(f"无法下载文件 {url}, 状态码: {e.response.status_code}")
+        return
+    print(f"已下载文件: {local_path}")
 
 if __name__ == "__main__":
     owner = "ruiduobao"
@@ -51,4 +79,4 @@ if __name__ == "__main__":
     path = "CTAmap(2013年-2023年)行政区划矢量"
     local_dir = "CTAmap(2013年-2023年)行政区划矢量"
     token = os.environ.get('GITHUB_TOKEN')  # 如果需要，可以在此处填写您的GitHub个人访问令牌
-    download_directory(owner, repo, path, local_dir, token)
\ No newline at end of file
+    download_directory(owner, repo, path, local_dir, token)
@@ -1,75 +1,108 @@
 import requests
-from bs4 import BeautifulSoup
 import os
-import sys
+import posixpath
 
-def download_file(url, local_filename):
+from download_engine import SEGMENT_MIN_SIZE, get_engine, wait_all
+from geofabrik_index import INDEX_CACHE_FILE, INDEX_MAX_AGE, IndexCache, load_index, select_files, split_page_url
+from metrics import Progress, get_metrics
+from sync_state import SYNC_STATE_FILE, SyncState
+
+def download_file(url, local_filename, show_progress=True, segments=1, min_segment_size=SEGMENT_MIN_SIZE,
+                  state=None):
     """
     下载文件并显示下载进度
-    """
-    with requests.get(url, stream=True) as r:
-        r.raise_for_status()
-        total_length = r.headers.get('content-length')
 
-        with open(local_filename, 'wb') as f:
-            if total_length is None:
-                f.write(r.content)
-            else:
-                dl = 0
-                total_length = int(total_length)
-                for chunk in r.iter_content(chunk_size=8192):
-                    if chunk:
-                        f.write(chunk)
-                        dl += len(chunk)
-                        done = int(50 * dl / total_length)
-                        sys.stdout.write(f"\r[{('=' * done):50s}] {dl/total_length:.2%}")
-                        sys.stdout.flush()
-    print(f"\n已下载文件：{local_filename}")
+    数据先写入 local_filename.part，完成后原子重命名；
+    传输中断或进程崩溃后再次运行会用 Range 请求从断点续传。
+    segments > 1 时按字节范围分段并发下载（服务器不支持 Range 时退回单流）。
+    传入 state（SyncState）时发送条件请求，服务器返回 304 则跳过未变化的文件。
+    进度按 PROGRESS_INTERVAL 限频输出，而不是每个数据块都重绘（见 metrics.Progress）。
+    """
+    engine = get_engine()
+    progress = Progress(os.path.basename(local_filename)) if show_progress else None
+    on_chunk = progress.update if show_progress else None
+    if state is not None:
+        if not engine.sync(url, local_filename, state, on_chunk=on_chunk,
+                           segments=segments, min_segment_size=min_segment_size):
+            print(f"文件未变化，跳过：{local_filename}")
+            return
+    elif segments > 1:
+        engine.download_segmented(url, local_filename, segments, min_segment_size, on_chunk=on_chunk)
+    else:
+        engine.download(url, local_filename, on_chunk=on_chunk)
+    if show_progress:
+        progress.finish()
+    print(f"已下载文件：{local_filename}")
 
-def scrape_and_download(base_url, download_dir, file_types=None):
+def scrape_and_download(base_url, download_dir, file_types=None, segments=1, min_segment_size=SEGMENT_MIN_SIZE,
+                        regions=None, max_age=INDEX_MAX_AGE, use_json_index=True):
     """
     爬取下载链接并下载文件
-    """
-    response = requests.get(base_url)
-    if response.status_code != 200:
-        print(f"无法访问 {base_url}, 状态码: {response.status_code}")
-        return
 
-    soup = BeautifulSoup(response.content, 'lxml')
+    从 base_url（任意 Geofabrik 区域页面，如 asia.html、asia/china.html）解析其下的整棵区域树：
+    站点提供 index-v1-nogeom.json 时一次请求得到全部区域，否则并发逐层抓取子区域页面
+    （只解析 <a> 标签）。解析出的 区域 -> 文件 URL 索引缓存在 download_dir/.geofabrik_index.json，
+    max_age 秒内再次运行不发送任何索引请求（见 geofabrik_index）。
 
-    # 创建下载目录
-    if not os.path.exists(download_dir):
-        os.makedirs(download_dir)
-    
-    # 查找所有包含下载链接的 <a> 标签
-    download_links = []
-    for td in soup.find_all('td', class_='subregion'):
-        # for ah in td.find_all('a'):
-        link = td.find('a')
-        print(f"下载链接:{link}")
-        if link and 'href' in link.attrs:
-            href = link['href']
-            if href.endswith(tuple(file_types)):
-                full_url = requests.compat.urljoin(base_url, href)
-                download_links.append((full_url, href))    
+    regions: 区域通配符列表，匹配区域路径（如 "asia/china/*"）或最后一级名称（如 "guang*"）；
+    默认下载 base_url 的直接子区域（没有子区域时下载该区域本身）。
+    file_types: 文件后缀列表，如 ['.osm.pbf']；默认下载所有文件。
+    文件按区域层级保存在 download_dir 下，如 china.html 的 anhui-latest.osm.pbf、guangdong/xxx-latest.osm.pbf。
+    segments / min_segment_size: 单个大文件的分段数与每段最小字节数，
+    小于 2 * min_segment_size 的文件仍用单流下载。
+    同步状态保存在 download_dir/.sync_state.json，再次运行只下载有变化的文件。
+    索引的获取与解析、文件下载分别计入运行指标的 listing / download 阶段，结束时输出。
+    """
+    engine = get_engine()
+    metrics = get_metrics()
+    cache = IndexCache(os.path.join(download_dir, INDEX_CACHE_FILE), max_age)
+    try:
+        index = load_index(base_url, cache, use_json_index)
+    except requests.HTTPError as e:
+        print(f"无法访问 {base_url}, 状态码: {e.response.status_code}")
+        return
+    download_links = select_files(index, base_url, regions, file_types)
 
     # 如果未找到任何下载链接
     if not download_links:
         print("未找到任何下载链接。")
         return
+    print(f"共 {len(index)} 个区域，选中 {len(download_links)} 个文件")
+
+    # 创建下载目录
+    if not os.path.exists(download_dir):
+        os.makedirs(download_dir)
 
-    # 下载所有链接的文件
-    for full_url, href in download_links:
-        filename = os.path.basename(href)
-        local_path = os.path.join(download_dir, filename)
-        print(f"正在下载 {filename} ...")
-        download_file(full_url, local_path)
+    # 将所有链接提交给共享下载引擎并发下载；多个文件同时下载时不绘制进度条
+    show_progress = len(download_links) == 1
+    state = SyncState(os.path.join(download_dir, SYNC_STATE_FILE))
+    site_url, start = split_page_url(base_url)
+    futures = {}
+    for region_path, full_url in download_links:
+        relative_path = full_url[len(site_url) + 1:]
+        if start and relative_path.startswith(start + "/"):
+            # 子区域文件按层级保存，起始区域自身的文件直接放在 download_dir 下
+            relative_path = relative_path[len(start) + 1:]
+        else:
+            relative_path = posixpath.basename(relative_path)
+        local_path = os.path.join(download_dir, *relative_path.split("/"))
+        print(f"正在下载 {relative_path} ...")
+        future = engine.submit(metrics.timed, "download", download_file, full_url, local_path, show_progress,
+                               segments, min_segment_size, state)
+        futures[future] = full_url
+    _, errors = wait_all(futures)
+    for full_url, e in errors:
+        print(f"下载失败 {full_url}: {e}")
+    state.save()
 
     print("所有文件已下载完成。")
+    print(engine.summary())
+    metrics.report()
 
 if __name__ == "__main__":
     base_url = "https://download.geofabrik.de/asia/china.html"
     download_dir = "geofabrik_china_osm_data"
     # 指定要下载的文件类型
     file_types = ['.osm.pbf', '.shp.zip', '.osm.bz2']
-    scrape_and_download(base_url, download_dir, file_types)
\ No newline at end of file
+    # 大文件按 4 段并发下载；下载所有省级区域，可用 regions 按通配符筛选，如 ["guang*", "beijing"]
+    scrape_and_download(base_url, download_dir, file_types, segments=4)
@@ -0,0 +1,334 @@
+import fnmatch
+import json
+import os
+import posixpath
+import re
+import threading
+import time
+import urllib.parse
+from concurrent.futures import FIRST_COMPLETED, wait
+
+import requests
+from bs4 import BeautifulSoup, SoupStrainer
+
+from download_engine import get_engine
+from metrics import get_metrics
+
+# Geofabrik 的机器可读索引（不含边界几何），相对站点根目录
+INDEX_JSON = "index-v1-nogeom.json"
+# 区域索引缓存文件名，保存在下载目录下
+INDEX_CACHE_FILE = ".geofabrik_index.json"
+# 缓存的区域索引有效期（秒）；Geofabrik 每天更新一次
+INDEX_MAX_AGE = 24 * 3600
+
+# <区域路径>-latest<后缀>，如 asia/china/anhui-latest.osm.pbf、asia/china-latest-free.shp.zip
+_LATEST_FILE_RE = re.compile(r"^(?P<path>[^?#]+?)-latest(?P<suffix>(?:-[a-z]+)?(?:\.[a-z0-9]+)+)$")
+# 只解析 <a href> 标签，页面其余部分不建树
+_LINKS = SoupStrainer("a", href=True)
+
+
+def split_page_url(page_url):
+    """
+    Splits a Geofabrik page URL into the site root and the region path,
+    e.g. "https://download.geofabrik.de/asia/china.html" into
+    ("https://download.geofabrik.de", "asia/china"). The region path of the
+    top page (index.html or "/") is "".
+    """
+    parts = urllib.parse.urlsplit(page_url)
+    site_url = f"{parts.scheme}://{parts.netloc}"
+    path = parts.path.strip("/")
+    if path.endswith(".html"):
+        path = path[:-len(".html")]
+    if posixpath.basename(path) == "index":
+        path = posixpath.dirname(path)
+    return site_url, path
+
+
+def _page_url(site_url, path):
+    return f"{site_url}/{path}.html" if path else f"{site_url}/index.html"
+
+
+def _region(name, parent):
+    return {"name": name, "parent": parent, "files": {}}
+
+
+def parse_page(site_url, path, content):
+    """
+    Extracts the sub-region pages and extract files linked from one page.
+
+    Only the <a href> elements are parsed (SoupStrainer). A link counts as
+    a sub-region when it points to a page one level below `path`; a file
+    counts when it is a "<region>-latest<suffix>" file of `path` itself or
+    of one of its sub-regions, so navigation links are ignored.
+
+    Parameters:
+    - site_url: The site root, see `split_page_url`.
+    - path: Region path of the page.
+    - content: The page's HTML.
+
+    Returns:
+    A (children, files) tuple: region path -> name for the sub-region
+    pages, and region path -> {suffix: url} for the files.
+    """
+    page_url = _page_url(site_url, path)
+    soup = BeautifulSoup(content, "lxml", parse_only=_LINKS)
+    children = {}
+    files = {}
+    for link in soup.find_all("a"):
+        url = urllib.parse.urljoin(page_url, link["href"]).split("#")[0]
+        if not url.startswith(site_url + "/"):
+            continue
+        relative = url[len(site_url) + 1:]
+        match = _LATEST_FILE_RE.match(relative)
+        if match:
+            region_path = match["path"]
+            if region_path == path or posixpath.dirname(region_path) == path:
+                files.setdefault(region_path, {})[match["suffix"]] = url
+        elif relative.endswith(".html"):
+            region_path = relative[:-len(".html")]
+            if (posixpath.dirname(region_path) == path and region_path != path
+                    and posixpath.basename(region_path) != "index"):
+                children.setdefault(region_path, link.get_text(strip=True) or posixpath.basename(region_path))
+    return children, files
+
+
+def _fetch_page(site_url, path):
+    response = get_engine().get(_page_url(site_url, path))
+    response.raise_for_status()
+    return parse_page(site_url, path, response.content)
+
+
+def crawl_pages(page_url, recursive=True):
+    """
+    Walks the region hierarchy of the Geofabrik site from `page_url`.
+
+    Pages are fetched through the shared download engine; all sub-region
+    pages discovered on a page are fetched concurrently (bounded by the
+    engine's per-host limit), so each level of the tree costs about one
+    round trip.
+
+    Parameters:
+    - page_url: Start page, e.g. ".../asia.html" or ".../asia/china.html".
+    - recursive: Descend into the sub-region pages; otherwise only the
+      start page is read.
+
+    Returns:
+    A (regions, complete) tuple: region path -> {"name", "parent" (path of
+    the parent region, None for the start page), "files" ({suffix: url})},
+    and whether every page could be read. Raises requests.HTTPError if the
+    start page cannot be read.
+    """
+    site_url, start = split_page_url(page_url)
+    engine = get_engine()
+    metrics = get_metrics()
+    regions = {start: _region(posixpath.basename(start), None)}
+    tasks = {engine.submit(metrics.timed, "listing", _fetch_page, site_url, start): start}
+    complete = True
+    while tasks:
+        done, _ = wait(tasks, return_when=FIRST_COMPLETED)
+        for future in done:
+            path = tasks.pop(future)
+            try:
+                children, files = future.result()
+            except requests.RequestException as e:
+                if path == start:
+                    raise
+                print(f"无法读取区域页面 {_page_url(site_url, path)}: {e}")
+                complete = False
+                continue
+            metrics.count("geofabrik_pages")
+            for child, name in children.items():
+                if child not in regions:
+                    regions[child] = _region(name, path)
+                    if recursive:
+                        tasks[engine.submit(metrics.timed, "listing", _fetch_page, site_url, child)] = child
+            for region_path, region_files in files.items():
+                if region_path not in regions:
+                    # 只有下载链接、没有单独页面的子区域
+                    regions[region_path] = _region(posixpath.basename(region_path), path)
+                regions[region_path]["files"].update(region_files)
+    return regions, complete
+
+
+def load_json_index(page_url):
+    """
+    Reads the region hierarchy below `page_url` from the site's
+    machine-readable index (INDEX_JSON), in one request.
+
+    Returns:
+    The regions in the format of `crawl_pages`, or None when the site has
+    no such index or it does not contain the start region.
+    """
+    site_url, start = split_page_url(page_url)
+    with get_metrics().stage("listing"):
+        try:
+            response = get_engine().get(f"{site_url}/{INDEX_JSON}")
+        except requests.RequestException as e:
+            print(f"无法读取 {INDEX_JSON}: {e}，改为逐页抓取")
+            return None
+        if response.status_code != 200:
+            return None
+        try:
+            features = response.json()["features"]
+        except (ValueError, KeyError):
+            return None
+
+    paths = {}
+    entries = []
+    for feature in features:
+        properties = feature.get("properties", {})
+        files = {}
+        for url in properties.get("urls", {}).values():
+            if not isinstance(url, str) or not url.startswith(site_url + "/"):
+                continue
+            match = _LATEST_FILE_RE.match(url[len(site_url) + 1:])
+            if match:
+                files[match["suffix"]] = url
+                paths[properties["id"]] = match["path"]
+        entries.append((properties, files))
+
+    regions = {"": _region("", None)} if not start else {}
+    for properties, files in entries:
+        path = paths.get(properties["id"])
+        if path is None or (start and path != start and not path.startswith(start + "/")):
+            continue
+        # parent 没有下载文件时无法得到其路径，按 URL 的目录层级推断；顶层区域挂在站点根 "" 下
+        parent = None if path == start else paths.get(properties.get("parent"), posixpath.dirname(path))
+        regions[path] = {"name": properties.get("name", posixpath.basename(path)), "parent": parent,
+                         "files": files}
+    if start and start not in regions:
+        if not regions:
+            return None
+        # 起始区域本身没有文件，但索引中有它的子区域
+        regions[start] = _region(posixpath.basename(start), None)
+    return regions
+
+
+class IndexCache:
+    """
+    On-disk cache of resolved region indexes, keyed by start page URL.
+
+    The cache is a JSON file, written atomically; entries older than
+    `max_age` seconds are ignored.
+
+    Parameters:
+    - path: Location of the JSON cache file.
+    - max_age: Lifetime of an entry in seconds.
+    """
+
+    def __init__(self, path, max_age=INDEX_MAX_AGE):
+        self.path = path
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                self._entries = json.load(f)
+        except (OSError, ValueError):
+            self._entries = {}
+
+    def get(self, key):
+        """
+        Returns the cached regions for `key`, or None if missing or expired.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None or time.time() - entry["fetched"] > self.max_age:
+            return None
+        return entry["regions"]
+
+    def put(self, key, regions, source):
+        """
+        Stores `regions` for `key` and writes the cache to disk.
+        """
+        with self._lock:
+            self._entries[key] = {"fetched": time.time(), "source": source, "regions": regions}
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self._entries, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+
+
+def load_index(page_url, cache=None, use_json_index=True, recursive=True):
+    """
+    Returns the region -> file URL index below `page_url`.
+
+    A fresh entry in `cache` is returned without any request. Otherwise the
+    site's INDEX_JSON is used when available (one request for the whole
+    site) and the pages are crawled (see `crawl_pages`) when it is not. A
+    complete result is stored in `cache`.
+
+    Parameters:
+    - page_url: Start page, e.g. ".../asia/china.html".
+    - cache: An IndexCache (optional).
+    - use_json_index: Try INDEX_JSON before crawling pages.
+    - recursive: Include the whole hierarchy below the start page; otherwise
+      only the start region and its direct sub-regions.
+
+    Returns:
+    The regions in the format of `crawl_pages`.
+    """
+    key = f"{page_url}#{'recursive' if recursive else 'children'}"
+    if cache is not None:
+        regions = cache.get(key)
+        if regions is not None:
+            get_metrics().count("geofabrik_index_cache_hits")
+            return regions
+    regions = load_json_index(page_url) if use_json_index else None
+    source, complete = INDEX_JSON, True
+    if regions is not None and not recursive:
+        _, start = split_page_url(page_url)
+        regions = {path: region for path, region in regions.items()
+                   if path == start or region["parent"] == start}
+    if regions is None:
+        regions, complete = crawl_pages(page_url, recursive)
+        source = "pages"
+    if cache is not None and complete:
+        cache.put(key, regions, source)
+    return regions
+
+
+def match_regions(regions, patterns):
+    """
+    Returns the paths of the regions matching any of the glob `patterns`.
+
+    A pattern is matched against the region path (e.g. "asia/china/*") and
+    against its last component (e.g. "guang*").
+    """
+    return sorted(
+        path for path in regions
+        if any(fnmatch.fnmatchcase(path, pattern) or fnmatch.fnmatchcase(posixpath.basename(path), pattern)
+               for pattern in patterns)
+    )
+
+
+def select_files(regions, page_url, patterns=None, file_types=None):
+    """
+    Selects the files to download from an index.
+
+    Parameters:
+    - regions: An index from `load_index`.
+    - page_url: The start page the index was loaded from.
+    - patterns: Region globs, see `match_regions`; by default the direct
+      sub-regions of the start page (or the start region itself when it
+      has none).
+    - file_types: File suffixes such as ".osm.pbf"; all files by default.
+
+    Returns:
+    A list of (region path, url) tuples sorted by region.
+    """
+    _, start = split_page_url(page_url)
+    if patterns:
+        selected = match_regions(regions, patterns)
+    else:
+        selected = sorted(path for path, region in regions.items() if region["parent"] == start and path != start)
+        if not selected and start in regions:
+            selected = [start]
+    files = []
+    for path in selected:
+        for suffix, url in sorted(regions[path]["files"].items()):
+            if not file_types or suffix.endswith(tuple(file_types)):
+                files.append((path, url))
+    return files
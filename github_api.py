@@ -0,0 +1,332 @@
+import os
+import posixpath
+import threading
+import time
+import urllib.parse
+
+from download_engine import RETRIES, get_engine
+from metrics import get_metrics
+
+GITHUB_API_URL = os.environ.get("GITHUB_API_URL", "https://api.github.com")
+GITHUB_RAW_URL = os.environ.get("GITHUB_RAW_URL", "https://raw.githubusercontent.com")
+
+# 剩余配额低于该值时视为预算紧张：开始限速，列目录改用最少请求的方式
+LOW_BUDGET = 50
+# 令牌桶容量：开始限速后允许的突发请求数
+BURST = 10
+# 由调度器重试的 5xx 状态码；502/503/504 已由下载引擎的连接池重试（见 download_engine.RETRY_STATUSES）
+RETRY_STATUSES = (500,)
+
+# 分支 -> 树 SHA 的解析结果缓存时间（秒），并发列多个目录时只解析一次
+REF_CACHE_SECONDS = 60
+
+# (owner, repo, tree_sha[, path]) -> 文件条目；同一次运行中多次列目录只请求一次
+_tree_cache = {}
+_tree_cache_lock = threading.Lock()
+# (owner, repo, ref) -> (解析时间, ref, tree_sha)
+_ref_cache = {}
+# 每个缓存键一把锁：并发请求同一棵树时只有一个线程真正发请求
+_key_locks = {}
+
+
+def _lock_for(key):
+    with _tree_cache_lock:
+        return _key_locks.setdefault(key, threading.Lock())
+
+
+class RateLimitScheduler:
+    """
+    Central scheduler for GitHub API calls.
+
+    Tracks the request budget from the X-RateLimit-Limit / -Remaining /
+    -Reset headers of every response. While at least LOW_BUDGET calls are
+    left, calls are not paced and only the download engine's concurrency
+    limits apply; below that, a token bucket spreads the remaining budget
+    over the time left until the reset. When the budget is exhausted (or
+    GitHub answers 403/429 with Retry-After or a zero remaining count)
+    callers sleep until the reset and the request is retried instead of
+    failing; 500 answers are retried with exponential backoff (the engine
+    retries 502/503/504 itself). Time spent pacing and waiting is counted
+    in the process-wide metrics.
+
+    Parameters:
+    - burst: Token bucket capacity.
+    """
+
+    def __init__(self, burst=BURST):
+        self.burst = burst
+        self.limit = None
+        self.remaining = None
+        self.reset = None
+        self._tokens = float(burst)
+        self._rate = None
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    @property
+    def budget_low(self):
+        """
+        True when fewer than LOW_BUDGET calls are left in the current window.
+        """
+        return self.remaining is not None and self.remaining < LOW_BUDGET
+
+    def acquire(self):
+        """
+        Blocks until one API call may be issued.
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if self.remaining == 0 and self.reset is not None:
+                    wait = self.reset - time.time() + 1
+                    if wait <= 0:
+                        # 重置时间已过，下一次响应会带来新的配额
+                        self.remaining = None
+                        self._rate = None
+                        continue
+                elif self._rate is None:
+                    return
+                else:
+                    self._tokens = min(self.burst, self._tokens + (now - self._last) * self._rate)
+                    self._last = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    wait = (1 - self._tokens) / self._rate
+            if wait > 5:
+                print(f"GitHub API 配额已用尽，等待 {wait:.0f} 秒直到配额重置")
+            get_metrics().count("github_pacing_wait_seconds", wait)
+            time.sleep(wait)
+
+    def update(self, response):
+        """
+        Updates the budget from `response`'s headers.
+
+        Returns:
+        The number of seconds to wait before retrying if the response was
+        rate limited, otherwise None.
+        """
+        headers = response.headers
+        with self._lock:
+            if "X-RateLimit-Remaining" in headers:
+                self.limit = int(headers.get("X-RateLimit-Limit", 0)) or self.limit
+                self.remaining = int(headers["X-RateLimit-Remaining"])
+                self.reset = int(headers.get("X-RateLimit-Reset", 0)) or self.reset
+                if self.reset is not None and 0 < self.remaining < LOW_BUDGET:
+                    window = max(self.reset - time.time(), 1)
+                    self._rate = self.remaining / window
+                else:
+                    # 配额充足（或已用尽，由 acquire 等待重置）时不按速率限速
+                    self._rate = None
+            if response.status_code not in (403, 429):
+                return None
+            retry_after = headers.get("Retry-After")
+            if retry_after is not None:
+                return max(float(retry_after), 1)
+            if self.remaining == 0 and self.reset is not None:
+                return max(self.reset - time.time(), 0) + 1
+        return None
+
+    def request(self, url, **kwargs):
+        """
+        GETs `url` through the shared engine under the scheduler's pacing,
+        sleeping through rate limits until the call succeeds or fails for
+        another reason. A 500 answer is retried up to RETRIES times, after
+        its Retry-After or 1, 2, 4, ... seconds, and the last answer is
+        returned; 502/503/504 are already retried by the engine.
+        """
+        server_errors = 0
+        while True:
+            self.acquire()
+            response = get_engine().get(url, **kwargs)
+            wait = self.update(response)
+            if wait is not None:
+                print(f"GitHub API 限流，{wait:.0f} 秒后重试 {url}")
+                get_metrics().count("github_rate_limit_wait_seconds", wait)
+            elif response.status_code in RETRY_STATUSES and server_errors < RETRIES:
+                wait = float(response.headers.get("Retry-After", 2 ** server_errors))
+                server_errors += 1
+                print(f"GitHub API 返回 {response.status_code}，{wait:.0f} 秒后重试 {url}")
+            else:
+                return response
+            get_metrics().retry(url)
+            time.sleep(wait)
+
+
+scheduler = RateLimitScheduler()
+
+
+def auth_headers(token=None):
+    """
+    Returns the Authorization header for `token`, if any.
+    """
+    headers = {}
+    if token:
+        headers["Authorization"] = f"token {token}"
+    return headers
+
+
+def api_get(path, token=None, params=None):
+    """
+    GETs `GITHUB_API_URL + path` and returns the decoded JSON body.
+
+    Raises requests.HTTPError on a non-2xx response.
+    """
+    with get_metrics().stage("github_api"):
+        response = scheduler.request(f"{GITHUB_API_URL}{path}", headers=auth_headers(token), params=params)
+        response.raise_for_status()
+        return response.json()
+
+
+def resolve_tree_sha(owner, repo, ref=None, token=None):
+    """
+    Resolves a branch to its root tree SHA.
+
+    Parameters:
+    - owner: The owner of the repository.
+    - repo: The name of the repository.
+    - ref: Branch name; the repository's default branch when None.
+    - token: Personal access token for GitHub API (optional).
+
+    Returns:
+    A (ref, tree_sha) tuple.
+    """
+    if ref is None:
+        ref = api_get(f"/repos/{owner}/{repo}", token)["default_branch"]
+    branch = api_get(f"/repos/{owner}/{repo}/branches/{urllib.parse.quote(ref, safe='')}", token)
+    return ref, branch["commit"]["commit"]["tree"]["sha"]
+
+
+def _file_entry(owner, repo, ref, path, item):
+    return {
+        "type": "file",
+        "path": path,
+        "name": posixpath.basename(path),
+        "sha": item["sha"],
+        "size": item.get("size"),
+        "download_url": f"{GITHUB_RAW_URL}/{owner}/{repo}/{urllib.parse.quote(ref)}/{urllib.parse.quote(path)}",
+    }
+
+
+def _blob_entries(owner, repo, ref, tree, base_path):
+    entries = []
+    for item in tree["tree"]:
+        if item["type"] == "blob":
+            path = posixpath.join(base_path, item["path"]) if base_path else item["path"]
+            entries.append(_file_entry(owner, repo, ref, path, item))
+    return entries
+
+
+def _walk_tree(owner, repo, ref, tree_sha, base_path, token, entries, try_recursive=True):
+    """
+    Lists the tree `tree_sha` (located at `base_path`) into `entries`.
+
+    Tries one recursive call first; if GitHub truncates it, lists this level
+    only and repeats for every subtree, so the number of calls stays close to
+    the number of subtrees too large for one response.
+    """
+    if try_recursive:
+        tree = api_get(f"/repos/{owner}/{repo}/git/trees/{tree_sha}", token, params={"recursive": "1"})
+        if not tree.get("truncated"):
+            entries.extend(_blob_entries(owner, repo, ref, tree, base_path))
+            return
+    tree = api_get(f"/repos/{owner}/{repo}/git/trees/{tree_sha}", token)
+    entries.extend(_blob_entries(owner, repo, ref, tree, base_path))
+    for item in tree["tree"]:
+        if item["type"] == "tree":
+            path = posixpath.join(base_path, item["path"]) if base_path else item["path"]
+            _walk_tree(owner, repo, ref, item["sha"], path, token, entries)
+
+
+def _find_subtree(owner, repo, tree_sha, path, token):
+    """
+    Returns the SHA of the subtree at `path`, one level per call, or None.
+    """
+    for part in path.split("/"):
+        tree = api_get(f"/repos/{owner}/{repo}/git/trees/{tree_sha}", token)
+        for item in tree["tree"]:
+            if item["type"] == "tree" and item["path"] == part:
+                tree_sha = item["sha"]
+                break
+        else:
+            return None
+    return tree_sha
+
+
+def list_tree(owner, repo, path="", ref=None, token=None):
+    """
+    Lists every file below `path` using the Git Trees API.
+
+    The branch is resolved to a tree SHA once and the whole tree is fetched
+    with a single `git/trees/{sha}?recursive=1` call, then filtered to `path`
+    in memory. When GitHub reports `truncated: true`, the subtree at `path` is
+    located and walked level by level instead (see `_walk_tree`). Listings
+    are cached per tree SHA for the lifetime of the process. When the API
+    budget is low the branch resolution is skipped and the tree is requested
+    by name, so a listing costs a single call.
+
+    Parameters:
+    - owner: The owner of the repository.
+    - repo: The name of the repository.
+    - path: Directory inside the repository; "" for the whole repository.
+    - ref: Branch name; the repository's default branch when None.
+    - token: Personal access token for GitHub API (optional).
+
+    Returns:
+    A list of file entries shaped like Contents API items (`type`, `path`,
+    `name`, `sha`, `size`, `download_url`), sorted by path. Raises
+    requests.HTTPError if GitHub refuses a request.
+    """
+    prefix = path.strip("/")
+    if scheduler.budget_low:
+        # 配额紧张：跳过分支解析，直接按分支名（或 HEAD）请求整棵树
+        ref = ref or "HEAD"
+        tree = api_get(f"/repos/{owner}/{repo}/git/trees/{urllib.parse.quote(ref, safe='')}", token,
+                       params={"recursive": "1"})
+        if not tree.get("truncated"):
+            entries = sorted(_blob_entries(owner, repo, ref, tree, ""), key=lambda entry: entry["path"])
+            with _tree_cache_lock:
+                _tree_cache[(owner, repo, tree["sha"])] = entries
+            return [entry for entry in entries if not prefix or entry["path"].startswith(prefix + "/")]
+    with _lock_for((owner, repo, ref)):
+        cached = _ref_cache.get((owner, repo, ref))
+        if cached is not None and time.monotonic() - cached[0] < REF_CACHE_SECONDS:
+            _, resolved_ref, tree_sha = cached
+        else:
+            resolved_ref, tree_sha = resolve_tree_sha(owner, repo, ref, token)
+            _ref_cache[(owner, repo, ref)] = (time.monotonic(), resolved_ref, tree_sha)
+    with _lock_for((owner, repo, tree_sha)):
+        entries = _load_tree(owner, repo, resolved_ref, tree_sha, prefix, token)
+    if not prefix:
+        return list(entries)
+    return [entry for entry in entries if entry["path"].startswith(prefix + "/")]
+
+
+def _load_tree(owner, repo, ref, tree_sha, prefix, token):
+    """
+    Returns the cached or freshly fetched entries of tree `tree_sha`: the
+    whole tree when it fits in one response, otherwise only `prefix`.
+    """
+    with _tree_cache_lock:
+        entries = _tree_cache.get((owner, repo, tree_sha))
+        if entries is None:
+            entries = _tree_cache.get((owner, repo, tree_sha, prefix))
+    if entries is None:
+        tree = api_get(f"/repos/{owner}/{repo}/git/trees/{tree_sha}", token, params={"recursive": "1"})
+        if tree.get("truncated"):
+            # 整棵树超出单次响应上限：定位到目标子树后逐层遍历
+            entries = []
+            if not prefix:
+                _walk_tree(owner, repo, ref, tree_sha, "", token, entries, try_recursive=False)
+            else:
+                subtree_sha = _find_subtree(owner, repo, tree_sha, prefix, token)
+                if subtree_sha is not None:
+                    _walk_tree(owner, repo, ref, subtree_sha, prefix, token, entries)
+            entries.sort(key=lambda entry: entry["path"])
+            with _tree_cache_lock:
+                _tree_cache[(owner, repo, tree_sha, prefix)] = entries
+            return entries
+        entries = sorted(_blob_entries(owner, repo, ref, tree, ""), key=lambda entry: entry["path"])
+        with _tree_cache_lock:
+            _tree_cache[(owner, repo, tree_sha)] = entries
+    return entries
@@ -2,37 +2,33 @@
 
 #sudo apt-get install swig
 #pip install rasterio s2geometry pygeos geopandas tqdm
+# open_buildings.py, region_boundaries.py, tile_catalog.py, metrics.py,
+# download_engine.py and sync_state.py from this repository must be
+# importable, e.g. uploaded next to this notebook.
 
 """
 This module imports various libraries and modules necessary for geospatial data processing and manipulation.
 """
 
-# Standard library imports
-import functools  # Higher-order functions and operations on callable objects
-import glob  # Unix style pathname pattern expansion
-import gzip  # Support for gzip files
-import json  # JSON encoder and decoder
-import multiprocessing  # Process-based parallelism
-from multiprocessing.pool import ThreadPool  # Thread-based parallelism
-import os  # Miscellaneous operating system interfaces
-import shutil  # High-level file operations
-import tempfile  # Generate temporary files and directories
-from typing import Optional, Tuple, Iterable, Callable, Any  # Type hinting
-
 # Third-party library imports
 import geopandas as gpd  # Geospatial data in Python
-from google.auth import credentials  # Google authentication
-from google.cloud import storage  # Google Cloud Storage client library
 from IPython import display  # IPython display utilities
-import pandas as pd  # Data manipulation and analysis
-import pyproj  # Python interface to PROJ (cartographic projections and transformations library)
-import rasterio  # Access to geospatial raster data
-from rasterio.transform import Affine  # Affine transformations
-import s2geometry as s2  # S2 Geometry Library
 import shapely  # Manipulation and analysis of geometric objects
-from shapely.geometry import Polygon, box  # Geometric objects
-import tqdm.notebook  # Progress bar for Jupyter notebooks
-from shapely.ops import transform  # Geometric transformations
+
+# Local library imports
+import metrics  # Per-stage run metrics
+import open_buildings  # Open Buildings temporal urls, clipping and mosaics
+from open_buildings import (
+    get_bounding_box_s2_covering_tokens,
+    get_region_s2_covering_tokens,
+    group_tiles_by_year,
+    multithreaded_clip_geotiffs,
+    multithreaded_get_matching_manifest_blobs,
+    multithreaded_mosaic_tiles,
+    read_from_file,
+    stream_geotiff_urls_to_file,
+)
+from region_boundaries import get_region_boundary  # Indexed country boundaries
 # @title Prepare urls of geotiffs of the given region
 
 # @markdown First, select a region from either the [Natural Earth low res](https://www.naturalearthdata.com/downloads/110m-cultural-vectors/110m-admin-0-countries/) (fastest), [Natural Earth high res](https://www.naturalearthdata.com/downloads/10m-cultural-vectors/10m-admin-0-countries/) or [World Bank high res](https://datacatalog.worldbank.org/dataset/world-bank-official-boundaries) shapefiles:
@@ -51,17 +47,40 @@ download_2021 = True  # @param { type: "boolean" }
 download_2022 = True  # @param { type: "boolean" }
 download_2023 = True  # @param { type: "boolean" }
 
-_GCS_BUCKET = "open-buildings-temporal-data"
+# @markdown Optionally, download the geotiffs clipped to the region (only the
+# @markdown part of each tile covering the region is read) and store the
+# @markdown region as their mask:
+download_clipped_tiles = False  # @param { type: "boolean" }
+write_region_mask = True  # @param { type: "boolean" }
+# @markdown and merge the clipped tiles of each year into one cloud optimized
+# @markdown geotiff:
+mosaic_clipped_tiles = False  # @param { type: "boolean" }
 
-_DATASET_VERSION = 'v1'
+# @markdown How manifests are parsed: on threads, on one process per core, or
+# @markdown fetched on threads and parsed on processes:
+executor_kind = "hybrid"  # @param ["thread", "process", "hybrid"]
+
+# @markdown Optionally, also write a catalog of the tiles (footprint,
+# @markdown projection, year, S2 cell and url) with a spatial index, to look
+# @markdown up tiles locally later with `tile_catalog.query_tiles`:
+write_tile_catalog = True  # @param { type: "boolean" }
 
-_GCS_MANIFESTS_FOLDER = "manifests_merged_s2_level_2_float"
 
 _LOCAL_DOWNLOAD_URL_FILE_PATH = "/tmp/downloadable_urls.txt"
 
-_MAX_NUM_THREADS = 8
+_LOCAL_TILE_CATALOG_PATH = "/tmp/tile_catalog.fgb"
+
+_LOCAL_CLIPPED_TILES_DIR = "/tmp/clipped_tiles"
+
+_LOCAL_MOSAICS_DIR = "/tmp/mosaics"
 
-_MANIFEST_S2_LEVEL = 2
+# Per-stage timings and request counts of the run, see `metrics`.
+_LOCAL_METRICS_PATH = "/tmp/run_metrics.json"
+
+# Whether to list the manifests of cells pruned by the exact covering, to
+# report how many manifests the bounding-box covering would have fetched.
+# Off by default: the report spends the listing calls the pruning saves.
+_REPORT_PRUNED_MANIFESTS = False
 
 
 def get_years_as_list() -> list[int]:
@@ -96,183 +115,71 @@ def get_region_geometry(
   if not region:
     raise ValueError("Please select a region or set your_own_wkt_polygon.")
 
-  if region_border_source == "Natural Earth (Low Res 110m)":
-    url = (
-        "https://naciscdn.org/naturalearth/"
-        "110m/cultural/ne_110m_admin_0_countries.zip"
-    )
-    !wget -N {url}
-    display.clear_output()
-    region_shapefile_path = os.path.basename(url)
-  elif region_border_source == "Natural Earth (High Res 10m)":
-    url = (
-        "https://naciscdn.org/naturalearth/"
-        "10m/cultural/ne_10m_admin_0_countries.zip"
-    )
-    !wget -N {url}
-    display.clear_output()
-    region_shapefile_path = os.path.basename(url)
-  elif region_border_source == "World Bank (High Res 10m)":
-    url = (
-        "https://datacatalogfiles.worldbank.org/ddh-published/"
-        "0038272/DR0046659/wb_countries_admin0_10m.zip"
-    )
-    !wget -N {url}
-    !unzip -o {os.path.basename(url)}
-    display.clear_output()
-    region_shapefile_path = "WB_countries_Admin0_10m"
-
   region_iso_a3 = region.split(" ")[0]
-  region_df = (
-      gpd.read_file(region_shapefile_path)
-      .query(f'ISO_A3 == "{region_iso_a3}"')
-      .dissolve(by="ISO_A3")[["geometry"]]
-  )
+  region_geometry = get_region_boundary(region_border_source, region_iso_a3)
   print(f"Preparing {region} from {region_border_source}.")
-  return region_df.iloc[0].geometry
-
-
-def get_bounding_box_s2_covering_tokens(
-    region_geometry: shapely.geometry.base.BaseGeometry,
-) -> list[str]:
-  """Returns the s2_tokens of the bounding box of the provided geometry."""
-  region_bounds = region_geometry.bounds
-  s2_lat_lng_rect = s2.S2LatLngRect_FromPointPair(
-      s2.S2LatLng_FromDegrees(region_bounds[1], region_bounds[0]),
-      s2.S2LatLng_FromDegrees(region_bounds[3], region_bounds[2]),
-  )
-  coverer = s2.S2RegionCoverer()
-  # NOTE: Should be kept in-sync with manifest s2 cell level.
-  coverer.set_fixed_level(_MANIFEST_S2_LEVEL)
-  coverer.set_max_cells(1000000)
-  return [cell.ToToken() for cell in coverer.GetCovering(s2_lat_lng_rect)]
-
-
-def get_matching_manifest_blobs(s2_token: str) -> list[storage.Blob]:
-  """Returns a list of manifest blobs for the given s2_token."""
-  matching_manifest_blobs = []
-  token_manifest_blobs = list(
-      storage_client.list_blobs(
-          _GCS_BUCKET,
-          prefix=os.path.join(_DATASET_VERSION, _GCS_MANIFESTS_FOLDER, f'{s2_token}_'),
-      )
-  )
-  for year in get_years_as_list():
-    filtered_token_manifests = [
-        blob for blob in token_manifest_blobs if f'_{str(year)}_' in blob.name
-    ]
-    matching_manifest_blobs.extend(filtered_token_manifests)
-  return matching_manifest_blobs
-
-
-def multithreaded_fn(progress_bar_desc: str, fn: Callable, items: Iterable[Any]):
-  """Run `fn` on `items` using multithreading and display a progress bar."""
-  total_num_items = len(items)
-  fn_results = []
-  with tqdm.notebook.tqdm(
-      total=len(items), desc=progress_bar_desc
-  ) as pbar:
-    with ThreadPool(processes=_MAX_NUM_THREADS) as pool:
-      for result in pool.map(fn, items):
-        fn_results.extend(result)
-        pbar.update(1)
-  return fn_results
-
+  return region_geometry
 
 
-def multithreaded_get_matching_manifest_blobs(
-    s2_tokens: list[str],
-) -> list[storage.Blob]:
-  """Returns a list of manifest blobs for the given s2_tokens."""
-  return multithreaded_fn("Fetching matching manifests",
-                          get_matching_manifest_blobs, s2_tokens)
-
-
-def extract_tile_polygons(
-    manifest_bytes: bytes,
-) -> list[str]:
-  """Extracts geotiff urls from a manifest."""
-  tile_polys = []
-  manifest = json.loads(manifest_bytes)
-  crs = None
-  for tileset in manifest["tilesets"]:
-    for source in tileset["sources"]:
-      # All tiles in a manifest should have the same projection
-      if crs is None:
-        crs = tileset["crs"]
-      affine_transform = source["affineTransform"]
-      transform = Affine.translation(
-          affine_transform["translateX"], affine_transform["translateY"]
-      ) * Affine.scale(affine_transform["scaleX"], affine_transform["scaleY"])
-      dimensions = source["dimensions"]
-      width = dimensions["width"]
-      height = dimensions["height"]
-
-      corners = [(0, 0), (width, 0), (width, height), (0, height)]
-      corners = [transform * corner for corner in corners]
-
-      uri = source["uris"][0]
-      object_path = manifest["uriPrefix"] + uri
-      tile_polys.append((object_path, Polygon(corners)))
-
-  return tile_polys, crs
-
-
-def extract_geotiff_urls(
-    manifest_blob: storage.Blob,
-    region_geometry: shapely.geometry.base.BaseGeometry,
-) -> list[str]:
-  """Extracts geotiff urls from a manifest intersecting `region_geometry`."""
-  manifest_bytes = manifest_blob.download_as_bytes()
-  tile_polys, crs = extract_tile_polygons(manifest_bytes)
-  # EPSG:4326 is the standard WGS84 lat/lon coordinate system. We transform
-  # region_geometry from EPSG:4326 to manifest's projection before doing
-  # intersection check.
-  transformer = pyproj.Transformer.from_crs("epsg:4326", crs, always_xy=True)
-  region_geometry = transform(transformer.transform, region_geometry)
-  geotiff_urls = []
-  for (url, poly) in tile_polys:
-    if poly.intersects(region_geometry):
-      geotiff_urls.append(url)
-
-  return geotiff_urls
-
-
-def multithreaded_extract_geotiff_urls(
-    manifest_blobs: list[storage.Blob],
-    region_geometry: shapely.geometry.base.BaseGeometry,
-) -> list[str]:
-  """Extracts geotiff urls from manifests."""
-  return multithreaded_fn(
-      "Extracting urls",
-      lambda manifest_blob: extract_geotiff_urls(
-          manifest_blob, region_geometry
-      ),
-      manifest_blobs,
-  )
-
-
-def write_to_file(filename: str, urls: list[str]) -> None:
-  """Writes urls to file."""
-  with open(filename, "w") as f:
-    for url in urls:
-      f.write(f"{url}\n")
-
 
 # Clear output after pip install.
 display.clear_output()
-storage_client = storage.Client(credentials=credentials.AnonymousCredentials())
 geometry = get_region_geometry(
     region_border_source, region, your_own_wkt_polygon
 )
-s2_tokens = get_bounding_box_s2_covering_tokens(geometry)
+s2_tokens = get_region_s2_covering_tokens(geometry)
+bounding_box_s2_tokens = get_bounding_box_s2_covering_tokens(geometry)
+pruned_s2_tokens = sorted(set(bounding_box_s2_tokens) - set(s2_tokens))
+print(
+    f"S2 covering: {len(s2_tokens)} cells, {len(pruned_s2_tokens)} of the"
+    f" {len(bounding_box_s2_tokens)} bounding box cells pruned."
+)
 
-region_manifest_blobs = multithreaded_get_matching_manifest_blobs(s2_tokens)
+if _REPORT_PRUNED_MANIFESTS and pruned_s2_tokens:
+  pruned_manifest_blobs = multithreaded_get_matching_manifest_blobs(
+      pruned_s2_tokens, get_years_as_list()
+  )
+  print(
+      f"{len(pruned_manifest_blobs)} manifests pruned compared with the"
+      " bounding box covering."
+  )
 
-geotiff_urls = multithreaded_extract_geotiff_urls(
-    region_manifest_blobs, geometry
+num_geotiff_urls = stream_geotiff_urls_to_file(
+    _LOCAL_DOWNLOAD_URL_FILE_PATH,
+    s2_tokens,
+    geometry,
+    get_years_as_list(),
+    executor_kind,
+    _LOCAL_TILE_CATALOG_PATH if write_tile_catalog else None,
 )
 
-write_to_file(_LOCAL_DOWNLOAD_URL_FILE_PATH, geotiff_urls)
+print(f"Finished writing urls to file. File contains {num_geotiff_urls} urls")
+if write_tile_catalog:
+  print(f"Wrote the tile catalog to {_LOCAL_TILE_CATALOG_PATH}.")
 
-print(f"Finished writing urls to file. File contains {len(geotiff_urls)} urls")
\ No newline at end of file
+if download_clipped_tiles:
+  clipped_tiles = multithreaded_clip_geotiffs(
+      read_from_file(_LOCAL_DOWNLOAD_URL_FILE_PATH),
+      geometry,
+      _LOCAL_CLIPPED_TILES_DIR,
+      write_region_mask,
+  )
+  window_pixels = sum(window for _, window, _ in clipped_tiles)
+  tile_pixels = sum(tile for _, _, tile in clipped_tiles)
+  print(
+      f"Wrote {len(clipped_tiles)} clipped tiles to {_LOCAL_CLIPPED_TILES_DIR},"
+      f" reading {window_pixels / max(tile_pixels, 1):.1%} of their pixels."
+  )
+  if mosaic_clipped_tiles:
+    mosaics = multithreaded_mosaic_tiles(
+        group_tiles_by_year(
+            (path for path, _, _ in clipped_tiles), get_years_as_list()
+        ),
+        _LOCAL_MOSAICS_DIR,
+    )
+    print(f"Wrote {len(mosaics)} yearly mosaics to {_LOCAL_MOSAICS_DIR}.")
+print(
+    f"Manifest cache: {open_buildings.manifest_cache.hits} hits,"
+    f" {open_buildings.manifest_cache.misses} misses."
+)
+metrics.get_metrics().report(_LOCAL_METRICS_PATH)
\ No newline at end of file
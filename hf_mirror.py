@@ -0,0 +1,227 @@
+import json
+import os
+import posixpath
+import threading
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+from blob_store import OBJECTS_DIR, BlobStore, fetch_blob
+from download_engine import get_engine, wait_all
+
+# Hub 地址，可用 HF_ENDPOINT 指向镜像站或本地测试服务
+HF_ENDPOINT = os.environ.get("HF_ENDPOINT", "https://huggingface.co").rstrip("/")
+# 镜像清单文件名，保存在镜像根目录下
+MIRROR_MANIFEST_FILE = ".hf_mirror.json"
+# 同时同步的仓库数；文件级并发由共享下载引擎限制
+MAX_CONCURRENT_REPOS = 4
+# 仓库类型 -> API 与镜像目录中使用的复数名
+REPO_TYPES = {"model": "models", "dataset": "datasets"}
+
+
+class MirrorManifest:
+    """
+    Local manifest of a Hugging Face mirror.
+
+    Maps "<models|datasets>/<repo_id>" to the revision that was requested,
+    the commit SHA it resolved to and the size and content key of every
+    file of that commit. The manifest is a JSON file, written atomically;
+    it is safe to update from several repo threads.
+
+    Parameters:
+    - path: Location of the JSON manifest.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                self._repos = json.load(f)
+        except (OSError, ValueError):
+            self._repos = {}
+
+    def get(self, key):
+        with self._lock:
+            return self._repos.get(key)
+
+    def put(self, key, entry):
+        """
+        Records `entry` for `key` and writes the manifest to disk.
+        """
+        with self._lock:
+            self._repos[key] = entry
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self._repos, f, ensure_ascii=False, indent=1)
+            os.replace(tmp_path, self.path)
+
+
+def auth_headers(token=None):
+    """
+    Returns the Authorization header for `token`, if any.
+    """
+    headers = {}
+    if token:
+        headers["Authorization"] = f"Bearer {token}"
+    return headers
+
+
+def get_revision_info(repo_id, repo_type="model", revision="main", endpoint=HF_ENDPOINT, token=None):
+    """
+    Resolves `revision` of a repository and lists its files in one request.
+
+    Returns:
+    A (commit_sha, files) tuple; `files` maps each file path to its `size`
+    and content `key`: the SHA-256 of LFS files, else the git blob SHA.
+    Raises requests.HTTPError if the Hub refuses the request.
+    """
+    url = (f"{endpoint}/api/{REPO_TYPES[repo_type]}/{repo_id}/revision/"
+           f"{urllib.parse.quote(revision, safe='')}")
+    response = get_engine().get(url, headers=auth_headers(token), params={"blobs": "true"})
+    response.raise_for_status()
+    info = response.json()
+    files = {}
+    for sibling in info.get("siblings", []):
+        lfs = sibling.get("lfs")
+        files[sibling["rfilename"]] = {
+            "size": lfs["size"] if lfs else sibling.get("size"),
+            "key": lfs["sha256"] if lfs else sibling["blobId"],
+        }
+    return info["sha"], files
+
+
+def _is_present(local_path, size):
+    # 清单中没有大小时只能确认文件存在
+    try:
+        return os.path.isfile(local_path) and (size is None or os.path.getsize(local_path) == size)
+    except OSError:
+        return False
+
+
+def mirror_repo(store, manifest, root, repo_id, repo_type="model", revision="main", endpoint=HF_ENDPOINT,
+                token=None):
+    """
+    Brings the mirror of one repository up to date.
+
+    Costs one metadata request when the revision still resolves to the
+    commit recorded in the manifest and every file is in place. Otherwise
+    only the files whose content key changed (or that are missing locally)
+    are fetched through the shared download engine; their bytes are stored
+    once in `store`, so a file shared by several repositories or revisions
+    is transferred once. Files deleted upstream are removed.
+
+    Parameters:
+    - store: The BlobStore holding the file contents.
+    - manifest: The MirrorManifest of the mirror.
+    - root: Mirror root; the repository goes to root/<models|datasets>/<repo_id>.
+    - repo_id: "<owner>/<name>" of the repository.
+    - repo_type: "model" or "dataset".
+    - revision: Branch, tag or commit to mirror.
+    - endpoint: Hub URL.
+    - token: Hugging Face access token (optional).
+
+    Returns:
+    A dict with the repository `key`, its `commit`, whether it was
+    `unchanged`, and the number of files `fetched` and `removed`.
+    """
+    key = f"{REPO_TYPES[repo_type]}/{repo_id}"
+    repo_dir = os.path.join(root, *key.split("/"))
+    commit, files = get_revision_info(repo_id, repo_type, revision, endpoint, token)
+    previous = manifest.get(key) or {}
+    previous_files = previous.get("files", {})
+
+    def local_path(path):
+        return os.path.join(repo_dir, *path.split("/"))
+
+    if previous.get("commit") == commit and all(
+            _is_present(local_path(path), meta["size"]) for path, meta in files.items()):
+        return {"key": key, "commit": commit, "unchanged": True, "fetched": 0, "removed": 0}
+
+    engine = get_engine()
+    headers = auth_headers(token)
+    prefix = "" if repo_type == "model" else f"{REPO_TYPES[repo_type]}/"
+    futures = {}
+    for path, meta in files.items():
+        old = previous_files.get(path)
+        if old is not None and old["key"] == meta["key"] and _is_present(local_path(path), meta["size"]):
+            continue
+        url = f"{endpoint}/{prefix}{repo_id}/resolve/{commit}/{urllib.parse.quote(path)}"
+        futures[engine.submit(fetch_blob, store, url, local_path(path), meta["key"], headers)] = path
+    _, errors = wait_all(futures)
+    if errors:
+        path, e = errors[0]
+        raise RuntimeError(f"{len(errors)} 个文件下载失败，例如 {path}: {e}") from e
+
+    removed = 0
+    for path in previous_files.keys() - files.keys():
+        if os.path.exists(local_path(path)):
+            os.remove(local_path(path))
+            removed += 1
+    manifest.put(key, {"revision": revision, "commit": commit, "files": files})
+    return {"key": key, "commit": commit, "unchanged": False, "fetched": len(futures), "removed": removed}
+
+
+def mirror_repos(repos, root="./hf_mirror", revision="main", endpoint=HF_ENDPOINT, token=None,
+                 max_repos=MAX_CONCURRENT_REPOS):
+    """
+    Mirrors Hugging Face repositories into `root` incrementally.
+
+    Layout: root/models/<repo_id>, root/datasets/<repo_id>, the shared
+    object store root/.objects and the manifest root/.hf_mirror.json.
+    A repository that fails is reported and does not stop the others.
+
+    Parameters:
+    - repos: (repo_id, repo_type) tuples.
+    - root: Mirror root directory.
+    - revision: Branch, tag or commit to mirror for every repository.
+    - endpoint: Hub URL.
+    - token: Hugging Face access token (optional).
+    - max_repos: Repositories synced at the same time.
+
+    Returns:
+    The result of mirror_repo for each repository, in order, or the
+    exception it raised.
+    """
+    store = BlobStore(os.path.join(root, OBJECTS_DIR))
+    manifest = MirrorManifest(os.path.join(root, MIRROR_MANIFEST_FILE))
+
+    def sync(repo):
+        repo_id, repo_type = repo
+        try:
+            result = mirror_repo(store, manifest, root, repo_id, repo_type, revision, endpoint, token)
+        except Exception as e:
+            print(f"同步失败 {repo_id}: {e}")
+            return e
+        if result["unchanged"]:
+            print(f"未变化，跳过: {result['key']}@{result['commit'][:12]}")
+        else:
+            print(f"已同步 {result['key']}@{result['commit'][:12]}: "
+                  f"下载 {result['fetched']} 个文件，删除 {result['removed']} 个文件")
+        return result
+
+    with ThreadPoolExecutor(max_workers=max_repos) as executor:
+        results = list(executor.map(sync, repos))
+    failed = sum(isinstance(result, Exception) for result in results)
+    unchanged = sum(isinstance(result, dict) and result["unchanged"] for result in results)
+    print(f"镜像完成：{len(results) - failed}/{len(results)} 个仓库，其中 {unchanged} 个未变化；"
+          + get_engine().summary())
+    return results
+
+
+def load_repo_list(path, field, repo_type):
+    """
+    Reads a JSON repo list such as models.json ([{"model_name": ...}]) as
+    (repo_id, repo_type) tuples.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        return [(item[field], repo_type) for item in json.load(f)]
+
+
+if __name__ == "__main__":
+    lists_dir = "./download_LLM_model_dataset_huggingface"
+    repos = load_repo_list(posixpath.join(lists_dir, "models.json"), "model_name", "model")
+    repos += load_repo_list(posixpath.join(lists_dir, "dataset.json"), "ds_name", "dataset")
+    mirror_repos(repos, root="./hf_mirror", token=os.environ.get("HF_TOKEN"))
@@ -0,0 +1,439 @@
+import json
+import os
+import sys
+import threading
+import time
+import urllib.parse
+from contextlib import contextmanager
+
+# 运行结束时写出指标的文件；以 .prom / .txt 结尾时写 Prometheus 文本格式，否则写 JSON
+METRICS_FILE = os.environ.get("SCRAPER_METRICS_FILE")
+# 人类可读进度的最短刷新间隔（秒）
+PROGRESS_INTERVAL = 2.0
+# 请求延迟直方图的桶上界（秒）
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+# Prometheus 指标名前缀
+PROMETHEUS_PREFIX = "scraper"
+
+
+def _host(url):
+    parts = urllib.parse.urlsplit(url)
+    return parts.netloc or url
+
+
+def _new_host_record():
+    return {
+        "count": 0,
+        "bytes": 0,
+        "seconds": 0.0,
+        "max_seconds": 0.0,
+        "retries": 0,
+        "statuses": {},
+        "buckets": [0] * (len(LATENCY_BUCKETS) + 1),
+    }
+
+
+def _new_stage_record():
+    return {
+        "calls": 0,
+        "errors": 0,
+        "wall_seconds": 0.0,
+        "cpu_seconds": 0.0,
+        "first": None,
+        "last": None,
+    }
+
+
+class Metrics:
+    """
+    Instrumentation shared by all scrapers of a process.
+
+    Records, aggregated so memory does not grow with the run:
+    - requests per host: count, status codes, bytes, latency histogram and
+      retries;
+    - stages (listing, manifest fetch, parse, ...): calls, errors, summed
+      wall and CPU time and the span from the first start to the last end;
+    - in-flight gauges: current and peak number of concurrent requests per
+      host and calls per stage;
+    - free-form counters, e.g. seconds spent waiting for a rate limit.
+
+    Comparing a stage's summed wall time with its span and peak concurrency
+    shows whether it is the bottleneck; CPU time close to wall time marks a
+    CPU-bound stage. A forked child starts with empty metrics; its records
+    are sent back with `drain` and added with `merge`.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """
+        Clears all records and restarts the run clock.
+        """
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self._start = time.monotonic()
+        self.requests = {}
+        self.stages = {}
+        self.in_flight = {}
+        self.counters = {}
+
+    def _enter(self, name):
+        with self._lock:
+            gauge = self.in_flight.setdefault(name, {"current": 0, "peak": 0})
+            gauge["current"] += 1
+            gauge["peak"] = max(gauge["peak"], gauge["current"])
+
+    def _leave(self, name):
+        with self._lock:
+            self.in_flight[name]["current"] -= 1
+
+    @contextmanager
+    def request(self, url):
+        """
+        Times one HTTP request to `url`.
+
+        Yields a dict in which the caller stores the response `status` and
+        the number of `bytes` received; an exception records its type name
+        as the status.
+        """
+        host = _host(url)
+        record = {"status": None, "bytes": 0}
+        self._enter(f"requests:{host}")
+        start = time.perf_counter()
+        try:
+            yield record
+        except BaseException as e:
+            if record["status"] is None:
+                record["status"] = type(e).__name__
+            raise
+        finally:
+            seconds = time.perf_counter() - start
+            self._leave(f"requests:{host}")
+            self.add_request(host, record["status"], seconds, record["bytes"])
+
+    def add_request(self, host, status, seconds, size=0):
+        """
+        Records one finished request to `host`.
+        """
+        bucket = 0
+        while bucket < len(LATENCY_BUCKETS) and seconds > LATENCY_BUCKETS[bucket]:
+            bucket += 1
+        status = str(status)
+        with self._lock:
+            entry = self.requests.setdefault(host, _new_host_record())
+            entry["count"] += 1
+            entry["bytes"] += size
+            entry["seconds"] += seconds
+            entry["max_seconds"] = max(entry["max_seconds"], seconds)
+            entry["statuses"][status] = entry["statuses"].get(status, 0) + 1
+            entry["buckets"][bucket] += 1
+
+    def retry(self, url):
+        """
+        Records that a request to `url` is retried.
+        """
+        with self._lock:
+            self.requests.setdefault(_host(url), _new_host_record())["retries"] += 1
+
+    def count(self, name, value=1):
+        """
+        Adds `value` to the counter `name`.
+        """
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Times the enclosed block as one call of stage `name`: wall time, CPU
+        time of the calling thread, and in-flight concurrency.
+        """
+        self._enter(f"stage:{name}")
+        wall_start = time.monotonic()
+        cpu_start = time.thread_time()
+        failed = False
+        try:
+            yield
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            cpu = time.thread_time() - cpu_start
+            wall_end = time.monotonic()
+            self._leave(f"stage:{name}")
+            with self._lock:
+                entry = self.stages.setdefault(name, _new_stage_record())
+                entry["calls"] += 1
+                entry["errors"] += failed
+                entry["wall_seconds"] += wall_end - wall_start
+                entry["cpu_seconds"] += cpu
+                entry["first"] = wall_start if entry["first"] is None else min(entry["first"], wall_start)
+                entry["last"] = wall_end if entry["last"] is None else max(entry["last"], wall_end)
+
+    def timed(self, name, fn, *args, **kwargs):
+        """
+        Calls `fn(*args, **kwargs)` as one call of stage `name`, e.g. as a
+        job for DownloadEngine.submit, and returns its result.
+        """
+        with self.stage(name):
+            return fn(*args, **kwargs)
+
+    def drain(self):
+        """
+        Returns the records as a picklable dict and clears them, e.g. to send
+        a worker process's records to its parent (see `merge`).
+        """
+        with self._lock:
+            records = {
+                "requests": self.requests,
+                "stages": self.stages,
+                "in_flight": {name: {"current": 0, "peak": gauge["peak"]}
+                              for name, gauge in self.in_flight.items()},
+                "counters": self.counters,
+            }
+            self.requests = {}
+            self.stages = {}
+            self.counters = {}
+            for gauge in self.in_flight.values():
+                gauge["peak"] = gauge["current"]
+        return records
+
+    def merge(self, records):
+        """
+        Adds records returned by `drain` in another process. Peaks of the
+        in-flight gauges are combined with max.
+        """
+        with self._lock:
+            for host, other in records["requests"].items():
+                entry = self.requests.setdefault(host, _new_host_record())
+                for key in ("count", "bytes", "seconds", "retries"):
+                    entry[key] += other[key]
+                entry["max_seconds"] = max(entry["max_seconds"], other["max_seconds"])
+                for status, n in other["statuses"].items():
+                    entry["statuses"][status] = entry["statuses"].get(status, 0) + n
+                entry["buckets"] = [a + b for a, b in zip(entry["buckets"], other["buckets"])]
+            for name, other in records["stages"].items():
+                entry = self.stages.setdefault(name, _new_stage_record())
+                for key in ("calls", "errors", "wall_seconds", "cpu_seconds"):
+                    entry[key] += other[key]
+                # CLOCK_MONOTONIC 在同一台机器的进程之间共享，可直接比较
+                entry["first"] = min(t for t in (entry["first"], other["first"]) if t is not None)
+                entry["last"] = max(t for t in (entry["last"], other["last"]) if t is not None)
+            for name, other in records["in_flight"].items():
+                gauge = self.in_flight.setdefault(name, {"current": 0, "peak": 0})
+                gauge["peak"] = max(gauge["peak"], other["peak"])
+            for name, value in records["counters"].items():
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    def to_dict(self):
+        """
+        Returns a JSON-serializable snapshot of all records.
+        """
+        with self._lock:
+            requests = {}
+            for host, entry in sorted(self.requests.items()):
+                cumulative = 0
+                buckets = {}
+                for bound, n in zip(LATENCY_BUCKETS + ("+Inf",), entry["buckets"]):
+                    cumulative += n
+                    buckets[str(bound)] = cumulative
+                requests[host] = {
+                    "count": entry["count"],
+                    "bytes": entry["bytes"],
+                    "seconds": entry["seconds"],
+                    "mean_seconds": entry["seconds"] / entry["count"] if entry["count"] else 0.0,
+                    "max_seconds": entry["max_seconds"],
+                    "retries": entry["retries"],
+                    "statuses": dict(sorted(entry["statuses"].items())),
+                    "latency_buckets": buckets,
+                    "peak_in_flight": self.in_flight.get(f"requests:{host}", {}).get("peak", 0),
+                }
+            stages = {}
+            for name, entry in self.stages.items():
+                stages[name] = {
+                    "calls": entry["calls"],
+                    "errors": entry["errors"],
+                    "wall_seconds": entry["wall_seconds"],
+                    "cpu_seconds": entry["cpu_seconds"],
+                    "span_seconds": entry["last"] - entry["first"],
+                    "peak_in_flight": self.in_flight.get(f"stage:{name}", {}).get("peak", 0),
+                }
+            return {
+                "started": self.started,
+                "elapsed_seconds": time.monotonic() - self._start,
+                "requests": requests,
+                "stages": stages,
+                "counters": dict(sorted(self.counters.items())),
+            }
+
+    def to_prometheus(self):
+        """
+        Returns all records in the Prometheus text exposition format.
+        """
+        snapshot = self.to_dict()
+        lines = []
+
+        def metric(name, kind, samples):
+            name = f"{PROMETHEUS_PREFIX}_{name}"
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                label_text = ",".join(f'{key}="{_escape_label(value)}"' for key, value in labels.items())
+                lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+
+        metric("run_seconds", "gauge", [({}, snapshot["elapsed_seconds"])])
+        requests = snapshot["requests"]
+        metric("requests_total", "counter", [
+            ({"host": host, "status": status}, n)
+            for host, entry in requests.items() for status, n in entry["statuses"].items()
+        ])
+        metric("request_bytes_total", "counter", [({"host": host}, entry["bytes"]) for host, entry in requests.items()])
+        metric("request_retries_total", "counter",
+               [({"host": host}, entry["retries"]) for host, entry in requests.items()])
+        lines.append(f"# TYPE {PROMETHEUS_PREFIX}_request_seconds histogram")
+        for host, entry in requests.items():
+            label = _escape_label(host)
+            for bound, n in entry["latency_buckets"].items():
+                lines.append(f'{PROMETHEUS_PREFIX}_request_seconds_bucket{{host="{label}",le="{bound}"}} {n}')
+            lines.append(f'{PROMETHEUS_PREFIX}_request_seconds_sum{{host="{label}"}} {entry["seconds"]}')
+            lines.append(f'{PROMETHEUS_PREFIX}_request_seconds_count{{host="{label}"}} {entry["count"]}')
+        metric("requests_in_flight_peak", "gauge",
+               [({"host": host}, entry["peak_in_flight"]) for host, entry in requests.items()])
+        stages = snapshot["stages"]
+        for key, name, kind in (
+                ("calls", "stage_calls_total", "counter"),
+                ("errors", "stage_errors_total", "counter"),
+                ("wall_seconds", "stage_wall_seconds_total", "counter"),
+                ("cpu_seconds", "stage_cpu_seconds_total", "counter"),
+                ("span_seconds", "stage_span_seconds", "gauge"),
+                ("peak_in_flight", "stage_in_flight_peak", "gauge")):
+            metric(name, kind, [({"stage": stage}, entry[key]) for stage, entry in stages.items()])
+        metric("events_total", "counter", [({"name": name}, value) for name, value in snapshot["counters"].items()])
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """
+        Returns a human summary of the stages and hosts, one line each.
+        """
+        snapshot = self.to_dict()
+        lines = [f"运行 {snapshot['elapsed_seconds']:.1f} 秒"]
+        for name, entry in sorted(snapshot["stages"].items(), key=lambda item: -item[1]["wall_seconds"]):
+            lines.append(
+                f"  阶段 {name}: {entry['calls']} 次，累计 {entry['wall_seconds']:.1f} 秒，"
+                f"CPU {entry['cpu_seconds']:.1f} 秒，跨度 {entry['span_seconds']:.1f} 秒，"
+                f"峰值并发 {entry['peak_in_flight']}"
+                + (f"，失败 {entry['errors']} 次" if entry["errors"] else ""))
+        for host, entry in snapshot["requests"].items():
+            statuses = ", ".join(f"{status}: {n}" for status, n in entry["statuses"].items())
+            lines.append(
+                f"  主机 {host}: {entry['count']} 个请求 ({statuses})，{entry['bytes'] / 1024 / 1024:.1f} MB，"
+                f"平均延迟 {entry['mean_seconds'] * 1000:.0f} ms，最长 {entry['max_seconds']:.1f} 秒，"
+                f"重试 {entry['retries']} 次，峰值并发 {entry['peak_in_flight']}")
+        for name, value in snapshot["counters"].items():
+            lines.append(f"  {name}: {value:g}")
+        return "\n".join(lines)
+
+    def write(self, path):
+        """
+        Writes the metrics to `path`: Prometheus text for a .prom or .txt
+        file, JSON otherwise. The file is replaced atomically.
+        """
+        if path.endswith((".prom", ".txt")):
+            text = self.to_prometheus()
+        else:
+            text = json.dumps(self.to_dict(), ensure_ascii=False, indent=1)
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+
+    def report(self, path=None):
+        """
+        Prints the summary and, when `path` (default: METRICS_FILE) is set,
+        writes the metrics there. Called at the end of a scraper run.
+        """
+        print(self.summary())
+        path = path or METRICS_FILE
+        if path:
+            self.write(path)
+            print(f"指标已写入 {path}")
+
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Progress:
+    """
+    Throttled progress line for long transfers.
+
+    Prints at most once every `interval` seconds (and once when finished)
+    instead of on every block, so progress output costs nothing measurable
+    on fast links. On a terminal the line is redrawn in place, otherwise
+    (logs, notebooks) every update is a new line.
+
+    Parameters:
+    - label: Text shown before the progress.
+    - interval: Minimum number of seconds between two updates.
+    - stream: Output stream, sys.stdout by default.
+    """
+
+    def __init__(self, label, interval=PROGRESS_INTERVAL, stream=None):
+        self.label = label
+        self.interval = interval
+        self.stream = stream or sys.stdout
+        self._start = time.monotonic()
+        self._last = None
+        self._lock = threading.Lock()
+        self._tty = hasattr(self.stream, "isatty") and self.stream.isatty()
+        self._open_line = False
+
+    def update(self, done, total=None):
+        """
+        Reports `done` of `total` bytes; prints only if `interval` elapsed.
+        """
+        now = time.monotonic()
+        if self._last is not None and now - self._last < self.interval and done != total:
+            return
+        with self._lock:
+            if self._last is not None and now - self._last < self.interval and done != total:
+                return
+            self._last = now
+            rate = done / max(now - self._start, 1e-9) / 1024 / 1024
+            if total:
+                text = f"{self.label}: {done / total:.1%} ({done / 1024 / 1024:.1f}/{total / 1024 / 1024:.1f} MB)"
+            else:
+                text = f"{self.label}: {done / 1024 / 1024:.1f} MB"
+            text += f"，{rate:.1f} MB/s"
+            if self._tty:
+                self.stream.write(f"\r{text}")
+                self._open_line = True
+            else:
+                self.stream.write(text + "\n")
+            self.stream.flush()
+
+    def finish(self):
+        """
+        Ends the redrawn line on a terminal.
+        """
+        with self._lock:
+            if self._open_line:
+                self.stream.write("\n")
+                self.stream.flush()
+                self._open_line = False
+
+
+_metrics = Metrics()
+# fork 出的子进程（如进程池 worker）从空记录开始，避免把父进程的记录重复合并回去
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_metrics.reset)
+
+
+def get_metrics():
+    """
+    Returns the process-wide Metrics.
+    """
+    return _metrics
@@ -0,0 +1,1552 @@
+"""Open Buildings 2.5D Temporal dataset: geotiff urls for regions and years.
+
+Importable library behind the `google_colab_data.py` notebook, usable
+outside Colab. It also runs as a batch command line tool which resolves the
+urls of many regions at once, listing and parsing each manifest only once:
+
+  python open_buildings.py --boundaries "Natural Earth (High Res 10m)" \\
+      --regions IDN MYS SGP --years 2020 2023 --output-dir urls/
+"""
+
+import argparse
+import array
+import collections
+import contextlib
+import functools
+import hashlib
+import io
+import itertools
+import json
+import math
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import os
+import queue
+import re
+import threading
+import time
+from typing import (
+    Any, Callable, Iterable, Iterator, NamedTuple, Optional, Tuple
+)
+import urllib.parse
+
+from google.auth import credentials
+from google.cloud import storage
+import numpy as np
+import pyproj
+import rasterio
+import rasterio.errors
+import rasterio.features
+import rasterio.merge
+import rasterio.shutil
+import rasterio.transform
+import rasterio.vrt
+import rasterio.warp
+import rasterio.windows
+import s2geometry as s2
+import shapely
+from shapely.geometry import box
+from shapely.ops import transform
+import tqdm.auto
+
+try:
+  import orjson  # Optional: faster manifest parsing.
+except ImportError:
+  orjson = None
+
+import metrics
+import region_boundaries
+import tile_catalog
+
+_GCS_BUCKET = "open-buildings-temporal-data"
+
+_DATASET_VERSION = 'v1'
+
+_GCS_MANIFESTS_FOLDER = "manifests_merged_s2_level_2_float"
+
+# Number of geotiffs read concurrently when downloading clipped tiles.
+_MAX_NUM_DOWNLOADS = 8
+
+# Memory budget of one year's mosaic. The mosaic is written block by block,
+# the block size being derived from this budget, so peak memory does not
+# depend on the size of the region.
+_MOSAIC_MEMORY_BYTES = 512 * 1024 * 1024
+
+# Number of years mosaicked concurrently, each within _MOSAIC_MEMORY_BYTES.
+_MAX_NUM_MOSAICS = 2
+
+# GDAL options for reading cloud optimized geotiffs over HTTP with as few
+# range requests as possible.
+_GDAL_COG_READ_OPTIONS = {
+    "GDAL_DISABLE_READDIR_ON_OPEN": "EMPTY_DIR",
+    "CPL_VSIL_CURL_ALLOWED_EXTENSIONS": ".tif,.tiff",
+    "GDAL_HTTP_MULTIRANGE": "YES",
+    "GDAL_HTTP_MERGE_CONSECUTIVE_RANGES": "YES",
+    "GDAL_TIFF_INTERNAL_MASK": "YES",
+}
+
+_MAX_NUM_THREADS = 8
+
+# How CPU-bound manifest parsing and intersection run: "thread" runs
+# everything on `_MAX_NUM_THREADS` threads; "process" runs it on a process
+# pool with one worker per available core; "hybrid" fetches manifests on
+# threads and parses and intersects them on the process pool.
+_EXECUTOR_KIND = "hybrid"
+
+# Local cache of manifest listings and parsed tile footprints, so re-runs for
+# other years or nearby regions need almost no network.
+_CACHE_DIR = "/tmp/open_buildings_cache"
+
+# Size bound of the cache; the least recently used entries are evicted first.
+_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+
+# Age after which a cached listing is listed again. Re-listing only fetches
+# blob names, generations and hashes; unchanged manifests stay cached.
+_LISTING_CACHE_MAX_AGE_SECONDS = 24 * 60 * 60
+
+# Capacity of the queues between the listing, extraction and writing stages.
+# A full queue blocks the stage feeding it, which bounds memory use.
+_PIPELINE_QUEUE_SIZE = 64
+
+_MANIFEST_S2_LEVEL = 2
+
+# Tolerance (degrees) for simplifying the region before computing its S2
+# covering. The region is first buffered by twice this amount so that the
+# simplified outline still contains it.
+_S2_COVERING_SIMPLIFY_TOLERANCE = 0.01
+
+# Longest edge (degrees) passed to S2. S2 edges are geodesics, so long
+# lat/lng edges are densified to keep them close to the planar outline.
+_S2_COVERING_MAX_EDGE_DEGREES = 1.0
+
+
+def get_bounding_box_s2_covering_tokens(
+    region_geometry: shapely.geometry.base.BaseGeometry,
+) -> list[str]:
+  """Returns the s2_tokens of the bounding box of the provided geometry."""
+  region_bounds = region_geometry.bounds
+  s2_lat_lng_rect = s2.S2LatLngRect_FromPointPair(
+      s2.S2LatLng_FromDegrees(region_bounds[1], region_bounds[0]),
+      s2.S2LatLng_FromDegrees(region_bounds[3], region_bounds[2]),
+  )
+  coverer = s2.S2RegionCoverer()
+  # NOTE: Should be kept in-sync with manifest s2 cell level.
+  coverer.set_fixed_level(_MANIFEST_S2_LEVEL)
+  coverer.set_max_cells(1000000)
+  return [cell.ToToken() for cell in coverer.GetCovering(s2_lat_lng_rect)]
+
+
+def _get_s2_polygon(
+    polygon: shapely.geometry.Polygon,
+) -> Optional[s2.S2Polygon]:
+  """Returns the exterior of `polygon` as an S2Polygon, or None if invalid."""
+  exterior = shapely.geometry.polygon.orient(polygon, sign=1.0).exterior
+  # S2 loops are implicitly closed, so the repeated last vertex is dropped.
+  points = [
+      s2.S2LatLng_FromDegrees(lat, lng).ToPoint()
+      for lng, lat in exterior.coords[:-1]
+  ]
+  loop = s2.S2Loop(points)
+  if not loop.IsValid():
+    return None
+  loop.Normalize()
+  s2_polygon = s2.S2Polygon()
+  s2_polygon.InitNested([loop])
+  return s2_polygon
+
+
+def get_region_s2_covering_tokens(
+    region_geometry: shapely.geometry.base.BaseGeometry,
+    simplify_tolerance: float = _S2_COVERING_SIMPLIFY_TOLERANCE,
+) -> list[str]:
+  """Returns the s2_tokens of the cells that intersect the provided geometry.
+
+  The covering is the union of the fixed-level coverings of every polygon of
+  the (buffered and simplified) region, so cells that only overlap the
+  bounding box of a diagonal or archipelago region are left out. Holes are
+  ignored, which can only add cells. Parts that do not form a valid S2 loop
+  fall back to their bounding box.
+  """
+  outline = region_geometry
+  if simplify_tolerance:
+    outline = outline.buffer(2 * simplify_tolerance).simplify(
+        simplify_tolerance, preserve_topology=True
+    )
+  outline = shapely.segmentize(outline, _S2_COVERING_MAX_EDGE_DEGREES)
+  coverer = s2.S2RegionCoverer()
+  # NOTE: Should be kept in-sync with manifest s2 cell level.
+  coverer.set_fixed_level(_MANIFEST_S2_LEVEL)
+  coverer.set_max_cells(1000000)
+  tokens = set()
+  for polygon in shapely.get_parts(outline):
+    s2_polygon = _get_s2_polygon(polygon)
+    if s2_polygon is None:
+      tokens.update(get_bounding_box_s2_covering_tokens(polygon))
+    else:
+      tokens.update(cell.ToToken() for cell in coverer.GetCovering(s2_polygon))
+  return sorted(tokens)
+
+
+class ManifestRef(NamedTuple):
+  """Identifies one version of a manifest blob in `_GCS_BUCKET`."""
+
+  name: str
+  generation: int
+  md5_hash: str
+  size: int
+
+
+class TileTable(NamedTuple):
+  """Columnar table of the tiles of a manifest.
+
+  `urls` is a NumPy object array and `bounds` the parallel (n, 4) float64
+  array of (minx, miny, maxx, maxy) tile bounds in the projection `crs`.
+  """
+
+  urls: np.ndarray
+  bounds: np.ndarray
+  crs: Optional[str]
+
+# (manifest_ref, cached tiles, None) or (manifest_ref, None, manifest bytes),
+# see `fetch_manifest`.
+FetchedManifest = Tuple[ManifestRef, Optional[TileTable], Optional[bytes]]
+
+
+class ManifestCache:
+  """Size-bounded on-disk LRU cache of manifest listings and tile footprints.
+
+  Listings are small JSON files keyed by prefix. Footprints are `.npz` files
+  keyed by manifest name, generation and MD5, holding the tile bounds as one
+  float64 array and the urls as one newline-separated UTF-8 buffer. File
+  mtimes track recency: reads touch the file, and writes evict the oldest
+  files once the cache grows past `max_bytes`.
+  """
+
+  def __init__(self, root: str, max_bytes: int = _CACHE_MAX_BYTES):
+    self.root = root
+    self.max_bytes = max_bytes
+    self.hits = 0
+    self.misses = 0
+    self._size = None
+    self._lock = threading.Lock()
+
+  def _path(self, kind: str, key: str, suffix: str) -> str:
+    digest = hashlib.sha1(key.encode("utf-8")).hexdigest()
+    return os.path.join(self.root, kind, digest + suffix)
+
+  def _count(self, hit: bool) -> None:
+    with self._lock:
+      if hit:
+        self.hits += 1
+      else:
+        self.misses += 1
+    metrics.get_metrics().count(
+        "manifest_cache_hits" if hit else "manifest_cache_misses"
+    )
+
+  def take_counts(self) -> Tuple[int, int]:
+    """Returns the (hits, misses) counted so far and resets them to zero."""
+    with self._lock:
+      counts = (self.hits, self.misses)
+      self.hits = self.misses = 0
+    return counts
+
+  def add_counts(self, hits: int, misses: int) -> None:
+    """Adds hits and misses counted elsewhere, e.g. in a worker process."""
+    with self._lock:
+      self.hits += hits
+      self.misses += misses
+
+  def _read(self, path: str) -> Optional[bytes]:
+    try:
+      with open(path, "rb") as f:
+        data = f.read()
+      os.utime(path)
+    except OSError:
+      return None
+    return data
+
+  def _write(self, path: str, data: bytes) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+      f.write(data)
+    os.replace(tmp_path, path)
+    self._evict(len(data))
+
+  def _entries(self) -> list[Tuple[float, int, str]]:
+    entries = []
+    for directory, _, filenames in os.walk(self.root):
+      for filename in filenames:
+        if filename.endswith(".tmp"):
+          continue
+        path = os.path.join(directory, filename)
+        try:
+          stat = os.stat(path)
+        except OSError:
+          continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+    return entries
+
+  def _evict(self, added_bytes: int) -> None:
+    with self._lock:
+      if self._size is None:
+        self._size = sum(size for _, size, _ in self._entries())
+      else:
+        self._size += added_bytes
+      if self._size <= self.max_bytes:
+        return
+      entries = sorted(self._entries())
+      self._size = sum(size for _, size, _ in entries)
+      # Evict down to 90% of the bound so that eviction is not rerun on
+      # every write.
+      for _, size, path in entries:
+        if self._size <= 0.9 * self.max_bytes:
+          break
+        try:
+          os.remove(path)
+        except OSError:
+          continue
+        self._size -= size
+
+  def get_listing(
+      self, prefix: str, max_age_seconds: float
+  ) -> Optional[list[ManifestRef]]:
+    """Returns the cached listing of `prefix` if younger than max_age."""
+    data = self._read(self._path("listings", prefix, ".json"))
+    listing = None
+    if data is not None:
+      try:
+        listing = json.loads(data)
+      except ValueError:
+        pass
+    if listing is None or time.time() - listing["listed_at"] > max_age_seconds:
+      self._count(hit=False)
+      return None
+    self._count(hit=True)
+    return [ManifestRef(*blob) for blob in listing["blobs"]]
+
+  def put_listing(self, prefix: str, refs: list[ManifestRef]) -> None:
+    """Stores the listing of `prefix`."""
+    listing = {"listed_at": time.time(), "blobs": [list(ref) for ref in refs]}
+    self._write(
+        self._path("listings", prefix, ".json"),
+        json.dumps(listing).encode("utf-8"),
+    )
+
+  def _tiles_path(self, ref: ManifestRef) -> str:
+    return self._path(
+        "tiles", f"{ref.name}#{ref.generation}#{ref.md5_hash}", ".npz"
+    )
+
+  def get_tiles(
+      self, ref: ManifestRef
+  ) -> Optional[TileTable]:
+    """Returns the cached (urls, bounds, crs) of the manifest `ref`."""
+    data = self._read(self._tiles_path(ref))
+    tiles = None
+    if data is not None:
+      try:
+        with np.load(io.BytesIO(data), allow_pickle=False) as npz:
+          urls = npz["urls"].tobytes().decode("utf-8")
+          tiles = TileTable(
+              np.asarray(urls.split("\n") if urls else [], dtype=object),
+              npz["bounds"],
+              str(npz["crs"]) or None,
+          )
+      except (OSError, ValueError, KeyError):
+        pass
+    self._count(hit=tiles is not None)
+    return tiles
+
+  def put_tiles(
+      self,
+      ref: ManifestRef,
+      urls: np.ndarray,
+      bounds: np.ndarray,
+      crs: Optional[str],
+  ) -> None:
+    """Stores the (urls, bounds, crs) parsed from the manifest `ref`."""
+    buffer = io.BytesIO()
+    np.savez(
+        buffer,
+        urls=np.frombuffer("\n".join(urls).encode("utf-8"), dtype=np.uint8),
+        bounds=bounds,
+        crs=np.asarray(crs or ""),
+    )
+    self._write(self._tiles_path(ref), buffer.getvalue())
+
+
+manifest_cache = ManifestCache(_CACHE_DIR)
+
+# Anonymous client of the public bucket, see `get_storage_client`.
+storage_client = None
+_storage_client_lock = threading.Lock()
+
+
+def get_storage_client() -> storage.Client:
+  """Returns the shared anonymous storage client, creating it on first use."""
+  global storage_client
+  with _storage_client_lock:
+    if storage_client is None:
+      storage_client = storage.Client(
+          credentials=credentials.AnonymousCredentials()
+      )
+    return storage_client
+
+
+def list_manifest_refs(prefix: str) -> list[ManifestRef]:
+  """Lists the manifests under `prefix`, from the cache when fresh."""
+  with metrics.get_metrics().stage("listing"):
+    refs = manifest_cache.get_listing(prefix, _LISTING_CACHE_MAX_AGE_SECONDS)
+    if refs is None:
+      refs = [
+          ManifestRef(blob.name, blob.generation, blob.md5_hash, blob.size)
+          for blob in get_storage_client().list_blobs(
+              _GCS_BUCKET,
+              prefix=prefix,
+              fields="items(name,generation,md5Hash,size),nextPageToken",
+          )
+      ]
+      manifest_cache.put_listing(prefix, refs)
+    return refs
+
+
+def get_manifest_s2_token(manifest_ref: ManifestRef) -> str:
+  """Returns the s2_token of the cell a manifest covers."""
+  return os.path.basename(manifest_ref.name).split("_")[0]
+
+
+def get_matching_manifest_blobs(
+    s2_token: str, years: Iterable[int]
+) -> list[ManifestRef]:
+  """Returns a list of manifest blobs for the given s2_token and years."""
+  matching_manifest_blobs = []
+  token_manifest_blobs = list_manifest_refs(
+      os.path.join(_DATASET_VERSION, _GCS_MANIFESTS_FOLDER, f'{s2_token}_')
+  )
+  for year in years:
+    filtered_token_manifests = [
+        blob for blob in token_manifest_blobs if f'_{str(year)}_' in blob.name
+    ]
+    matching_manifest_blobs.extend(filtered_token_manifests)
+  return matching_manifest_blobs
+
+
+def get_num_workers(executor_kind: str) -> int:
+  """Returns the default number of workers for `executor_kind`."""
+  if executor_kind == "thread":
+    return _MAX_NUM_THREADS
+  try:
+    # Honors CPU affinity masks and container CPU sets.
+    return len(os.sched_getaffinity(0))
+  except AttributeError:
+    return os.cpu_count() or 1
+
+
+def make_process_pool(
+    num_workers: int,
+    initializer: Optional[Callable] = None,
+    initargs: tuple[Any, ...] = (),
+) -> multiprocessing.pool.Pool:
+  """Returns a process pool that is safe to create while threads run.
+
+  Workers are started from a fork server (or spawned where there is none)
+  instead of being forked from this process, whose threads (progress bars,
+  download pools) may hold locks at fork time. Workers therefore only see
+  module-level functions and receive any other state through `initializer`
+  and `initargs`.
+  """
+  if "forkserver" in multiprocessing.get_all_start_methods():
+    context = multiprocessing.get_context("forkserver")
+    if __name__ != "__main__":
+      # Import this module once in the fork server rather than per worker.
+      context.set_forkserver_preload([__name__])
+  else:
+    context = multiprocessing.get_context("spawn")
+  return context.Pool(
+      processes=num_workers, initializer=initializer, initargs=initargs
+  )
+
+
+def _call_in_stage(stage: str, fn: Callable, *args: Any) -> Any:
+  with metrics.get_metrics().stage(stage):
+    return fn(*args)
+
+
+# (drained metrics, (manifest cache hits, misses)) of a worker process, see
+# `_call_in_worker`.
+WorkerCounts = Tuple[dict[str, Any], Tuple[int, int]]
+
+
+def _call_in_worker(fn: Callable, *args: Any) -> Tuple[Any, WorkerCounts]:
+  """Returns the result of `fn` in a process pool worker with the metrics
+  and manifest cache hits and misses the worker recorded since its last
+  task, for the parent to merge (see `_merge_worker_counts`)."""
+  return fn(*args), (
+      metrics.get_metrics().drain(),
+      manifest_cache.take_counts(),
+  )
+
+
+def _merge_worker_counts(worker_counts: WorkerCounts) -> None:
+  """Adds the counts returned by `_call_in_worker` to this process's."""
+  worker_metrics, cache_counts = worker_counts
+  metrics.get_metrics().merge(worker_metrics)
+  manifest_cache.add_counts(*cache_counts)
+
+
+def _apply_in_worker(
+    pool: multiprocessing.pool.Pool, fn: Callable, args: tuple[Any, ...]
+) -> Any:
+  """Like `pool.apply(fn, args)`, merging the worker's counts into ours."""
+  result, worker_counts = pool.apply(_call_in_worker, (fn, *args))
+  _merge_worker_counts(worker_counts)
+  return result
+
+
+def _imap_fetched(
+    pool: multiprocessing.pool.Pool,
+    fn: Callable,
+    fetch_fn: Callable,
+    items: Iterable[Any],
+    num_threads: int,
+) -> Iterator[Any]:
+  """Yields `fn(fetch_fn(item))` for `items` in order, running `fn` on `pool`.
+
+  Items are fetched on `num_threads` threads, each of which hands its
+  fetched value to `pool` and waits for the result. At most
+  `2 * num_threads` items are in flight, so fetched values cannot pile up
+  in memory while the process pool is busy.
+  """
+  items = iter(items)
+  in_flight = collections.deque()
+  with ThreadPool(processes=num_threads) as thread_pool:
+
+    def submit_next() -> None:
+      for item in itertools.islice(items, 1):
+        in_flight.append(
+            thread_pool.apply_async(
+                lambda item=item: pool.apply(fn, (fetch_fn(item),))
+            )
+        )
+
+    for _ in range(2 * num_threads):
+      submit_next()
+    while in_flight:
+      result = in_flight.popleft().get()
+      submit_next()
+      yield result
+
+
+def multithreaded_fn(
+    progress_bar_desc: str,
+    fn: Callable,
+    items: Iterable[Any],
+    executor_kind: str = "thread",
+    num_workers: Optional[int] = None,
+    fetch_fn: Optional[Callable] = None,
+    initializer: Optional[Callable] = None,
+    initargs: tuple[Any, ...] = (),
+):
+  """Run `fn` on `items` in parallel and display a progress bar.
+
+  Args:
+    progress_bar_desc: Description shown next to the progress bar.
+    fn: Function returning a list of results for one item. It must be
+      picklable (defined at module level) for the "process" and "hybrid"
+      kinds.
+    items: Items to process.
+    executor_kind: "thread" runs `fn` on a thread pool, "process" on a
+      process pool, and "hybrid" runs `fetch_fn` on a thread pool and `fn` on
+      a process pool on the fetched values (see `_imap_fetched`).
+    num_workers: Pool size; defaults to `get_num_workers(executor_kind)`.
+    fetch_fn: I/O-bound function for the "hybrid" kind.
+    initializer: Called with `initargs` once in every worker process, e.g.
+      to receive large arguments once per worker instead of per task.
+    initargs: Arguments for `initializer`.
+
+  Every call of `fn` is timed as one call of the `progress_bar_desc` stage
+  of the run metrics (see `metrics`), also in worker processes.
+  """
+  num_workers = num_workers or get_num_workers(executor_kind)
+  fn_results = []
+  run_item = functools.partial(_call_in_stage, progress_bar_desc, fn)
+  with tqdm.auto.tqdm(
+      total=len(items), desc=progress_bar_desc
+  ) as pbar:
+    if executor_kind == "thread":
+      with ThreadPool(processes=num_workers) as pool:
+        for result in pool.imap(run_item, items):
+          fn_results.extend(result)
+          pbar.update(1)
+      return fn_results
+    run_item = functools.partial(_call_in_worker, run_item)
+    with make_process_pool(num_workers, initializer, initargs) as pool:
+      if executor_kind == "process":
+        results = pool.imap(run_item, items)
+      elif executor_kind == "hybrid":
+        # Enough fetch threads to keep every worker busy.
+        results = _imap_fetched(
+            pool, run_item, fetch_fn, items, _MAX_NUM_THREADS + num_workers
+        )
+      else:
+        raise ValueError(f"Unknown executor kind: {executor_kind}")
+      for result, worker_counts in results:
+        _merge_worker_counts(worker_counts)
+        fn_results.extend(result)
+        pbar.update(1)
+  return fn_results
+
+
+
+def multithreaded_get_matching_manifest_blobs(
+    s2_tokens: list[str], years: Iterable[int]
+) -> list[ManifestRef]:
+  """Returns a list of manifest blobs for the given s2_tokens and years."""
+  return multithreaded_fn(
+      "Fetching matching manifests",
+      functools.partial(get_matching_manifest_blobs, years=list(years)),
+      s2_tokens,
+  )
+
+
+_MANIFEST_SOURCES_RE = re.compile(r'"sources"\s*:\s*\[')
+_MANIFEST_SEPARATOR_RE = re.compile(r"[\s,]*")
+_MANIFEST_URI_PREFIX_RE = re.compile(r'"uriPrefix"\s*:\s*("(?:[^"\\]|\\.)*")')
+_MANIFEST_CRS_RE = re.compile(r'"crs"\s*:\s*("(?:[^"\\]|\\.)*")')
+_JSON_DECODER = json.JSONDecoder()
+
+
+def _iter_manifest_sources(
+    manifest_text: str,
+) -> Iterator[dict[str, Any]]:
+  """Yields the sources of every tileset, decoding one source at a time."""
+  for match in _MANIFEST_SOURCES_RE.finditer(manifest_text):
+    position = match.end()
+    while True:
+      position = _MANIFEST_SEPARATOR_RE.match(manifest_text, position).end()
+      if manifest_text[position] == "]":
+        break
+      source, position = _JSON_DECODER.raw_decode(manifest_text, position)
+      yield source
+
+
+def _read_manifest(
+    manifest_bytes: bytes, streaming: bool
+) -> Tuple[str, Optional[str], Iterable[dict[str, Any]]]:
+  """Returns the (uri_prefix, crs, sources) of a manifest.
+
+  With `streaming`, only one source is decoded at a time and the parse tree
+  of the whole manifest is never built; otherwise the manifest is parsed at
+  once with orjson (or json when orjson is not installed).
+  """
+  if not streaming:
+    manifest = (orjson.loads if orjson else json.loads)(manifest_bytes)
+    # All tiles in a manifest should have the same projection
+    crs = manifest["tilesets"][0]["crs"] if manifest["tilesets"] else None
+    sources = (
+        source
+        for tileset in manifest["tilesets"]
+        for source in tileset["sources"]
+    )
+    return manifest.get("uriPrefix", ""), crs, sources
+  manifest_text = manifest_bytes.decode("utf-8")
+  uri_prefix = _MANIFEST_URI_PREFIX_RE.search(manifest_text)
+  crs = _MANIFEST_CRS_RE.search(manifest_text)
+  return (
+      json.loads(uri_prefix.group(1)) if uri_prefix else "",
+      json.loads(crs.group(1)) if crs else None,
+      _iter_manifest_sources(manifest_text),
+  )
+
+
+def extract_tile_bounds(
+    manifest_bytes: bytes, streaming: Optional[bool] = None
+) -> TileTable:
+  """Extracts geotiff urls and tile bounds from a manifest.
+
+  Only `affineTransform`, `dimensions`, `uris[0]` and the tileset `crs` are
+  read, straight into compact float64 columns. By default the manifest is
+  parsed at once with orjson when it is installed, and streamed source by
+  source otherwise, which keeps peak memory close to the size of the
+  manifest (see `benchmarks/bench_manifest_parsing.py`).
+
+  Args:
+    manifest_bytes: The manifest JSON.
+    streaming: Forces (True) or disables (False) streaming.
+  """
+  if streaming is None:
+    streaming = orjson is None
+  uri_prefix, crs, sources = _read_manifest(manifest_bytes, streaming)
+  translate_x, translate_y = array.array("d"), array.array("d")
+  scale_x, scale_y = array.array("d"), array.array("d")
+  width, height = array.array("d"), array.array("d")
+  urls = []
+  for source in sources:
+    affine_transform = source["affineTransform"]
+    dimensions = source["dimensions"]
+    translate_x.append(affine_transform["translateX"])
+    translate_y.append(affine_transform["translateY"])
+    scale_x.append(affine_transform["scaleX"])
+    scale_y.append(affine_transform["scaleY"])
+    width.append(dimensions["width"])
+    height.append(dimensions["height"])
+    urls.append(uri_prefix + source["uris"][0])
+
+  translate_x, translate_y, scale_x, scale_y, width, height = (
+      np.frombuffer(column, dtype=np.float64)
+      for column in (translate_x, translate_y, scale_x, scale_y, width, height)
+  )
+  # The transform is translation * scale (no rotation), so each tile is the
+  # axis-aligned box between its (0, 0) and (width, height) corners.
+  far_x = translate_x + scale_x * width
+  far_y = translate_y + scale_y * height
+  bounds = np.column_stack((
+      np.minimum(translate_x, far_x),
+      np.minimum(translate_y, far_y),
+      np.maximum(translate_x, far_x),
+      np.maximum(translate_y, far_y),
+  )).reshape(-1, 4)
+  return TileTable(np.asarray(urls, dtype=object), bounds, crs)
+
+
+def extract_tile_polygons(
+    manifest_bytes: bytes,
+) -> Tuple[np.ndarray, np.ndarray, Optional[str]]:
+  """Extracts geotiff urls and tile footprints from a manifest.
+
+  Returns:
+    A tuple of (urls, polygons, crs): `urls` and `polygons` are parallel
+    NumPy object arrays, the footprints being built in one vectorized
+    `shapely.box` call in the manifest's projection.
+  """
+  urls, bounds, crs = extract_tile_bounds(manifest_bytes)
+  return urls, shapely.box(*bounds.T), crs
+
+
+def fetch_manifest(manifest_ref: ManifestRef) -> FetchedManifest:
+  """Returns (manifest_ref, cached tiles, None), or the bytes on a miss.
+
+  This is the I/O-bound half of `get_manifest_tiles`.
+  """
+  with metrics.get_metrics().stage("manifest_fetch"):
+    tiles = manifest_cache.get_tiles(manifest_ref)
+    if tiles is not None:
+      return manifest_ref, tiles, None
+    manifest_bytes = (
+        get_storage_client().bucket(_GCS_BUCKET)
+        .blob(manifest_ref.name, generation=manifest_ref.generation)
+        .download_as_bytes()
+    )
+    return manifest_ref, None, manifest_bytes
+
+
+def parse_manifest(
+    fetched_manifest: FetchedManifest,
+) -> TileTable:
+  """Returns the (urls, bounds, crs) of a `fetch_manifest` result.
+
+  This is the CPU-bound half of `get_manifest_tiles`; parsed tiles are
+  added to the cache.
+  """
+  manifest_ref, tiles, manifest_bytes = fetched_manifest
+  if tiles is None:
+    with metrics.get_metrics().stage("parse"):
+      tiles = extract_tile_bounds(manifest_bytes)
+      manifest_cache.put_tiles(manifest_ref, *tiles)
+  return tiles
+
+
+def get_manifest_tiles(manifest_ref: ManifestRef) -> TileTable:
+  """Returns the (urls, bounds, crs) of a manifest, cached by generation."""
+  return parse_manifest(fetch_manifest(manifest_ref))
+
+
+@functools.lru_cache(maxsize=None)
+def get_transformer(crs: str) -> pyproj.Transformer:
+  """Returns the cached EPSG:4326 -> `crs` transformer."""
+  return pyproj.Transformer.from_crs("epsg:4326", crs, always_xy=True)
+
+
+# crs -> (source geometry, prepared geometry in crs). The source geometry is
+# kept so a different region with a recycled id() is never served.
+_region_in_crs_cache = {}
+
+
+def get_region_in_crs(
+    region_geometry: shapely.geometry.base.BaseGeometry, crs: str
+) -> shapely.geometry.base.BaseGeometry:
+  """Returns `region_geometry` transformed to `crs` and prepared, cached."""
+  cached = _region_in_crs_cache.get((id(region_geometry), crs))
+  if cached is not None and cached[0] is region_geometry:
+    return cached[1]
+  projected = transform(get_transformer(crs).transform, region_geometry)
+  shapely.prepare(projected)
+  _region_in_crs_cache[(id(region_geometry), crs)] = (
+      region_geometry,
+      projected,
+  )
+  return projected
+
+
+def extract_geotiff_urls(
+    manifest_blob: ManifestRef,
+    region_geometry: shapely.geometry.base.BaseGeometry,
+) -> list[str]:
+  """Extracts geotiff urls from a manifest intersecting `region_geometry`."""
+  return intersect_tiles(get_manifest_tiles(manifest_blob), region_geometry)
+
+
+def intersect_tiles(
+    tiles: TileTable,
+    region_geometry: shapely.geometry.base.BaseGeometry,
+) -> list[str]:
+  """Returns the urls of the tiles intersecting `region_geometry`."""
+  urls, bounds, crs = tiles
+  if not len(urls):
+    return []
+  with metrics.get_metrics().stage("intersect"):
+    tile_polys = shapely.box(*bounds.T)
+    # EPSG:4326 is the standard WGS84 lat/lon coordinate system. We transform
+    # region_geometry from EPSG:4326 to manifest's projection (once per CRS)
+    # before doing the intersection check on all tiles at once.
+    region_in_crs = get_region_in_crs(region_geometry, crs)
+    return urls[shapely.intersects(tile_polys, region_in_crs)].tolist()
+
+
+def assign_tiles_to_regions(
+    tiles: TileTable,
+    region_geometries: dict[str, shapely.geometry.base.BaseGeometry],
+) -> dict[str, TileTable]:
+  """Returns the tiles intersecting each region, by region name.
+
+  The tiles are indexed with an STRtree, so each region only tests the tiles
+  near it. Regions without any intersecting tile are left out.
+  """
+  urls, bounds, crs = tiles
+  if not len(urls):
+    return {}
+  with metrics.get_metrics().stage("intersect"):
+    tree = shapely.STRtree(shapely.box(*bounds.T))
+    region_tiles = {}
+    for name, region_geometry in region_geometries.items():
+      indices = tree.query(
+          get_region_in_crs(region_geometry, crs), predicate="intersects"
+      )
+      if len(indices):
+        indices = np.sort(indices)
+        region_tiles[name] = TileTable(urls[indices], bounds[indices], crs)
+    return region_tiles
+
+
+# Region geometries of a process pool worker by name, set by
+# `_init_extract_worker`.
+_worker_region_geometries = {}
+
+# Name of the region of the single-region functions.
+_REGION = "region"
+
+
+def _init_extract_worker(
+    region_wkbs: dict[str, bytes], cache_dir: str, cache_max_bytes: int
+) -> None:
+  """Process pool initializer: receives the regions once per worker as WKB."""
+  global _worker_region_geometries, manifest_cache, storage_client
+  _worker_region_geometries = {
+      name: shapely.from_wkb(region_wkb)
+      for name, region_wkb in region_wkbs.items()
+  }
+  manifest_cache = ManifestCache(cache_dir, cache_max_bytes)
+  storage_client = storage.Client(
+      credentials=credentials.AnonymousCredentials()
+  )
+
+
+def _extract_geotiff_urls_in_worker(manifest_ref: ManifestRef) -> list[str]:
+  return extract_geotiff_urls(
+      manifest_ref, _worker_region_geometries[_REGION]
+  )
+
+
+def _parse_geotiff_urls_in_worker(
+    fetched_manifest: FetchedManifest,
+) -> list[str]:
+  return intersect_tiles(
+      parse_manifest(fetched_manifest), _worker_region_geometries[_REGION]
+  )
+
+
+def _assign_tiles_in_worker(
+    manifest_ref: ManifestRef, region_names: list[str]
+) -> dict[str, TileTable]:
+  return assign_tiles_to_regions(
+      get_manifest_tiles(manifest_ref),
+      {name: _worker_region_geometries[name] for name in region_names},
+  )
+
+
+def _parse_and_assign_tiles_in_worker(
+    fetched_manifest: FetchedManifest, region_names: list[str]
+) -> dict[str, TileTable]:
+  return assign_tiles_to_regions(
+      parse_manifest(fetched_manifest),
+      {name: _worker_region_geometries[name] for name in region_names},
+  )
+
+
+def _extract_worker_initargs(
+    region_geometries: dict[str, shapely.geometry.base.BaseGeometry],
+) -> tuple[dict[str, bytes], str, int]:
+  return (
+      {
+          name: shapely.to_wkb(region_geometry)
+          for name, region_geometry in region_geometries.items()
+      },
+      manifest_cache.root,
+      manifest_cache.max_bytes,
+  )
+
+
+def multithreaded_extract_geotiff_urls(
+    manifest_blobs: list[ManifestRef],
+    region_geometry: shapely.geometry.base.BaseGeometry,
+    executor_kind: str = _EXECUTOR_KIND,
+) -> list[str]:
+  """Extracts geotiff urls from manifests."""
+  if executor_kind == "thread":
+    return multithreaded_fn(
+        "Extracting urls",
+        lambda manifest_blob: extract_geotiff_urls(
+            manifest_blob, region_geometry
+        ),
+        manifest_blobs,
+    )
+  return multithreaded_fn(
+      "Extracting urls",
+      _extract_geotiff_urls_in_worker
+      if executor_kind == "process"
+      else _parse_geotiff_urls_in_worker,
+      manifest_blobs,
+      executor_kind=executor_kind,
+      fetch_fn=fetch_manifest,
+      initializer=_init_extract_worker,
+      initargs=_extract_worker_initargs({_REGION: region_geometry}),
+  )
+
+
+def stream_region_urls_to_files(
+    filenames: dict[str, str],
+    region_geometries: dict[str, shapely.geometry.base.BaseGeometry],
+    years: Iterable[int],
+    executor_kind: str = _EXECUTOR_KIND,
+    s2_tokens: Optional[dict[str, list[str]]] = None,
+    catalog_filenames: Optional[dict[str, str]] = None,
+) -> dict[str, int]:
+  """Lists manifests, extracts urls and writes them to files as a pipeline.
+
+  The union of the regions' S2 coverings is listed once and every manifest
+  is fetched and parsed once; its tiles are then assigned to each region
+  whose covering contains the manifest's cell (see
+  `assign_tiles_to_regions`), so neighboring regions share all manifest
+  work.
+
+  Manifests are extracted as soon as their listing arrives and urls are
+  appended to their region's file (and flushed) as soon as they are
+  extracted, so everything written survives a crash partway through. The
+  stages are connected by queues of `_PIPELINE_QUEUE_SIZE` items, so a slow
+  stage holds back the one before it instead of letting results pile up.
+  With the "process" and "hybrid" executor kinds, the extraction threads
+  hand the CPU-bound work to a process pool (see `multithreaded_fn`).
+
+  The listing, manifest_fetch, parse, intersect and write stages are timed
+  in the run metrics (see `metrics`), including the work done in worker
+  processes, so the slowest stage can be told apart.
+
+  The bounds, projection, year and S2 cell of the tiles of each region can
+  also be kept in a tile catalog (see `tile_catalog`), which is written once
+  all urls are extracted.
+
+  Args:
+    filenames: Output file of each region, by region name.
+    region_geometries: EPSG:4326 geometry of each region, by region name.
+    years: Years to fetch.
+    executor_kind: See `multithreaded_fn`.
+    s2_tokens: Covering of each region, by region name; computed with
+      `get_region_s2_covering_tokens` when None.
+    catalog_filenames: Tile catalog of each region, by region name; regions
+      without one get no catalog.
+
+  Returns:
+    The number of urls written for each region, by region name.
+  """
+  years = list(years)
+  catalog_filenames = catalog_filenames or {}
+  if s2_tokens is None:
+    s2_tokens = {
+        name: get_region_s2_covering_tokens(region_geometry)
+        for name, region_geometry in region_geometries.items()
+    }
+  token_regions = collections.defaultdict(list)
+  for name, region_tokens in s2_tokens.items():
+    for s2_token in region_tokens:
+      token_regions[s2_token].append(name)
+
+  manifest_queue = queue.Queue(maxsize=_PIPELINE_QUEUE_SIZE)
+  # Items are ("listed", count), ("tiles", (manifest_ref, tiles by region
+  # name)) or ("error", exception); None marks the end of the pipeline.
+  result_queue = queue.Queue(maxsize=_PIPELINE_QUEUE_SIZE)
+
+  def list_manifests(s2_token: str) -> None:
+    try:
+      manifest_refs = get_matching_manifest_blobs(s2_token, years)
+    except Exception as e:  # pylint: disable=broad-exception-caught
+      result_queue.put(("error", e))
+      return
+    result_queue.put(("listed", len(manifest_refs)))
+    for manifest_ref in manifest_refs:
+      manifest_queue.put((manifest_ref, token_regions[s2_token]))
+
+  process_pool = None
+  num_extractors = _MAX_NUM_THREADS
+  if executor_kind == "thread":
+    extract = lambda manifest_ref, region_names: assign_tiles_to_regions(
+        get_manifest_tiles(manifest_ref),
+        {name: region_geometries[name] for name in region_names},
+    )
+  else:
+    num_workers = get_num_workers(executor_kind)
+    process_pool = make_process_pool(
+        num_workers,
+        _init_extract_worker,
+        _extract_worker_initargs(region_geometries),
+    )
+    # Enough threads to keep every worker busy while others are fetching.
+    num_extractors = _MAX_NUM_THREADS + num_workers
+    if executor_kind == "process":
+      extract = lambda manifest_ref, region_names: _apply_in_worker(
+          process_pool, _assign_tiles_in_worker, (manifest_ref, region_names)
+      )
+    elif executor_kind == "hybrid":
+      extract = lambda manifest_ref, region_names: _apply_in_worker(
+          process_pool,
+          _parse_and_assign_tiles_in_worker,
+          (fetch_manifest(manifest_ref), region_names),
+      )
+    else:
+      process_pool.terminate()
+      raise ValueError(f"Unknown executor kind: {executor_kind}")
+
+  def extract_urls() -> None:
+    while (item := manifest_queue.get()) is not None:
+      try:
+        result_queue.put(("tiles", (item[0], extract(*item))))
+      except Exception as e:  # pylint: disable=broad-exception-caught
+        result_queue.put(("error", e))
+
+  def run_stages() -> None:
+    extractors = [
+        threading.Thread(target=extract_urls, daemon=True)
+        for _ in range(num_extractors)
+    ]
+    for extractor in extractors:
+      extractor.start()
+    with ThreadPool(processes=_MAX_NUM_THREADS) as pool:
+      pool.map(list_manifests, sorted(token_regions))
+    for _ in extractors:
+      manifest_queue.put(None)
+    for extractor in extractors:
+      extractor.join()
+    result_queue.put(None)
+
+  threading.Thread(target=run_stages, daemon=True).start()
+  num_urls = {name: 0 for name in filenames}
+  catalogs = {
+      name: tile_catalog.TileCatalogWriter() for name in catalog_filenames
+  }
+  errors = []
+  with contextlib.ExitStack() as stack:
+    files = {
+        name: stack.enter_context(open(filename, "w"))
+        for name, filename in filenames.items()
+    }
+    pbar = stack.enter_context(
+        tqdm.auto.tqdm(total=0, desc="Extracting urls")
+    )
+    while (item := result_queue.get()) is not None:
+      kind, value = item
+      if kind == "listed":
+        pbar.total += value
+        pbar.refresh()
+      elif kind == "tiles":
+        manifest_ref, region_tiles = value
+        with metrics.get_metrics().stage("write"):
+          for name, tiles in region_tiles.items():
+            files[name].writelines(f"{url}\n" for url in tiles.urls)
+            files[name].flush()
+            num_urls[name] += len(tiles.urls)
+            if name in catalogs:
+              catalogs[name].add(
+                  *tiles,
+                  get_tile_year(manifest_ref.name, years),
+                  get_manifest_s2_token(manifest_ref),
+              )
+        pbar.update(1)
+      else:
+        errors.append(value)
+  if process_pool is not None:
+    process_pool.close()
+    process_pool.join()
+  if errors:
+    raise errors[0]
+  for name, catalog in catalogs.items():
+    with metrics.get_metrics().stage("write"):
+      catalog.write(catalog_filenames[name])
+  return num_urls
+
+
+def stream_geotiff_urls_to_file(
+    filename: str,
+    s2_tokens: list[str],
+    region_geometry: shapely.geometry.base.BaseGeometry,
+    years: Iterable[int],
+    executor_kind: str = _EXECUTOR_KIND,
+    catalog_filename: Optional[str] = None,
+) -> int:
+  """Writes the urls of one region to `filename` as a pipeline.
+
+  See `stream_region_urls_to_files`; the region's tile catalog is written to
+  `catalog_filename` when given.
+
+  Returns:
+    The number of urls written.
+  """
+  return stream_region_urls_to_files(
+      {_REGION: filename},
+      {_REGION: region_geometry},
+      years,
+      executor_kind,
+      {_REGION: s2_tokens},
+      {_REGION: catalog_filename} if catalog_filename else None,
+  )[_REGION]
+
+
+def write_to_file(filename: str, urls: list[str]) -> None:
+  """Writes urls to file."""
+  with open(filename, "w") as f:
+    for url in urls:
+      f.write(f"{url}\n")
+
+
+def read_from_file(filename: str) -> list[str]:
+  """Reads urls written by `write_to_file`."""
+  with open(filename) as f:
+    return [line.strip() for line in f if line.strip()]
+
+
+def get_gdal_path(url: str) -> str:
+  """Returns the GDAL path reading `url` with HTTP range requests.
+
+  gs:// urls are read anonymously through the public storage.googleapis.com
+  endpoint.
+  """
+  parsed_url = urllib.parse.urlparse(url)
+  if parsed_url.scheme == "gs":
+    url = f"https://storage.googleapis.com/{parsed_url.netloc}{parsed_url.path}"
+  elif parsed_url.scheme not in ("http", "https"):
+    return url
+  return f"/vsicurl/{url}"
+
+
+def clip_geotiff(
+    url: str,
+    region_geometry: shapely.geometry.base.BaseGeometry,
+    output_dir: str,
+    write_mask: bool = True,
+) -> list[Tuple[str, int, int]]:
+  """Downloads the part of a geotiff covering `region_geometry`.
+
+  Only the window of the tile covering the region is read, so GDAL fetches
+  just the internal blocks of that window. The window is written as a tiled
+  geotiff under `output_dir`, mirroring the path of `url`, with the region
+  as its mask if `write_mask` is set. Existing outputs are kept.
+
+  Returns:
+    [(output_path, window_pixels, tile_pixels)], or [] if the tile does not
+    intersect the region.
+  """
+  output_path = os.path.join(
+      output_dir, urllib.parse.urlparse(url).path.lstrip("/")
+  )
+  with rasterio.Env(**_GDAL_COG_READ_OPTIONS):
+    with rasterio.open(get_gdal_path(url)) as src:
+      tile_pixels = src.width * src.height
+      region_in_crs = get_region_in_crs(region_geometry, src.crs.to_string())
+      clip_geometry = region_in_crs.intersection(box(*src.bounds))
+      if clip_geometry.is_empty:
+        return []
+      try:
+        window = rasterio.features.geometry_window(src, [clip_geometry])
+      except rasterio.errors.WindowError:
+        return []
+      window_pixels = int(window.width) * int(window.height)
+      if os.path.exists(output_path):
+        return [(output_path, window_pixels, tile_pixels)]
+      data = src.read(window=window)
+      window_transform = src.window_transform(window)
+      profile = src.profile.copy()
+      profile.update(
+          driver="GTiff",
+          width=data.shape[2],
+          height=data.shape[1],
+          transform=window_transform,
+          tiled=True,
+          blockxsize=256,
+          blockysize=256,
+          compress="deflate",
+      )
+
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    tmp_path = f"{output_path}.{threading.get_ident()}.tmp.tif"
+    with rasterio.open(tmp_path, "w", **profile) as dst:
+      dst.write(data)
+      if write_mask:
+        region_mask = rasterio.features.geometry_mask(
+            [clip_geometry],
+            out_shape=data.shape[1:],
+            transform=window_transform,
+            invert=True,
+        )
+        dst.write_mask(region_mask.astype(np.uint8) * 255)
+  os.replace(tmp_path, output_path)
+  return [(output_path, window_pixels, tile_pixels)]
+
+
+def get_tile_year(path: str, years: Iterable[int]) -> Optional[int]:
+  """Returns the first of `years` found in a tile's path or url, if any."""
+  years = set(years)
+  for match in re.finditer(r"(?<!\d)(\d{4})(?!\d)", path):
+    if int(match.group(1)) in years:
+      return int(match.group(1))
+  return None
+
+
+def group_tiles_by_year(
+    paths: Iterable[str], years: Iterable[int]
+) -> dict[int, list[str]]:
+  """Groups tile paths by the year found in them; others are dropped."""
+  years = list(years)
+  tiles_by_year = collections.defaultdict(list)
+  for path in paths:
+    year = get_tile_year(path, years)
+    if year is not None:
+      tiles_by_year[year].append(path)
+  return dict(tiles_by_year)
+
+
+def get_mosaic_block_size(
+    memory_bytes: int, num_bands: int, dtype: str
+) -> int:
+  """Returns the side of the square mosaic blocks fitting `memory_bytes`.
+
+  A block is held up to four times at once (the merged block and the
+  windows read from the source tiles), and its side is a multiple of the
+  256-pixel internal tiles so that each internal tile is written once.
+  """
+  bytes_per_pixel = num_bands * np.dtype(dtype).itemsize
+  block_size = math.isqrt(memory_bytes // (4 * bytes_per_pixel))
+  return max(256, block_size // 256 * 256)
+
+
+def mosaic_tiles(
+    paths: list[str],
+    output_path: str,
+    memory_bytes: int = _MOSAIC_MEMORY_BYTES,
+    nodata: Optional[float] = None,
+) -> str:
+  """Merges geotiff tiles into one cloud optimized geotiff, block by block.
+
+  The mosaic uses the most common projection and resolution of the tiles;
+  tiles in other projections are warped on the fly. Tile footprints are read
+  from the tile headers and indexed with an STRtree, and each output block
+  only opens and reads the tiles overlapping it. The blocks are written to a
+  tiled intermediate geotiff which is then copied to `output_path` with the
+  GDAL COG driver, adding overviews.
+
+  Args:
+    paths: Paths of the tiles.
+    output_path: Path of the mosaic.
+    memory_bytes: Memory budget of one block, see `get_mosaic_block_size`.
+    nodata: Nodata value of the mosaic. Defaults to the nodata value of the
+      tiles (0 if they have none); a ValueError is raised if the tiles do
+      not all have the same one.
+
+  Returns:
+    `output_path`.
+  """
+  tile_crs, tile_bounds, tile_res, tile_nodata = [], [], [], []
+  for path in paths:
+    with rasterio.open(path) as src:
+      tile_crs.append(src.crs)
+      tile_bounds.append(src.bounds)
+      tile_res.append(src.res)
+      tile_nodata.append(src.nodata)
+      num_bands, dtype = src.count, src.dtypes[0]
+  if nodata is None:
+    # Compared as strings so that NaN matches NaN.
+    if len({str(value) for value in tile_nodata}) > 1:
+      raise ValueError(
+          "Tiles have different nodata values"
+          f" {sorted({str(value) for value in tile_nodata})}; pass `nodata`."
+      )
+    nodata = 0 if tile_nodata[0] is None else tile_nodata[0]
+  crs = collections.Counter(tile_crs).most_common(1)[0][0]
+  x_res, y_res = tile_res[tile_crs.index(crs)]
+  bounds = np.asarray([
+      tile_bounds[i]
+      if tile_crs[i] == crs
+      else rasterio.warp.transform_bounds(tile_crs[i], crs, *tile_bounds[i])
+      for i in range(len(paths))
+  ])
+  tree = shapely.STRtree(shapely.box(*bounds.T))
+  left, bottom = bounds[:, :2].min(axis=0)
+  right, top = bounds[:, 2:].max(axis=0)
+  width = math.ceil((right - left) / x_res)
+  height = math.ceil((top - bottom) / y_res)
+  mosaic_transform = rasterio.transform.from_origin(left, top, x_res, y_res)
+  block_size = get_mosaic_block_size(memory_bytes, num_bands, dtype)
+
+  os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+  tmp_path = f"{output_path}.tmp.tif"
+  with rasterio.Env(GDAL_CACHEMAX=max(16, memory_bytes // 4 // 2**20)):
+    with rasterio.open(
+        tmp_path,
+        "w",
+        driver="GTiff",
+        width=width,
+        height=height,
+        count=num_bands,
+        dtype=dtype,
+        crs=crs,
+        transform=mosaic_transform,
+        nodata=nodata,
+        tiled=True,
+        blockxsize=256,
+        blockysize=256,
+        compress="deflate",
+        BIGTIFF="IF_SAFER",
+    ) as dst:
+      for row_off in range(0, height, block_size):
+        for col_off in range(0, width, block_size):
+          window = rasterio.windows.Window(
+              col_off,
+              row_off,
+              min(block_size, width - col_off),
+              min(block_size, height - row_off),
+          )
+          block_bounds = rasterio.windows.bounds(window, mosaic_transform)
+          overlapping = tree.query(
+              shapely.box(*block_bounds), predicate="intersects"
+          )
+          if not len(overlapping):
+            continue
+          with contextlib.ExitStack() as stack:
+            sources = []
+            for i in sorted(overlapping):
+              src = stack.enter_context(rasterio.open(paths[i]))
+              if tile_crs[i] != crs:
+                src = stack.enter_context(rasterio.vrt.WarpedVRT(src, crs=crs))
+              sources.append(src)
+            merged, _ = rasterio.merge.merge(
+                sources,
+                bounds=block_bounds,
+                res=(x_res, y_res),
+                nodata=nodata,
+                dtype=dtype,
+            )
+          block = merged
+          if block.shape[1:] != (window.height, window.width):
+            # `merge` sizes its output as round(extent / res), which can be
+            # off by a pixel; fit it onto the window so the block is whole.
+            block = np.full(
+                (num_bands, window.height, window.width), nodata, dtype=dtype
+            )
+            rows = min(merged.shape[1], window.height)
+            cols = min(merged.shape[2], window.width)
+            block[:, :rows, :cols] = merged[:, :rows, :cols]
+          dst.write(block, window=window)
+    rasterio.shutil.copy(
+        tmp_path,
+        output_path,
+        driver="COG",
+        compress="deflate",
+        overview_resampling="nearest",
+        BIGTIFF="IF_SAFER",
+    )
+  os.remove(tmp_path)
+  return output_path
+
+
+def multithreaded_mosaic_tiles(
+    tiles_by_year: dict[int, list[str]], output_dir: str
+) -> list[str]:
+  """Mosaics each year's tiles, `_MAX_NUM_MOSAICS` years at a time."""
+  return multithreaded_fn(
+      "Mosaicking tiles",
+      lambda year: [
+          mosaic_tiles(
+              tiles_by_year[year], os.path.join(output_dir, f"{year}.tif")
+          )
+      ],
+      sorted(tiles_by_year),
+      num_workers=_MAX_NUM_MOSAICS,
+  )
+
+
+def multithreaded_clip_geotiffs(
+    urls: list[str],
+    region_geometry: shapely.geometry.base.BaseGeometry,
+    output_dir: str,
+    write_mask: bool = True,
+) -> list[Tuple[str, int, int]]:
+  """Downloads clipped geotiffs, `_MAX_NUM_DOWNLOADS` at a time."""
+  return multithreaded_fn(
+      "Downloading clipped tiles",
+      lambda url: clip_geotiff(url, region_geometry, output_dir, write_mask),
+      urls,
+      num_workers=_MAX_NUM_DOWNLOADS,
+  )
+
+
+def load_region_geometries(
+    boundaries: str, iso_a3_codes: Optional[Iterable[str]] = None
+) -> dict[str, shapely.geometry.base.BaseGeometry]:
+  """Returns the geometry of each country of a boundaries source, by ISO_A3.
+
+  `boundaries` is either the name of one of
+  `region_boundaries.BOUNDARY_SOURCES`, whose indexed store is used, or the
+  path of an admin 0 boundaries file, which is read once for all countries.
+  All countries with an ISO_A3 code are returned when `iso_a3_codes` is None.
+  """
+  if boundaries in region_boundaries.BOUNDARY_SOURCES:
+    store = region_boundaries.get_store(boundaries)
+    if iso_a3_codes is None:
+      iso_a3_codes = store.codes()
+    return {iso_a3: store.get(iso_a3) for iso_a3 in iso_a3_codes}
+  region_df = region_boundaries.read_boundaries_file(boundaries, iso_a3_codes)
+  return dict(zip(region_df.index, region_df.geometry))
+
+
+def get_region_urls(
+    region_geometries: dict[str, shapely.geometry.base.BaseGeometry],
+    years: Iterable[int],
+    output_dir: str,
+    executor_kind: str = _EXECUTOR_KIND,
+    catalog_format: Optional[str] = None,
+) -> dict[str, int]:
+  """Writes the geotiff urls of each region to `output_dir`/<name>.txt.
+
+  With a `catalog_format` ("fgb" or "parquet"), the tile catalog of each
+  region is also written to `output_dir`/<name>.<catalog_format>.
+
+  Returns:
+    The number of urls written for each region, by region name.
+  """
+  os.makedirs(output_dir, exist_ok=True)
+  catalog_filenames = None
+  if catalog_format is not None:
+    catalog_filenames = {
+        name: os.path.join(output_dir, f"{name}.{catalog_format}")
+        for name in region_geometries
+    }
+  return stream_region_urls_to_files(
+      {
+          name: os.path.join(output_dir, f"{name}.txt")
+          for name in region_geometries
+      },
+      region_geometries,
+      years,
+      executor_kind,
+      catalog_filenames=catalog_filenames,
+  )
+
+
+def main(argv: Optional[list[str]] = None) -> None:
+  parser = argparse.ArgumentParser(
+      description=(
+          "Writes the Open Buildings temporal geotiff urls of many regions,"
+          " one file per region, sharing all manifest work between regions."
+      )
+  )
+  parser.add_argument(
+      "--boundaries",
+      help="Boundary source name (one of: "
+      + ", ".join(region_boundaries.BOUNDARY_SOURCES)
+      + ") or admin 0 boundaries file with an ISO_A3 column.",
+  )
+  parser.add_argument(
+      "--regions",
+      nargs="*",
+      help="ISO_A3 codes of the countries; all countries of --boundaries by"
+      " default.",
+  )
+  parser.add_argument(
+      "--wkt",
+      action="append",
+      default=[],
+      metavar="NAME=WKT",
+      help="Additional EPSG:4326 region as a WKT polygon; may be repeated.",
+  )
+  parser.add_argument(
+      "--years", nargs="+", type=int, default=list(range(2016, 2024))
+  )
+  parser.add_argument("--output-dir", required=True)
+  parser.add_argument(
+      "--executor",
+      choices=["thread", "process", "hybrid"],
+      default=_EXECUTOR_KIND,
+  )
+  parser.add_argument(
+      "--catalog",
+      choices=["fgb", "parquet"],
+      help="Also write a tile catalog of each region in this format.",
+  )
+  parser.add_argument(
+      "--metrics",
+      default=metrics.METRICS_FILE,
+      help="Write the run metrics to this file: Prometheus text for .prom"
+      " or .txt, JSON otherwise.",
+  )
+  args = parser.parse_args(argv)
+
+  region_geometries = {}
+  if args.boundaries:
+    region_geometries.update(
+        load_region_geometries(args.boundaries, args.regions)
+    )
+  elif args.regions:
+    parser.error("--regions needs --boundaries")
+  for region_wkt in args.wkt:
+    name, _, wkt = region_wkt.partition("=")
+    region_geometries[name] = shapely.from_wkt(wkt)
+  if not region_geometries:
+    parser.error("no regions given; use --boundaries and/or --wkt")
+
+  start = time.monotonic()
+  num_urls = get_region_urls(
+      region_geometries,
+      args.years,
+      args.output_dir,
+      args.executor,
+      args.catalog,
+  )
+  print(
+      f"Wrote {sum(num_urls.values())} urls for {len(num_urls)} regions to"
+      f" {args.output_dir} in {time.monotonic() - start:.0f}s (manifest"
+      f" cache: {manifest_cache.hits} hits, {manifest_cache.misses} misses)."
+  )
+  metrics.get_metrics().report(args.metrics)
+
+
+if __name__ == "__main__":
+  main()
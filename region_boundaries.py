@@ -0,0 +1,272 @@
+"""Indexed local store of country boundaries for region selection.
+
+Each boundary source (a zipped admin 0 shapefile) is downloaded once,
+checksum-verified, and converted into a compact store made of:
+
+  <source>.wkb         The WKB of every country, dissolved by ISO_A3,
+                       concatenated.
+  <source>.index.json  ISO_A3 -> (offset, length, sha256, bounds) of its WKB.
+
+Looking up a country then reads the small index and one WKB record,
+instead of reading and dissolving the whole shapefile.
+"""
+
+import functools
+import hashlib
+import json
+import os
+import re
+import shutil
+from typing import Iterable, NamedTuple, Optional
+import zipfile
+
+import geopandas as gpd
+import shapely
+
+from download_engine import get_engine
+from sync_state import file_sha256
+
+BOUNDARIES_CACHE_DIR = os.environ.get(
+    "OPEN_BUILDINGS_BOUNDARIES_DIR",
+    os.path.join(
+        os.path.expanduser("~"), ".cache", "open_buildings", "boundaries"
+    ),
+)
+
+# Version of the store layout; stores of another version are rebuilt.
+_STORE_VERSION = 1
+
+
+class BoundarySource(NamedTuple):
+  """A downloadable admin 0 boundaries file."""
+
+  url: str
+  # Path of the shapefile inside the zip, or None to read the zip directly.
+  shapefile: Optional[str] = None
+  # Expected SHA-256 of the download. When None, the digest of the first
+  # download that parses as a boundaries file is recorded and later copies
+  # are verified against it.
+  sha256: Optional[str] = None
+
+
+BOUNDARY_SOURCES = {
+    "Natural Earth (Low Res 110m)": BoundarySource(
+        "https://naciscdn.org/naturalearth/"
+        "110m/cultural/ne_110m_admin_0_countries.zip"
+    ),
+    "Natural Earth (High Res 10m)": BoundarySource(
+        "https://naciscdn.org/naturalearth/"
+        "10m/cultural/ne_10m_admin_0_countries.zip"
+    ),
+    "World Bank (High Res 10m)": BoundarySource(
+        "https://datacatalogfiles.worldbank.org/ddh-published/"
+        "0038272/DR0046659/wb_countries_admin0_10m.zip",
+        shapefile="WB_countries_Admin0_10m",
+    ),
+}
+
+
+def _slug(source_name: str) -> str:
+  return re.sub(r"[^a-z0-9]+", "_", source_name.lower()).strip("_")
+
+
+def fetch_source(
+    source_name: str, cache_dir: str = BOUNDARIES_CACHE_DIR
+) -> str:
+  """Returns the path of the verified download of a boundary source.
+
+  The file is downloaded once (resumably, with retries) and kept in
+  `cache_dir`. Its SHA-256 is checked against the source's pinned digest or,
+  when none is pinned, against the digest recorded at the first download; a
+  cached copy that fails the check is downloaded again. A digest is only
+  recorded for a download that reads as a boundaries file with ISO_A3 codes
+  (see `read_countries`), so a truncated or wrong file is never trusted.
+
+  Raises:
+    ValueError: If a fresh download does not match the expected digest, or
+      there is none and the download cannot be read.
+  """
+  source = BOUNDARY_SOURCES[source_name]
+  path = os.path.join(cache_dir, os.path.basename(source.url))
+  digest_path = f"{path}.sha256"
+  expected = source.sha256
+  if expected is None and os.path.exists(digest_path):
+    with open(digest_path) as f:
+      expected = f.read().strip()
+  if os.path.exists(path):
+    if expected is None or file_sha256(path) == expected:
+      return path
+    os.remove(path)
+  get_engine().download(source.url, path)
+  digest = file_sha256(path)
+  if expected is not None and digest != expected:
+    os.remove(path)
+    raise ValueError(
+        f"Checksum mismatch for {source.url}: expected {expected}, got"
+        f" {digest}."
+    )
+  if expected is None:
+    try:
+      read_countries(source_name, path, cache_dir)
+    except Exception as e:
+      os.remove(path)
+      raise ValueError(
+          f"Download of {source.url} is not a readable boundaries file: {e}"
+      ) from e
+  with open(digest_path, "w") as f:
+    f.write(f"{digest}\n")
+  return path
+
+
+def read_boundaries_file(
+    path: str, iso_a3_codes: Optional[Iterable[str]] = None
+) -> gpd.GeoDataFrame:
+  """Reads an admin 0 boundaries file into one geometry per country.
+
+  Args:
+    path: Any file GeoPandas can read with an ISO_A3 column.
+    iso_a3_codes: Countries to keep; all countries when None.
+
+  Returns:
+    The countries' geometries indexed by ISO_A3, rows without a valid code
+    dropped and rows with the same code dissolved.
+
+  Raises:
+    ValueError: If the file has no ISO_A3 column.
+  """
+  region_df = gpd.read_file(path)
+  if "ISO_A3" not in region_df.columns:
+    raise ValueError(f"{path} has no ISO_A3 column.")
+  # Some files have rows without a code (null ISO_A3).
+  region_df = region_df[
+      region_df["ISO_A3"].str.fullmatch("[A-Z]{3}", na=False)
+  ]
+  if iso_a3_codes is not None:
+    region_df = region_df[region_df["ISO_A3"].isin(list(iso_a3_codes))]
+  return region_df.dissolve(by="ISO_A3")[["geometry"]]
+
+
+def read_countries(
+    source_name: str, zip_path: str, cache_dir: str = BOUNDARIES_CACHE_DIR
+) -> gpd.GeoDataFrame:
+  """Reads the countries of a downloaded boundary source, by ISO_A3.
+
+  Returns:
+    The countries, see `read_boundaries_file`.
+
+  Raises:
+    ValueError: If the file has no country with a valid ISO_A3 code.
+  """
+  source = BOUNDARY_SOURCES[source_name]
+  read_path = zip_path
+  extract_dir = None
+  if source.shapefile is not None:
+    extract_dir = os.path.join(cache_dir, f"{_slug(source_name)}.extracted")
+    with zipfile.ZipFile(zip_path) as archive:
+      archive.extractall(extract_dir)
+    read_path = os.path.join(extract_dir, source.shapefile)
+  try:
+    region_df = read_boundaries_file(read_path)
+  finally:
+    if extract_dir is not None:
+      shutil.rmtree(extract_dir, ignore_errors=True)
+  if region_df.empty:
+    raise ValueError(f"{zip_path} has no country with an ISO_A3 code.")
+  return region_df
+
+
+def build_store(
+    source_name: str, cache_dir: str = BOUNDARIES_CACHE_DIR
+) -> str:
+  """Converts a boundary source into the indexed WKB store.
+
+  Returns:
+    The path of the store's index.
+  """
+  zip_path = fetch_source(source_name, cache_dir)
+  region_df = read_countries(source_name, zip_path, cache_dir)
+
+  base_path = os.path.join(cache_dir, _slug(source_name))
+  index = {
+      "version": _STORE_VERSION,
+      "source_sha256": file_sha256(zip_path),
+      "regions": {},
+  }
+  offset = 0
+  with open(f"{base_path}.wkb.tmp", "wb") as f:
+    for iso_a3, geometry in zip(region_df.index, region_df.geometry):
+      wkb = shapely.to_wkb(geometry)
+      f.write(wkb)
+      index["regions"][iso_a3] = {
+          "offset": offset,
+          "length": len(wkb),
+          "sha256": hashlib.sha256(wkb).hexdigest(),
+          "bounds": list(geometry.bounds),
+      }
+      offset += len(wkb)
+  os.replace(f"{base_path}.wkb.tmp", f"{base_path}.wkb")
+  # The index is written last: its presence marks a complete store.
+  with open(f"{base_path}.index.json.tmp", "w") as f:
+    json.dump(index, f)
+  os.replace(f"{base_path}.index.json.tmp", f"{base_path}.index.json")
+  return f"{base_path}.index.json"
+
+
+class BoundaryStore:
+  """Read access to the indexed WKB store of one boundary source."""
+
+  def __init__(self, source_name: str, cache_dir: str = BOUNDARIES_CACHE_DIR):
+    base_path = os.path.join(cache_dir, _slug(source_name))
+    index = None
+    try:
+      with open(f"{base_path}.index.json") as f:
+        index = json.load(f)
+    except (OSError, ValueError):
+      pass
+    if index is None or index.get("version") != _STORE_VERSION:
+      with open(build_store(source_name, cache_dir)) as f:
+        index = json.load(f)
+    self.source_name = source_name
+    self._wkb_path = f"{base_path}.wkb"
+    self._regions = index["regions"]
+
+  def codes(self) -> list[str]:
+    """Returns the ISO_A3 codes in the store."""
+    return sorted(self._regions)
+
+  def bounds(self, iso_a3: str) -> tuple[float, float, float, float]:
+    """Returns the (minx, miny, maxx, maxy) of a country without reading it."""
+    return tuple(self._regions[iso_a3]["bounds"])
+
+  def get(self, iso_a3: str) -> shapely.geometry.base.BaseGeometry:
+    """Returns the EPSG:4326 geometry of a country.
+
+    Raises:
+      KeyError: If the source has no country with that ISO_A3 code.
+      ValueError: If the stored record is corrupt.
+    """
+    region = self._regions[iso_a3]
+    with open(self._wkb_path, "rb") as f:
+      f.seek(region["offset"])
+      wkb = f.read(region["length"])
+    if hashlib.sha256(wkb).hexdigest() != region["sha256"]:
+      raise ValueError(
+          f"Corrupt boundary store record {iso_a3} in {self._wkb_path}; delete"
+          " the store to rebuild it."
+      )
+    return shapely.from_wkb(wkb)
+
+
+@functools.lru_cache(maxsize=None)
+def get_store(
+    source_name: str, cache_dir: str = BOUNDARIES_CACHE_DIR
+) -> BoundaryStore:
+  """Returns the (cached) store of a boundary source, building it if needed."""
+  return BoundaryStore(source_name, cache_dir)
+
+
+def get_region_boundary(
+    source_name: str, iso_a3: str, cache_dir: str = BOUNDARIES_CACHE_DIR
+) -> shapely.geometry.base.BaseGeometry:
+  """Returns the EPSG:4326 geometry of the country `iso_a3` of a source."""
+  return get_store(source_name, cache_dir).get(iso_a3)
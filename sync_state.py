@@ -0,0 +1,85 @@
+import hashlib
+import json
+import os
+import threading
+
+# 同步状态文件名，保存在各下载目录下
+SYNC_STATE_FILE = ".sync_state.json"
+# 每记录多少个文件自动落盘一次，避免进程崩溃丢失全部状态
+AUTOSAVE_EVERY = 100
+
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    """
+    Returns the hex SHA-256 of the file at `path`.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class SyncState:
+    """
+    Local sync-state store for incremental downloads.
+
+    Maps each source URL to the local path, ETag, Last-Modified, size and
+    SHA-256 of the copy last downloaded from it. The store is a JSON file,
+    written atomically; it is safe to update from several download threads.
+
+    Parameters:
+    - path: Location of the JSON state file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._unsaved = 0
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                self._records = json.load(f)
+        except (OSError, ValueError):
+            self._records = {}
+
+    def get(self, url):
+        """
+        Returns the record stored for `url`, or None.
+        """
+        with self._lock:
+            return self._records.get(url)
+
+    def record(self, url, local_path, etag=None, last_modified=None, **extra):
+        """
+        Records the freshly downloaded `local_path` as the copy of `url`.
+
+        Extra keyword arguments are stored alongside the standard fields.
+        """
+        entry = {
+            "path": local_path,
+            "etag": etag,
+            "last_modified": last_modified,
+            "size": os.path.getsize(local_path),
+            "sha256": file_sha256(local_path),
+        }
+        entry.update(extra)
+        with self._lock:
+            self._records[url] = entry
+            self._unsaved += 1
+            autosave = self._unsaved >= AUTOSAVE_EVERY
+        if autosave:
+            self.save()
+
+    def save(self):
+        """
+        Writes the store to disk atomically.
+        """
+        with self._lock:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self._records, f, ensure_ascii=False, indent=1)
+            os.replace(tmp_path, self.path)
+            self._unsaved = 0
@@ -0,0 +1,180 @@
+"""Local catalog of resolved Open Buildings tiles.
+
+Written next to the url files while urls are extracted (see
+`open_buildings.stream_region_urls_to_files`), the catalog keeps what the
+manifests say about each tile, so later spatial lookups are answered from a
+local file instead of from GCS or by opening geotiffs. One row per tile:
+
+  url                   Url of the geotiff.
+  year                  Year of the manifest listing the tile.
+  s2_token              S2 cell of the manifest listing the tile.
+  crs                   Projection of the geotiff.
+  minx miny maxx maxy   Bounds of the geotiff in `crs`.
+  geometry              Footprint of the geotiff in EPSG:4326.
+
+Catalogs ending in ".parquet" are written as GeoParquet with a bounding box
+covering column (needs pyarrow); anything else is written as FlatGeobuf with
+its packed Hilbert R-tree index. Both let `read_catalog` read only the rows
+near the query geometry.
+"""
+
+import collections
+import functools
+from typing import Iterable, Optional
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pyproj
+import shapely
+from shapely.ops import transform
+
+CATALOG_CRS = "EPSG:4326"
+
+_BOUNDS_COLUMNS = ["minx", "miny", "maxx", "maxy"]
+
+
+@functools.lru_cache(maxsize=None)
+def _get_transformer(src_crs: str, dst_crs: str) -> pyproj.Transformer:
+  return pyproj.Transformer.from_crs(src_crs, dst_crs, always_xy=True)
+
+
+def get_footprints(bounds: np.ndarray, crs: str) -> np.ndarray:
+  """Returns the EPSG:4326 polygons of (n, 4) tile bounds in `crs`.
+
+  The four corners of each tile are reprojected, which is exact to well
+  under a pixel for tiles of a few kilometers.
+  """
+  minx, miny, maxx, maxy = bounds.T
+  xs = np.stack((minx, maxx, maxx, minx, minx), axis=1)
+  ys = np.stack((miny, miny, maxy, maxy, miny), axis=1)
+  lons, lats = _get_transformer(crs, CATALOG_CRS).transform(xs, ys)
+  return shapely.polygons(np.stack((lons, lats), axis=-1))
+
+
+class TileCatalogWriter:
+  """Accumulates tiles in memory and writes them as one catalog.
+
+  Rows are kept as columns of arrays until `write`, since a FlatGeobuf
+  spatial index can only be built once all features are known.
+  """
+
+  def __init__(self):
+    self._columns = collections.defaultdict(list)
+    self._num_tiles = 0
+
+  def __len__(self) -> int:
+    return self._num_tiles
+
+  def add(
+      self,
+      urls: np.ndarray,
+      bounds: np.ndarray,
+      crs: str,
+      year: Optional[int],
+      s2_token: str,
+  ) -> None:
+    """Adds parallel arrays of tile urls and (n, 4) bounds in `crs`."""
+    num_tiles = len(urls)
+    if not num_tiles:
+      return
+    self._columns["url"].append(np.asarray(urls, dtype=object))
+    self._columns["year"].append(
+        np.full(num_tiles, -1 if year is None else year, dtype=np.int32)
+    )
+    self._columns["s2_token"].append(np.full(num_tiles, s2_token, object))
+    self._columns["crs"].append(np.full(num_tiles, crs, dtype=object))
+    self._columns["bounds"].append(np.asarray(bounds, dtype=np.float64))
+    self._columns["geometry"].append(get_footprints(bounds, crs))
+    self._num_tiles += num_tiles
+
+  def to_geodataframe(self) -> gpd.GeoDataFrame:
+    """Returns the tiles added so far, sorted by url."""
+    if not self._num_tiles:
+      return gpd.GeoDataFrame(
+          {
+              "url": pd.Series(dtype=object),
+              "year": pd.Series(dtype=np.int32),
+              "s2_token": pd.Series(dtype=object),
+              "crs": pd.Series(dtype=object),
+              **{name: pd.Series(dtype=np.float64) for name in _BOUNDS_COLUMNS},
+          },
+          geometry=gpd.GeoSeries([], crs=CATALOG_CRS),
+      )
+    columns = {
+        name: np.concatenate(values) for name, values in self._columns.items()
+    }
+    bounds = columns.pop("bounds")
+    geometry = columns.pop("geometry")
+    catalog = gpd.GeoDataFrame(
+        {
+            **columns,
+            **{name: bounds[:, i] for i, name in enumerate(_BOUNDS_COLUMNS)},
+        },
+        geometry=gpd.GeoSeries(geometry, crs=CATALOG_CRS),
+    )
+    return catalog.sort_values("url", ignore_index=True)
+
+  def write(self, path: str) -> int:
+    """Writes the catalog to `path`; returns the number of tiles written."""
+    write_catalog(self.to_geodataframe(), path)
+    return self._num_tiles
+
+
+def write_catalog(catalog: gpd.GeoDataFrame, path: str) -> None:
+  """Writes a catalog as GeoParquet or FlatGeobuf, by `path`'s extension."""
+  if path.endswith(".parquet"):
+    catalog.to_parquet(path, write_covering_bbox=True)
+  else:
+    catalog.to_file(path, driver="FlatGeobuf", SPATIAL_INDEX="YES")
+
+
+def read_catalog(
+    path: str,
+    geometry: Optional[shapely.geometry.base.BaseGeometry] = None,
+    years: Optional[Iterable[int]] = None,
+) -> gpd.GeoDataFrame:
+  """Reads the tiles of a catalog intersecting `geometry` in `years`.
+
+  Only the rows whose footprint's bounding box meets `geometry`'s are read,
+  through the file's spatial index. The remaining tiles are then tested
+  against `geometry` reprojected to each tile's own projection, the same
+  test the url extraction uses, so a query returns exactly the tiles the
+  extraction would have.
+
+  Args:
+    path: Catalog written by `write_catalog`.
+    geometry: EPSG:4326 geometry; all tiles when None.
+    years: Years to keep; all years when None.
+
+  Returns:
+    The matching rows, in catalog order.
+  """
+  bbox = None if geometry is None else tuple(geometry.bounds)
+  if path.endswith(".parquet"):
+    catalog = gpd.read_parquet(path, bbox=bbox)
+  else:
+    catalog = gpd.read_file(path, bbox=bbox)
+  if years is not None:
+    catalog = catalog[catalog["year"].isin(list(years))]
+  if geometry is None or catalog.empty:
+    return catalog
+  keep = np.zeros(len(catalog), dtype=bool)
+  for crs, indices in catalog.groupby("crs").indices.items():
+    bounds = catalog[_BOUNDS_COLUMNS].to_numpy()[indices]
+    geometry_in_crs = transform(
+        _get_transformer(CATALOG_CRS, crs).transform, geometry
+    )
+    keep[indices] = shapely.intersects(
+        shapely.box(*bounds.T), geometry_in_crs
+    )
+  return catalog[keep]
+
+
+def query_tiles(
+    path: str,
+    geometry: shapely.geometry.base.BaseGeometry,
+    years: Optional[Iterable[int]] = None,
+) -> list[str]:
+  """Returns the urls of a catalog's tiles intersecting `geometry`."""
+  return read_catalog(path, geometry, years)["url"].tolist()